@@ -3,42 +3,168 @@ import torch
 import pandas as pd
 from torchvision import transforms
 import numpy as np
+import os
+import math
+import json
+import shutil
+import hashlib
+import tempfile
+import warnings
+
+
+CACHE_VERSION = 1
+
+
+def _file_hash(file_path, block_size=1 << 20):
+    """
+    SHA1 of a file, read in blocks so that large spectra files are not loaded at once.
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _to_builtin(label):
+    """
+    Convert an index label (possibly a tuple of numpy scalars) to JSON friendly objects.
+    """
+    if isinstance(label, tuple):
+        return [_to_builtin(x) for x in label]
+    return label.item() if hasattr(label, 'item') else label
+
+
+def get_cache_dir(csv_fn):
+    """
+    The binary cache of `csv_fn` lives next to it, e.g. `spectra.csv` -> `spectra.csv.cache/`.
+    """
+    return f"{os.path.abspath(csv_fn)}.cache"
+
+
+def _cache_is_valid(cache_dir, csv_fn):
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("version") != CACHE_VERSION:
+        return False
+    stat = os.stat(csv_fn)
+    if meta["size"] != stat.st_size:
+        return False
+    if meta["mtime"] == stat.st_mtime:
+        return True
+    # The file has been touched, only rebuild if the content has changed.
+    return meta["sha1"] == _file_hash(csv_fn)
+
+
+def build_spectra_cache(csv_fn, cache_dir=None):
+    """
+    Convert the spectra csv file into a binary cache directory which contains:
+        data.npy : float32 array of all the (AUX_ and ENE_) columns.
+        meta.json : column names, atom labels (the MultiIndex) and the hash/mtime of the csv file.
+    The cache is written into a temporary directory first and then renamed, so that
+    concurrent trials starting at the same time never see a half written cache. If another
+    process has meanwhile built a valid cache, theirs is kept.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir(csv_fn)
+    full_df = pd.read_csv(csv_fn, index_col=[0, 1], comment='#')
+    stat = os.stat(csv_fn)
+    meta = {
+        "version": CACHE_VERSION,
+        "source": os.path.abspath(csv_fn),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha1": _file_hash(csv_fn),
+        "columns": full_df.columns.to_list(),
+        "index": [_to_builtin(label) for label in full_df.index.to_list()]
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=os.path.dirname(cache_dir))
+    new_dir = os.path.join(tmp_dir, "cache")
+    try:
+        os.mkdir(new_dir)
+        np.save(os.path.join(new_dir, "data.npy"), full_df.to_numpy(dtype=np.float32))
+        with open(os.path.join(new_dir, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+        if _cache_is_valid(cache_dir, csv_fn):
+            return cache_dir # another process has just rebuilt the cache, use theirs.
+        if os.path.isdir(cache_dir):
+            # move the stale cache out of the way, it is deleted with the temporary directory.
+            try:
+                os.rename(cache_dir, os.path.join(tmp_dir, "stale"))
+            except FileNotFoundError:
+                pass # already moved by another process.
+        try:
+            os.rename(new_dir, cache_dir)
+        except OSError:
+            if not _cache_is_valid(cache_dir, csv_fn):
+                raise
+            # another process has just created the cache, use theirs.
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return cache_dir
+
+
+def load_spectra_cache(csv_fn):
+    """
+    Return `(data, columns, index)` of the csv file, where `data` is a read-only memory map
+    of the float32 cache. The cache is (re)built if it is missing or out of date.
+    """
+    cache_dir = get_cache_dir(csv_fn)
+    if not _cache_is_valid(cache_dir, csv_fn):
+        build_spectra_cache(csv_fn, cache_dir)
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        meta = json.load(f)
+    data = np.load(os.path.join(cache_dir, "data.npy"), mmap_mode='r')
+    index = [tuple(label) if isinstance(label, list) else label for label in meta["index"]]
+    return data, meta["columns"], index
 
 
 class AuxSpectraDataset(Dataset):
     def __init__(self, csv_fn, split_portion, train_val_test_ratios=(0.7, 0.15, 0.15),
-                 n_aux=0, transform=None):
+                 n_aux=0, transform=None, cache=False):
         self.metadata = self._process_metadata(csv_fn, train_val_test_ratios)
-        full_df = pd.read_csv(csv_fn, index_col=[0, 1], comment='#')
-        self.grid = np.array([float(col.strip('ENE_')) for col in full_df.columns if col.startswith('ENE_')])
-        n_train_val_test = [int(len(full_df) * ratio)
+        if cache:
+            try:
+                full_data, columns, full_index = load_spectra_cache(csv_fn)
+            except OSError as e: # e.g. the directory of the csv file is read-only
+                warnings.warn(f"Cannot use the cache of {csv_fn}, reading the csv file instead: {e}")
+                cache = False
+        if not cache:
+            full_df = pd.read_csv(csv_fn, index_col=[0, 1], comment='#')
+            full_data, columns, full_index = full_df.to_numpy(), full_df.columns.to_list(), full_df.index.to_list()
+        self.grid = np.array([float(col.strip('ENE_')) for col in columns if col.startswith('ENE_')])
+        n_train_val_test = [int(len(full_data) * ratio)
                             for ratio in train_val_test_ratios]
-        n_train_val_test[-1] = int(len(full_df)) - sum(n_train_val_test[:-1])
+        n_train_val_test[-1] = int(len(full_data)) - sum(n_train_val_test[:-1])
         portion_options = ['train', 'val', 'test']
         assert split_portion in portion_options
         i_prev = portion_options.index(split_portion)
-        df = full_df[sum(n_train_val_test[:i_prev]):sum(n_train_val_test[:i_prev+1])]
-        assert "ENE_" in df.columns.to_list()[n_aux]
+        i_start, i_end = sum(n_train_val_test[:i_prev]), sum(n_train_val_test[:i_prev+1])
+        assert "ENE_" in columns[n_aux]
         if n_aux > 0:
-            assert "ENE_" not in df.columns.to_list()[n_aux-1]
-            assert "AUX_" in df.columns.to_list()[0]
-            assert "AUX_" in df.columns.to_list()[n_aux-1]
-        data = df.to_numpy()
+            assert "ENE_" not in columns[n_aux-1]
+            assert "AUX_" in columns[0]
+            assert "AUX_" in columns[n_aux-1]
+        data = full_data[i_start:i_end]
         self.spec = data[:, n_aux:]
         if n_aux > 0:
             self.aux = data[:, :n_aux]
         else:
             self.aux = None
         self.transform = transform
-        self.atom_index = df.index.to_list()
-    
+        self.atom_index = full_index[i_start:i_end]
+
     def _process_metadata(self, file_path, split_ratio):
         metadata = {
                 "path": file_path,
                 "train_test_val_split_ratio": split_ratio
         }
         return metadata
-    
+
     def __len__(self):
         return self.spec.shape[0]
 
@@ -58,15 +184,53 @@ class AuxSpectraDataset(Dataset):
 
 class ToTensor(object):
     def __call__(self, sample):
-        return torch.Tensor(sample)
+        return torch.tensor(sample, dtype=torch.float32)
+
 
+class TensorBatchLoader(object):
+    """
+    A fast-path replacement of `DataLoader` for datasets that fit in (device) memory.
+    The whole split is kept as two contiguous tensors on `device`, and each epoch yields
+    `(spec, aux)` batches by index slicing a (shuffled) permutation, so there is no per-sample
+    collation. As for `AuxSpectraDataset`, `aux` is a column of zeros if the dataset has no aux.
+    Batches are copies, so in-place operations on them do not touch the stored split.
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, device=torch.device('cpu')):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.spec = torch.tensor(np.asarray(dataset.spec), dtype=torch.float32, device=device)
+        aux = dataset.aux if dataset.aux is not None else np.zeros((len(dataset), 1))
+        self.aux = torch.tensor(np.asarray(aux), dtype=torch.float32, device=device)
 
-def get_dataloaders(csv_fn, batch_size, train_val_test_ratios=(0.7, 0.15, 0.15), n_aux=0):
+    def __len__(self):
+        return math.ceil(self.spec.size()[0] / self.batch_size)
+
+    def __iter__(self):
+        n_samples = self.spec.size()[0]
+        if self.shuffle:
+            index = torch.randperm(n_samples, device=self.device)
+        else:
+            index = torch.arange(n_samples, device=self.device)
+        for i in range(0, n_samples, self.batch_size):
+            batch_index = index[i:i+self.batch_size]
+            yield self.spec[batch_index], self.aux[batch_index]
+
+
+def get_dataloaders(csv_fn, batch_size, train_val_test_ratios=(0.7, 0.15, 0.15), n_aux=0, cache=False,
+                    device_resident=False, device=torch.device('cpu')):
     transform_list = transforms.Compose([ToTensor()])
     ds_train,  ds_val, ds_test = [AuxSpectraDataset(
-        csv_fn, p, train_val_test_ratios, transform=transform_list, n_aux=n_aux)
+        csv_fn, p, train_val_test_ratios, transform=transform_list, n_aux=n_aux, cache=cache)
         for p in ["train", "val", "test"]]
 
+    if device_resident:
+        train_loader = TensorBatchLoader(ds_train, batch_size, shuffle=True, device=device)
+        val_loader = TensorBatchLoader(ds_val, batch_size, device=device)
+        test_loader = TensorBatchLoader(ds_test, batch_size, device=device)
+        return train_loader, val_loader, test_loader
+
     train_loader = DataLoader(
         ds_train, batch_size=batch_size, shuffle=True, num_workers=0, pin_memory=False)
     val_loader = DataLoader(ds_val, batch_size=batch_size,
@@ -3,6 +3,7 @@ import numbers
 import torch
 from torch import nn
 from torch.autograd import Function
+from sc.utils.compat import autocast, is_fx_proxy
 
 
 class GradientReversalLayer(Function):
@@ -21,6 +22,17 @@ class GradientReversalLayer(Function):
             grad_input = -grad_input * ctx.beta
         return grad_input, None
 
+
+def float32_forward(module, x):
+    """
+    Apply `module` to `x` in fp32, also inside an autocast (mixed precision) region.
+    """
+    if is_fx_proxy(x): # symbolic tracing, see `sc.utils.export`
+        return module(x.float())
+    with autocast(x.device.type, enabled=False):
+        return module(x.float())
+
+
 class EncodingBlock(nn.Module):
     def __init__(self, in_channels, out_channels, in_len, out_len, kernel_size=7, stride=2, excitation=4,
                  dropout_rate=0.2):
@@ -232,7 +244,13 @@ class GaussianSmoothing(nn.Module):
 class Encoder(nn.Module):
     """ front end part of discriminator and Q"""
 
-    def __init__(self, dropout_rate=0.2, nstyle=5, dim_in=256):
+    def __init__(
+        self, 
+        dropout_rate = 0.2, 
+        nstyle = 5, 
+        dim_in = 256,
+        n_layers = 3 # A place holder here for now . Only effective for FC model.
+    ):
         super(Encoder, self).__init__()
         self.main = nn.Sequential(
             EncodingBlock(in_channels=1, out_channels=4, in_len=dim_in, out_len=128, kernel_size=11, stride=2,
@@ -256,7 +274,7 @@ class Encoder(nn.Module):
         output = output.reshape(batch_size, 32)
 
         z_gauss = self.lin3(output)
-        z_gauss = self.bn_style(z_gauss)
+        z_gauss = float32_forward(self.bn_style, z_gauss) # fp32 under mixed precision
 
         return z_gauss
 
@@ -290,7 +308,7 @@ class CompactEncoder(nn.Module):
         output = output.reshape(batch_size, 32)
 
         z_gauss = self.lin3(output)
-        z_gauss = self.bn_style(z_gauss)
+        z_gauss = float32_forward(self.bn_style, z_gauss) # fp32 under mixed precision
 
         return z_gauss
 
@@ -298,7 +316,13 @@ class CompactEncoder(nn.Module):
 class QvecEncoder(nn.Module):
     """ for Q vector only"""
 
-    def __init__(self, dropout_rate=0.2, nstyle=5, dim_in=12):
+    def __init__(
+        self, 
+        dropout_rate = 0.2, 
+        nstyle = 5, 
+        dim_in = 12,
+        n_layers = 3 # A place holder here for now . Only effective for FC model.
+    ):
         super(QvecEncoder, self).__init__()
         self.main = nn.Sequential(
             nn.Linear(dim_in, 8),
@@ -380,7 +404,15 @@ class FCEncoder(nn.Module):
 
 class Decoder(nn.Module):
 
-    def __init__(self, dropout_rate=0.2, nstyle=5, debug=False, last_layer_activation='ReLu'):
+    def __init__(
+        self, 
+        dropout_rate = 0.2, 
+        nstyle = 5, 
+        debug = False, 
+        last_layer_activation = 'ReLu', 
+        dim_out = 256, # A place holder, the output length is always 256.
+        n_layers = 3 # A place holder here for now . Only effective for FC model.
+    ):
         super(Decoder, self).__init__()
 
         if last_layer_activation == 'ReLu':
@@ -476,7 +508,15 @@ class CompactDecoder(nn.Module):
 
 class QvecDecoder(nn.Module):
 
-    def __init__(self, dropout_rate=0.2, nstyle=5, debug=False, last_layer_activation='ReLu', dim_out=12):
+    def __init__(
+        self, 
+        dropout_rate = 0.2, 
+        nstyle = 5, 
+        debug = False, 
+        last_layer_activation = 'ReLu', 
+        dim_out = 12,
+        n_layers = 3 # A place holder here for now . Only effective for FC model.
+    ):
         super(QvecDecoder, self).__init__()
 
         if last_layer_activation == 'ReLu':
@@ -0,0 +1,146 @@
+import copy
+import torch
+from torch import nn
+
+
+class PackedLinear(nn.Module):
+    """
+    `n_replicas` independent `nn.Linear` layers evaluated with one batched matrix product.
+    The input is packed replica-major: shape (n_replicas * batch_size, in_features).
+    """
+
+    def __init__(self, linears):
+        super(PackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([l.weight.detach().clone() for l in linears]))
+        if linears[0].bias is not None:
+            self.bias = nn.Parameter(torch.stack([l.bias.detach().clone() for l in linears]))
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        n_replicas = self.weight.size()[0]
+        x = x.reshape(n_replicas, -1, x.size()[-1])
+        if self.bias is not None:
+            out = torch.baddbmm(self.bias.unsqueeze(dim=1), x, self.weight.transpose(1, 2))
+        else:
+            out = torch.bmm(x, self.weight.transpose(1, 2))
+        return out.reshape(-1, out.size()[-1])
+
+    def unpack(self, k, linear):
+        linear.weight.copy_(self.weight[k])
+        if self.bias is not None:
+            linear.bias.copy_(self.bias[k])
+
+
+class PackedPReLU(nn.Module):
+
+    def __init__(self, prelus):
+        super(PackedPReLU, self).__init__()
+        self.weight = nn.Parameter(torch.stack([p.weight.detach().clone() for p in prelus]))
+
+    def forward(self, x):
+        n_replicas, n_weight = self.weight.size()
+        x = x.reshape(n_replicas, -1, x.size()[-1])
+        out = torch.where(x >= 0, x, self.weight.view(n_replicas, 1, n_weight) * x)
+        return out.reshape(-1, out.size()[-1])
+
+    def unpack(self, k, prelu):
+        prelu.weight.copy_(self.weight[k])
+
+
+class PackedBatchNorm1d(nn.Module):
+    """
+    `n_replicas` independent `nn.BatchNorm1d(num_features, affine=False)` as one batch norm over
+    `n_replicas * num_features` channels.
+    """
+
+    def __init__(self, bns):
+        super(PackedBatchNorm1d, self).__init__()
+        bn = bns[0]
+        assert not bn.affine, "Only BatchNorm1d(affine=False) can be packed."
+        self.n_replicas = len(bns)
+        self.bn = nn.BatchNorm1d(
+            self.n_replicas * bn.num_features, eps=bn.eps, momentum=bn.momentum, affine=False,
+            track_running_stats=bn.track_running_stats
+        )
+        if bn.track_running_stats:
+            self.bn.running_mean.copy_(torch.cat([b.running_mean for b in bns]))
+            self.bn.running_var.copy_(torch.cat([b.running_var for b in bns]))
+            self.bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+
+    def forward(self, x):
+        n_features = x.size()[-1]
+        x = x.reshape(self.n_replicas, -1, n_features).transpose(0, 1)
+        batch_size = x.size()[0]
+        out = self.bn(x.reshape(batch_size, -1))
+        return out.reshape(batch_size, self.n_replicas, n_features).transpose(0, 1).reshape(-1, n_features)
+
+    def unpack(self, k, bn):
+        if bn.track_running_stats:
+            n_features = bn.num_features
+            bn.running_mean.copy_(self.bn.running_mean[k*n_features:(k+1)*n_features])
+            bn.running_var.copy_(self.bn.running_var[k*n_features:(k+1)*n_features])
+            bn.num_batches_tracked.copy_(self.bn.num_batches_tracked)
+
+
+PACKED_LAYER_DICT = {
+    nn.Linear: PackedLinear,
+    nn.PReLU: PackedPReLU,
+    nn.BatchNorm1d: PackedBatchNorm1d
+}
+PACKED_LAYERS = tuple(PACKED_LAYER_DICT.values())
+
+
+def pack_models(models):
+    """
+    Pack identical-architecture models (e.g. `FCEncoder`s differing only in their initialization)
+    into one model evaluating all of them at once.
+
+    The packed model is a copy of the first model with each `nn.Linear`, `nn.PReLU` and
+    `nn.BatchNorm1d` replaced by its packed version, so its `forward` is unchanged. Tensors are
+    packed replica-major: the input and output of shape (n_replicas * batch_size, ...) hold
+    the batch of replica k in rows [k * batch_size, (k + 1) * batch_size). All the parameters
+    have the replica as their first dimension, the replicas are independent as long as the
+    losses are summed over the replicas and the optimizer is element-wise (Adam, AdaBound...).
+    Layers with parameters or buffers of any other type (e.g. convolutions) can not be packed.
+    """
+    packed = copy.deepcopy(models[0])
+    for name, module in list(models[0].named_modules()):
+        if len(list(module.children())) > 0:
+            continue
+        if len(list(module.parameters())) == 0 and len(list(module.buffers())) == 0:
+            continue # stateless layers (activations, dropout) work on packed tensors as is.
+        if type(module) not in PACKED_LAYER_DICT:
+            raise ValueError(f"Layer {name} ({type(module).__name__}) can not be packed.")
+        packed_module = PACKED_LAYER_DICT[type(module)]([m.get_submodule(name) for m in models])
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(packed.get_submodule(parent_name), child_name, packed_module)
+    return packed
+
+
+def unpack_model(packed, k, model):
+    """
+    Copy the replica `k` of the `packed` model into `model`, a model of the original architecture.
+    """
+    with torch.no_grad():
+        for name, module in packed.named_modules():
+            if isinstance(module, PACKED_LAYERS):
+                module.unpack(k, model.get_submodule(name))
+    model.train(packed.training)
+    return model
+
+
+class ReplicaLoss(nn.Module):
+    """
+    Wrap a loss module to return the mean loss of each of the `n_replicas` replicas of packed
+    inputs, as a vector of shape (n_replicas,).
+    """
+
+    def __init__(self, loss_fn, n_replicas):
+        super(ReplicaLoss, self).__init__()
+        self.loss_fn = loss_fn
+        self.loss_fn.reduction = 'none'
+        self.n_replicas = n_replicas
+
+    def forward(self, input, target):
+        return self.loss_fn(input, target).reshape(self.n_replicas, -1).mean(dim=1)
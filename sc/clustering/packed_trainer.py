@@ -0,0 +1,334 @@
+import os
+import logging
+import numpy as np
+
+import torch
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+from sc.clustering.trainer import Trainer
+from sc.clustering.packed import pack_models, unpack_model, ReplicaLoss
+from sc.utils.parameter import AE_CLS_DICT, Parameters
+from sc.utils.checkpoint import CheckpointManager
+from sc.utils.metrics_writer import MetricsWriter
+from sc.utils.functions import style_normality, style_coupling, alpha
+
+
+class PackedTrainer(Trainer):
+    """
+    Train several independent replicas of the same (fully connected) model in lock-step, on the
+    same batches, as one packed model (see `sc.clustering.packed.pack_models`).
+
+    Every loss is a vector of the per-replica losses, their sum is backpropagated so each
+    replica gets the gradients of its own loss. Each replica has its own learning rate
+    schedulers, best checkpoints and `work_dir` with the same outputs as a `Trainer` (losses.csv,
+    messages.txt, best.pt, final.pt). Resuming (`resume_interval`) is not supported.
+    """
+
+    def __init__(
+        self,
+        encoders, decoders, discriminators, device, train_loader, val_loader,
+        verbose=True, work_dirs=None,
+        config_parameters = Parameters({}),
+        loggers = None,
+        loss_loggers = None
+    ):
+        self.n_replicas = len(encoders)
+        self.work_dirs = work_dirs if work_dirs is not None else ['.'] * self.n_replicas
+        self.loggers = loggers if loggers is not None else [logging.getLogger("training")] * self.n_replicas
+        self.loss_loggers = loss_loggers if loss_loggers is not None else [logging.getLogger("losses")] * self.n_replicas
+        # regular (unpacked) models the replicas are copied into to be checkpointed.
+        self.replica_models = [
+            {"Encoder": e, "Decoder": d, "Style Discriminator": dis}
+            for e, d, dis in zip(encoders, decoders, discriminators)
+        ]
+        super(PackedTrainer, self).__init__(
+            pack_models(encoders), pack_models(decoders), pack_models(discriminators),
+            device, train_loader, val_loader,
+            verbose=verbose, work_dir=self.work_dirs[0], config_parameters=config_parameters,
+            logger=self.loggers[0], loss_logger=self.loss_loggers[0]
+        )
+        # the real gaussian samples of the adversarial losses are drawn for all the replicas.
+        self.batch_size = self.n_replicas * self.batch_size
+        # the validation chunks must not straddle the replicas.
+        self.val_chunk_size = None
+
+
+    def loss_functions(self):
+        return tuple(
+            ReplicaLoss(loss_fn, self.n_replicas).to(self.device)
+            for loss_fn in super(PackedTrainer, self).loss_functions()
+        )
+
+
+    def aux_loss(self, aux_in, styles, n_pairs=None):
+        aux_in = aux_in.reshape(self.n_replicas, -1, aux_in.size()[-1])
+        styles = styles.reshape(self.n_replicas, -1, styles.size()[-1])
+        return torch.stack([
+            super(PackedTrainer, self).aux_loss(a, s, n_pairs=n_pairs) for a, s in zip(aux_in, styles)
+        ])
+
+
+    def load_validation_data(self):
+        if self.val_cache and self._val_data is not None:
+            return self._val_data
+        val_cache, self.val_cache = self.val_cache, False
+        spec_in_val, aux_in_val = super(PackedTrainer, self).load_validation_data()
+        self.val_cache = val_cache
+        val_data = (spec_in_val.repeat(self.n_replicas, 1), aux_in_val.repeat(self.n_replicas, 1))
+        if self.val_cache:
+            self._val_data = val_data
+        return val_data
+
+
+    def load_schedulers(self):
+        """
+        One `ReduceLROnPlateau` per optimizer and replica. Each scheduler drives the learning
+        rate (starting at 1) of a proxy optimizer, used as the factor of the updates of its
+        replica in `optimizer_step`.
+        """
+        self.schedulers = {}
+        self.lr_scales = {}
+        for name in self.optimizers:
+            self.lr_scales[name] = torch.ones(self.n_replicas, device=self.device)
+            for k in range(self.n_replicas):
+                proxy = torch.optim.SGD([torch.zeros(1, requires_grad=True)], lr=1.0)
+                self.schedulers[(name, k)] = ReduceLROnPlateau(
+                    proxy, mode="min", factor=self.sch_factor, patience=self.sch_patience,
+                    cooldown=0, threshold=0.01
+                )
+
+
+    def optimizer_step(self, name, loss):
+        """
+        Step the optimizer `name` on the sum of the per-replica losses `loss`, then scale the
+        update of each replica by its learning rate factor.
+        """
+        scales = self.lr_scales[name]
+        params = [p for group in self.optimizers[name].param_groups for p in group['params']]
+        scaled = bool((scales != 1.0).any())
+        if scaled:
+            params_before = [p.detach().clone() for p in params]
+        super(PackedTrainer, self).optimizer_step(name, loss.sum())
+        if scaled:
+            with torch.no_grad():
+                for p, p_before in zip(params, params_before):
+                    scale = scales.view(-1, *[1] * (p.dim() - 1))
+                    p.copy_(p_before + (p - p_before) * scale)
+
+
+    def replica_checkpoint_models(self, k):
+        """
+        Copy the replica `k` into its regular models and return them.
+        """
+        models = self.replica_models[k]
+        unpack_model(self.encoder, k, models["Encoder"])
+        unpack_model(self.decoder, k, models["Decoder"])
+        unpack_model(self.discriminator, k, models["Style Discriminator"])
+        return models
+
+
+    def train(self, callback=None):
+        """
+        Same as `Trainer.train` for every replica. `callback(epoch, metrics)` is called with the
+        list of the metrics of the replicas and may return a list of booleans, True to stop the
+        corresponding replica. A stopped replica is frozen and its final models are saved, the
+        pack stops when all of them are. Returns the last metrics of the replicas.
+        """
+        if self.verbose:
+            para_info = torch.__config__.parallel_info()
+            self.logger.info(para_info)
+
+        n_replicas = self.n_replicas
+        mse_loss, nll_loss, bce_lgt_loss = self.loss_functions()
+        best_combined_metric = [np.inf] * n_replicas # lower is better
+        min_style_normality, max_style_coupling = None, None
+        checkpoints = []
+        for k in range(n_replicas):
+            chkpt_dir = f"{self.work_dirs[k]}/checkpoints"
+            if not os.path.exists(chkpt_dir):
+                os.makedirs(chkpt_dir, exist_ok=True)
+            checkpoints.append(
+                CheckpointManager(
+                    chkpt_dir, self.replica_models[k],
+                    top_k=self.checkpoint_top_k,
+                    asynchronous=self.async_checkpoint,
+                    greater_is_better=False
+                )
+            )
+            self.loss_loggers[k].info(
+                    "Epoch,Train_D,Val_D,Train_G,Val_G,Train_Aux,Val_Aux,Train_Recon,"
+                    "Val_Recon,Train_Smooth,Val_Smooth,Train_Mutual_Info,Val_Mutual_Info"
+            )
+        loss_names = self.loss_names
+        metrics_writers = [
+            MetricsWriter(os.path.join(self.work_dirs[k], self.tb_logdir)) if self.tensorboard else None
+            for k in range(n_replicas)
+        ]
+        metrics = [None] * n_replicas
+        early_stop = [(np.inf, 0)] * n_replicas # best combined metric and its epoch
+        stopped = [False] * n_replicas
+
+        for epoch in range(self.max_epoch):
+            self.epoch = epoch
+            self.encoder.train()
+            self.decoder.train()
+            self.discriminator.train()
+
+            if self.gradient_reversal:
+                alpha_ = alpha(epoch/self.max_epoch, self.alpha_flat_step, self.alpha_limit)
+            else:
+                alpha_ = None
+
+            n_batch = len(self.train_loader)
+            # (n_replicas, n_losses) sums of the training losses, read once per epoch.
+            train_loss_sums = torch.zeros(n_replicas, len(loss_names), dtype=torch.float64, device=self.device)
+            for spec_in, aux_in in self.train_loader:
+                # every replica trains on the same batch.
+                spec_in = spec_in.to(self.device).repeat(n_replicas, 1)
+                if self.train_loader.dataset.aux is None:
+                    aux_in = None
+                else:
+                    assert len(aux_in.size()) == 2
+                    aux_in = aux_in.to(self.device).repeat(n_replicas, 1)
+
+                spec_in += torch.randn_like(spec_in, requires_grad=False) * self.spec_noise
+                if self.train_step == "fused":
+                    train_step = self.fused_step
+                else:
+                    train_step = self.sequential_step
+                with torch.autograd.set_detect_anomaly(self.detect_anomaly), self.autocast():
+                    train_losses = train_step(
+                        spec_in, aux_in, epoch, alpha_,
+                        mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
+                    )
+                train_loss_sums += torch.stack(
+                    [
+                        train_losses[name].detach().to(self.device, torch.float64).reshape(-1).expand(n_replicas)
+                        for name in loss_names
+                    ], dim=1
+                )
+                self.zerograd()
+
+            grad_norms = self.log_grad_norms() if self.record_grad_norm else None # of all the replicas
+
+            ### Validation ###
+            self.encoder.eval()
+            self.decoder.eval()
+            self.discriminator.eval()
+
+            z, val_losses = self.validate(
+                alpha_,
+                mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
+            )
+            # (n_replicas, n_losses) tables of the training and validation losses
+            train_losses = (train_loss_sums / n_batch).tolist() # epoch means
+            val_losses = torch.stack(
+                [val_losses[name].reshape(-1).expand(n_replicas) for name in loss_names], dim=1
+            ).tolist()
+
+            if epoch % self.loss_log_interval == 0:
+                for k in [k for k in range(n_replicas) if not stopped[k]]:
+                    self.loss_loggers[k].info(
+                        f"{epoch:d},\t" + "".join(
+                            f"{loss_train:.6f},\t{loss_val:.6f},\t"
+                            for loss_train, loss_val in zip(train_losses[k], val_losses[k])
+                        )
+                    )
+
+            avg_mutual_info = [losses[loss_names.index("Mutual_Info")] for losses in train_losses]
+            fresh_metrics = epoch % self.metric_interval == 0 or epoch == self.max_epoch - 1
+            if fresh_metrics:
+                z = z.reshape(n_replicas, -1, z.size()[-1])
+                min_style_normality, max_style_coupling = torch.stack([
+                    torch.stack([style_normality(z_k).min(), style_coupling(z_k)[1]]) for z_k in z
+                ]).cpu().T.tolist()
+            for k in range(n_replicas):
+                if stopped[k]: # the metrics of a stopped replica stay those of its last epoch.
+                    continue
+                metrics[k] = [
+                    min_style_normality[k], val_losses[k][loss_names.index("Recon")], avg_mutual_info[k],
+                    max_style_coupling[k], val_losses[k][loss_names.index("Aux")] if aux_in is not None else 0
+                ]
+                combined_metric = - (np.array(self.metric_weights) * np.array(metrics[k])).sum()
+                if fresh_metrics and combined_metric < best_combined_metric[k]:
+                    best_combined_metric[k] = combined_metric
+                    self.replica_checkpoint_models(k)
+                    checkpoints[k].save(combined_metric, epoch)
+
+                if metrics_writers[k] is not None:
+                    self.write_metrics(
+                        metrics_writers[k], epoch, train_losses[k], val_losses[k], metrics[k],
+                        z=z[k] if fresh_metrics and epoch % self.loss_log_interval == 0 else None,
+                        grad_norms=grad_norms,
+                        learning_rates={ # the learning rate of the optimizer scaled for the replica
+                            name: opt.param_groups[0]['lr'] * self.schedulers[(name, k)].optimizer.param_groups[0]['lr']
+                            for name, opt in self.optimizers.items()
+                        }
+                    )
+
+                for name in self.optimizers:
+                    sch = self.schedulers[(name, k)]
+                    sch.step(combined_metric)
+                    self.lr_scales[name][k] = sch.optimizer.param_groups[0]['lr']
+
+                if fresh_metrics and combined_metric < early_stop[k][0]:
+                    early_stop[k] = (combined_metric, epoch)
+
+            callback_stops = callback(epoch, metrics) if callback is not None else None
+            for k in range(n_replicas):
+                if stopped[k]:
+                    continue
+                stop_reason = None
+                if self.early_stop_patience and epoch - early_stop[k][1] >= self.early_stop_patience:
+                    stop_reason = f"no improvement of the combined metric since epoch {early_stop[k][1]}"
+                if callback_stops is not None and callback_stops[k]:
+                    stop_reason = "stopped by the callback"
+                if stop_reason is not None:
+                    # freeze the replica and save its final models now.
+                    stopped[k] = True
+                    for name in self.optimizers:
+                        self.lr_scales[name][k] = 0.0
+                    self.replica_checkpoint_models(k)
+                    checkpoints[k].save_final(f'{self.work_dirs[k]}/final.pt')
+                    self.loggers[k].info(f"Training stopped at epoch {epoch}: {stop_reason}.")
+            if all(stopped):
+                break
+
+        # save the final models
+        for k in range(n_replicas):
+            if not stopped[k]:
+                self.replica_checkpoint_models(k)
+                checkpoints[k].save_final(f'{self.work_dirs[k]}/final.pt')
+            checkpoints[k].save_best(f'{self.work_dirs[k]}/best.pt')
+            checkpoints[k].close()
+            if metrics_writers[k] is not None:
+                metrics_writers[k].close()
+
+        return metrics
+
+
+    @classmethod
+    def from_data(
+        cls, csv_fn,
+        igpu=0, verbose=True, work_dirs=None,
+        train_ratio=0.7, validation_ratio=0.15, test_ratio=0.15,
+        config_parameters = Parameters({}),
+        loggers = None,
+        loss_loggers = None
+    ):
+        p = config_parameters
+        assert p.ae_form in AE_CLS_DICT
+        logger = loggers[0] if loggers is not None else logging.getLogger("from_data")
+
+        device = cls.get_device(igpu, verbose=verbose, logger=logger)
+        dl_train, dl_val = cls.get_loaders(csv_fn, p, device, (train_ratio, validation_ratio, test_ratio))
+
+        # One independently initialized set of models per replica
+        encoders, decoders, discriminators = zip(*[cls.build_models(p, device) for _ in work_dirs])
+
+        trainer = PackedTrainer(
+            encoders, decoders, discriminators, device, dl_train, dl_val,
+            verbose=verbose, work_dirs=work_dirs,
+            config_parameters=p, loggers=loggers, loss_loggers=loss_loggers
+        )
+        return trainer
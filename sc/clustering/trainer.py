@@ -1,14 +1,13 @@
-import shutil
 import os
+import random
+import functools
 import logging
-import itertools
+from collections import defaultdict
 import seaborn as sns
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import shapiro, spearmanr
 
 import torch
-torch.autograd.set_detect_anomaly(True)
 from torch import nn
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
@@ -18,11 +17,18 @@ from sc.clustering.model import (
 )
 from sc.clustering.dataloader import get_dataloaders
 from sc.utils.parameter import AE_CLS_DICT, OPTIM_DICT, Parameters
+from sc.utils.checkpoint import CheckpointManager
+from sc.utils.metrics_writer import MetricsWriter
+from sc.utils.optim import SharedMomentAdamW
+from sc.utils.compat import autocast, grad_scaler
 from sc.utils.functions import (
     kendall_constraint, 
     recon_loss, 
     mutual_info_loss, 
     smoothness_loss, 
+    get_gaussian_smoother,
+    style_normality,
+    style_coupling,
     discriminator_loss,
     generator_loss,
     adversarial_loss,
@@ -33,6 +39,8 @@ from sc.utils.functions import (
 class Trainer:
     
     metric_weights = [1.0, -1.0, -0.01, -1.0, -1.0]
+    metric_names = ["Style_Normality", "Recon", "Mutual_Info", "Style_Coupling", "Aux"]
+    loss_names = ["D", "G", "Aux", "Recon", "Smooth", "Mutual_Info"] # as in `losses.csv`
     gau_kernel_size = 17
 
     def __init__(
@@ -57,36 +65,104 @@ class Trainer:
 
         # update name space with config_parameters dictionary
         self.epoch_stop_smooth = 500 # default value in case it's not in fix_config, (to deprecate).
+        self.val_cache = True # keep the validation tensors on the device between epochs.
+        self.val_chunk_size = None # validate the whole set at once by default.
+        self.train_step = "sequential" # or "fused", see `fused_step`.
+        self.checkpoint_top_k = 3 # number of best checkpoints kept in `work_dir/checkpoints`, 0 for none.
+        self.async_checkpoint = True # write the checkpoints on a background thread.
+        self.resume_interval = 50 # epochs between two saves of the full training state, 0 to disable.
+        self.metric_interval = 1 # epochs between two evaluations of the style metrics.
+        self.loss_log_interval = 10 # epochs between two lines of `losses.csv` (epoch means of the losses).
+        self.tensorboard = False # also write the losses, metrics, learning rates and style histograms to `tb_logdir`.
+        self.early_stop_patience = 0 # stop after this many epochs without improvement, 0 to disable.
+        self.smooth_method = "auto" # "direct" or "fft" convolution in the smoothness loss.
+        self.kendall_chunk_size = None # tile size of the Kendall constraint, see `kendall_constraint`.
+        self.kendall_pairs = None # number of sampled pairs for the training Kendall constraint (None: exact).
+        self.amp = False # automatic mixed precision of the training steps, see `autocast`.
+        self.amp_dtype = None # "bfloat16" or "float16", None: bfloat16 on CPU and float16 on CUDA.
+        # debug options, all of them slow down the training.
+        self.detect_anomaly = False # autograd anomaly detection for every backward pass.
+        self.check_finite = False # raise as soon as a loss term is NaN or Inf.
+        self.record_grad_norm = False # log the gradient norm of each optimizer every epoch.
         self.__dict__.update(config_parameters.to_dict())
+        assert self.train_step in ["sequential", "fused"]
+        self.device_type = torch.device(self.device).type
+        if self.amp_dtype is None:
+            self.amp_dtype = "bfloat16" if self.device_type == "cpu" else "float16"
+        assert self.amp_dtype in ["bfloat16", "float16"]
+        # fp16 gradients can underflow, they are scaled by a `GradScaler` (torch >= 2.3).
+        self.grad_scaler = None
+        if self.amp and self.amp_dtype == "float16":
+            self.grad_scaler = grad_scaler(self.device_type)
+        self._val_data = None
+        self.epoch = 0
+        self.start_epoch = 0
+        self.resumed_state = None
+        self.grad_norms = defaultdict(list)
+        self.smoother = get_gaussian_smoother(
+            self.gau_kernel_size, device=self.device, method=self.smooth_method
+        )
         self.load_optimizers()
         self.load_schedulers()
 
 
     def train(self, callback=None):
+        """
+        Train for `max_epoch` epochs, or until the combined metric has not improved for
+        `early_stop_patience` epochs. `callback(epoch, metrics)` is called at the end of every
+        epoch, training stops if it returns True (e.g. a pruner, see `sc.utils.pruning`).
+
+        Returns
+        -------
+        metrics : the metrics of the last epoch, combined with `metric_weights`.
+        """
         if self.verbose:
             para_info = torch.__config__.parallel_info()
             self.logger.info(para_info)
 
         # loss functions
-        mse_loss = nn.MSELoss().to(self.device)
-        nll_loss = nn.NLLLoss().to(self.device)
-        bce_lgt_loss = nn.BCEWithLogitsLoss().to(self.device)
+        mse_loss, nll_loss, bce_lgt_loss = self.loss_functions()
 
         # train network
-        best_combined_metric = 10.0 # Initialize a guess for best combined metric.
+        best_combined_metric = np.inf # lower is better, as for early stopping and the schedulers.
+        min_style_normality, max_style_coupling = None, None
+        # best combined metric and its epoch for early stopping
+        early_stop = (np.inf, self.start_epoch)
         chkpt_dir = f"{self.work_dir}/checkpoints"
         if not os.path.exists(chkpt_dir):
             os.makedirs(chkpt_dir, exist_ok=True)
-        best_chpt_file = None
+        checkpoints = CheckpointManager(
+            chkpt_dir, 
+            {
+                "Encoder": self.encoder,
+                "Decoder": self.decoder,
+                "Style Discriminator": self.discriminator
+            },
+            top_k=self.checkpoint_top_k,
+            asynchronous=self.async_checkpoint,
+            greater_is_better=False
+        )
+        # TensorBoard event files in `work_dir/tb_logdir`, written on a background thread.
+        metrics_writer = MetricsWriter(os.path.join(self.work_dir, self.tb_logdir)) if self.tensorboard else None
         metrics = None
+        resume_file = f"{self.work_dir}/resume.pt"
         
-        # Record first line of loss values
-        self.loss_logger.info( 
-                "Epoch,Train_D,Val_D,Train_G,Val_G,Train_Aux,Val_Aux,Train_Recon,"
-                "Val_Recon,Train_Smooth,Val_Smooth,Train_Mutual_Info,Val_Mutual_Info"
-        )
+        if self.resumed_state is not None: # continue the loop from where `load_state_dict` left
+            best_combined_metric, metrics, min_style_normality, max_style_coupling = [
+                self.resumed_state[k] for k in 
+                ["best_combined_metric", "metrics", "min_style_normality", "max_style_coupling"]
+            ]
+            checkpoints.load_state_dict(self.resumed_state["checkpoints"])
+            early_stop = self.resumed_state.get("early_stop", early_stop)
+        else:
+            # Record first line of loss values
+            self.loss_logger.info( 
+                    "Epoch,Train_D,Val_D,Train_G,Val_G,Train_Aux,Val_Aux,Train_Recon,"
+                    "Val_Recon,Train_Smooth,Val_Smooth,Train_Mutual_Info,Val_Mutual_Info"
+            )
         
-        for epoch in range(self.max_epoch):
+        for epoch in range(self.start_epoch, self.max_epoch):
+            self.epoch = epoch
             # Set the networks in train mode (apply dropout when needed)
             self.encoder.train()
             self.decoder.train()
@@ -94,232 +170,570 @@ class Trainer:
 
             if self.gradient_reversal:
                 alpha_ = alpha(epoch/self.max_epoch, self.alpha_flat_step, self.alpha_limit)
+            else:
+                alpha_ = None
 
             # Loop through the labeled and unlabeled dataset getting one batch of samples from each
             # The batch size has to be a divisor of the size of the dataset or it will return
             # invalid samples
             n_batch = len(self.train_loader)
-            avg_mutual_info = 0.0
+            # the training losses are summed on the device and read once per epoch.
+            train_loss_sums = torch.zeros(len(self.loss_names), dtype=torch.float64, device=self.device)
             for spec_in, aux_in in self.train_loader:
                 spec_in = spec_in.to(self.device)
                 if self.train_loader.dataset.aux is None:
                     aux_in = None
                 else:
                     assert len(aux_in.size()) == 2
-                    n_aux = aux_in.size()[-1]
                     aux_in = aux_in.to(self.device)
                 
                 spec_in += torch.randn_like(spec_in, requires_grad=False) * self.spec_noise
-                styles = self.encoder(spec_in) # exclude the free style
-                spec_out = self.decoder(styles) # reconstructed spectra
-
-                # Use gradient reversal method or standard GAN structure
-                if self.gradient_reversal:
-                    self.zerograd()
-                    dis_loss_train = adversarial_loss(
-                        spec_in, styles, self.discriminator, alpha_,
-                        batch_size=self.batch_size, 
-                        nll_loss=bce_lgt_loss, 
-                        device=self.device
-                    )
-                    dis_loss_train.backward()
-                    self.optimizers["adversarial"].step()
-                    gen_loss_train = torch.tensor(0)
+                if self.train_step == "fused":
+                    train_step = self.fused_step
                 else:
-                    # Init gradients, discriminator loss
-                    self.zerograd()
-                    styles = self.encoder(spec_in)
-
-                    dis_loss_train = discriminator_loss(
-                        styles, self.discriminator, 
-                        batch_size=self.batch_size, 
-                        loss_fn=bce_lgt_loss,
-                        device=self.device
-                    )
-                    dis_loss_train.backward()
-                    self.optimizers["discriminator"].step()
-
-                    # Init gradients, generator loss
-                    self.zerograd()
-                    gen_loss_train = generator_loss(
-                        spec_in, self.encoder, self.discriminator, 
-                        loss_fn=nll_loss,
-                        device=self.device
+                    train_step = self.sequential_step
+                with torch.autograd.set_detect_anomaly(self.detect_anomaly), self.autocast():
+                    train_losses = train_step(
+                        spec_in, aux_in, epoch, alpha_,
+                        mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
                     )
-                    gen_loss_train.backward()
-                    self.optimizers["generator"].step()
-
-                # Kendall constraint
-                self.zerograd()
-                styles = self.encoder(spec_in)
-                aux_loss_train = kendall_constraint(
-                    aux_in, styles[:,:n_aux], 
-                    activate=self.kendall_activation,
-                    device=self.device
+                train_loss_sums += torch.stack(
+                    [train_losses[name].detach().to(self.device, torch.float64) for name in self.loss_names]
                 )
-                aux_loss_train.backward()
-                self.optimizers["correlation"].step()
-
-                # Init gradients, reconstruction loss
-                self.zerograd()
-                spec_out  = self.decoder(self.encoder(spec_in)) # retain the graph?
-                recon_loss_train = recon_loss(
-                    spec_in, spec_out, 
-                    scale=self.use_flex_spec_target,
-                    device=self.device
-                )
-                recon_loss_train.backward()
-                self.optimizers["reconstruction"].step()
-
-                # Init gradients, mutual information loss
-                self.zerograd()
-                styles = self.encoder(spec_in)
-                mutual_info_loss_train = mutual_info_loss(
-                    spec_in, styles,
-                    encoder=self.encoder, 
-                    decoder=self.decoder, 
-                    mse_loss=mse_loss, 
-                    device=self.device
-                )
-                mutual_info_loss_train.backward()
-                self.optimizers["mutual_info"].step()
-                avg_mutual_info += mutual_info_loss_train.item()
-
-                # Init gradients, smoothness loss
-                if epoch < self.epoch_stop_smooth: # turn off smooth loss after 500
-                    self.zerograd()
-                    spec_out  = self.decoder(self.encoder(spec_in)) # retain the graph?
-                    smooth_loss_train = smoothness_loss(
-                        spec_out, 
-                        gs_kernel_size=self.gau_kernel_size,
-                        device=self.device
-                    )
-                    smooth_loss_train.backward()
-                    self.optimizers["smoothness"].step()
-                else:
-                    smooth_loss_train = torch.tensor(0) 
-                
                 
                 # Init gradients
                 self.zerograd()
 
+            grad_norms = self.log_grad_norms() if self.record_grad_norm else None
+
             ### Validation ###
             self.encoder.eval()
             self.decoder.eval()
             self.discriminator.eval()
             
-            spec_in_val, aux_in_val = [torch.cat(x, dim=0) for x in zip(*list(self.val_loader))]
-            spec_in_val = spec_in_val.to(self.device)
-            z = self.encoder(spec_in_val)
-            spec_out_val = self.decoder(z)
-
-            if self.train_loader.dataset.aux is None:
-                aux_in = None
-            else:
-                assert len(aux_in_val.size()) == 2
-                n_aux = aux_in_val.size()[-1]
-                aux_in_val = aux_in_val.to(self.device)
-            
-            recon_loss_val = recon_loss(
-                spec_in_val, 
-                spec_out_val, 
-                mse_loss=mse_loss, 
-                device=self.device
-            )
-            aux_loss_val = kendall_constraint(
-                aux_in_val, 
-                z[:,:n_aux], 
-                activate=self.kendall_activation,
-                device=self.device
-            )
-            smooth_loss_val = smoothness_loss(
-                spec_out_val, 
-                gs_kernel_size=self.gau_kernel_size,
-                device=self.device
-            )
-            mutual_info_loss_val = mutual_info_loss(
-                spec_in_val, z,
-                encoder=self.encoder, 
-                decoder=self.decoder, 
-                mse_loss=mse_loss, 
-                device=self.device
+            z, val_losses = self.validate(
+                alpha_,
+                mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
             )
-            if self.gradient_reversal:
-                dis_loss_val = adversarial_loss(
-                    spec_in_val, z, self.discriminator, alpha_,
-                    batch_size=self.batch_size, 
-                    nll_loss=bce_lgt_loss, 
-                    device=self.device
-                )
-                gen_loss_val = torch.tensor(0)
-            else:
-                dis_loss_val = discriminator_loss(
-                    z, self.discriminator, 
-                    batch_size=len(z),
-                    loss_fn=bce_lgt_loss,
-                    device=self.device
-                )
-                gen_loss_val = generator_loss(
-                    spec_in_val, 
-                    self.encoder, 
-                    self.discriminator, 
-                    loss_fn=nll_loss, 
-                    device=self.device
-                )
+            train_losses = (train_loss_sums / n_batch).tolist() # epoch means
+            val_losses = torch.stack(
+                [val_losses[name].detach().to(self.device, torch.float32).reshape(()) for name in self.loss_names]
+            ).tolist()
+
             # Write losses to a file
-            if epoch % 10 == 0:
+            if epoch % self.loss_log_interval == 0:
                 self.loss_logger.info(
-                    f"{epoch:d},\t"
-                    f"{dis_loss_train.item():.6f},\t{dis_loss_val.item():.6f},\t"
-                    f"{gen_loss_train.item():.6f},\t{gen_loss_val.item():.6f},\t"
-                    f"{aux_loss_train.item():.6f},\t{aux_loss_val.item():.6f},\t"
-                    f"{recon_loss_train.item():.6f},\t{recon_loss_val.item():.6f},\t"
-                    f"{smooth_loss_train.item():.6f},\t{smooth_loss_val.item():.6f},\t"
-                    f"{mutual_info_loss_train.item():.6f},\t{mutual_info_loss_val.item():.6f},\t"
+                    f"{epoch:d},\t" + "".join(
+                        f"{loss_train:.6f},\t{loss_val:.6f},\t" for loss_train, loss_val in zip(train_losses, val_losses)
+                    )
                 )
             
-            model_dict = {"Encoder": self.encoder,
-                          "Decoder": self.decoder,
-                          "Style Discriminator": self.discriminator}
-            
-            avg_mutual_info /= n_batch
-            style_np = z.detach().clone().cpu().numpy().T
-            style_shapiro = [shapiro(x).statistic for x in style_np]
-            style_coupling = np.max(np.fabs(
-                [
-                    spearmanr(style_np[j1], style_np[j2]).correlation
-                    for j1, j2 in itertools.combinations(range(style_np.shape[0]), 2)
+            avg_mutual_info = train_losses[self.loss_names.index("Mutual_Info")]
+            # The style metrics are refreshed every `metric_interval` epochs (and at the last
+            # epoch), in between the last values are reused.
+            fresh_metrics = epoch % self.metric_interval == 0 or epoch == self.max_epoch - 1
+            if fresh_metrics:
+                min_style_normality, max_style_coupling = [
+                    x.item() for x in torch.stack([style_normality(z).min(), style_coupling(z)[1]]).cpu()
                 ]
-            ))
-            metrics = [min(style_shapiro), recon_loss_val.item(), avg_mutual_info, style_coupling,
-                       aux_loss_val.item() if aux_in is not None else 0]
+            metrics = [min_style_normality, val_losses[self.loss_names.index("Recon")], avg_mutual_info, max_style_coupling,
+                       val_losses[self.loss_names.index("Aux")] if aux_in is not None else 0]
             
             combined_metric = - (np.array(self.metric_weights) * np.array(metrics)).sum()
-            if combined_metric > best_combined_metric:
+            if metrics_writer is not None:
+                self.write_metrics(
+                    metrics_writer, epoch, train_losses, val_losses, metrics,
+                    z=z if epoch % self.loss_log_interval == 0 else None, grad_norms=grad_norms
+                )
+            if fresh_metrics and combined_metric < best_combined_metric:
                 best_combined_metric = combined_metric
-                best_chpt_file = f"{chkpt_dir}/epoch_{epoch:06d}_loss_{combined_metric:07.6g}.pt"
-                torch.save(model_dict, best_chpt_file)
+                if self.checkpoint_top_k > 0:
+                    checkpoints.save(combined_metric, epoch)
 
             for _, sch in self.schedulers.items():
                 sch.step(combined_metric)
 
-            if callback is not None:
-                callback(epoch, metrics)
+            stop_reason = None
+            if fresh_metrics and combined_metric < early_stop[0]:
+                early_stop = (combined_metric, epoch)
+            if self.early_stop_patience and epoch - early_stop[1] >= self.early_stop_patience:
+                stop_reason = f"no improvement of the combined metric since epoch {early_stop[1]}"
+            if callback is not None and callback(epoch, metrics):
+                stop_reason = "stopped by the callback"
+
+            # Save the full training state to resume from, a stopped training is not resumed.
+            if self.resume_interval and (
+                (epoch + 1) % self.resume_interval == 0 or epoch + 1 == self.max_epoch or stop_reason is not None
+            ):
+                checkpoints.save_object(
+                    self.state_dict(
+                        epoch + 1 if stop_reason is None else self.max_epoch,
+                        {
+                            "best_combined_metric": best_combined_metric,
+                            "metrics": metrics,
+                            "min_style_normality": min_style_normality,
+                            "max_style_coupling": max_style_coupling,
+                            "early_stop": early_stop,
+                            "checkpoints": checkpoints.state_dict()
+                        }
+                    ),
+                    resume_file
+                )
+            if stop_reason is not None:
+                self.logger.info(f"Training stopped at epoch {epoch}: {stop_reason}.")
+                break
             
         # save the final model
-        torch.save(model_dict, f'{self.work_dir}/final.pt')
-
-        if best_chpt_file is not None:
-            shutil.copy2(best_chpt_file, f'{self.work_dir}/best.pt')
+        checkpoints.save_final(f'{self.work_dir}/final.pt')
+        checkpoints.save_best(f'{self.work_dir}/best.pt')
+        checkpoints.close()
+        if metrics_writer is not None:
+            metrics_writer.close()
 
         return metrics
 
 
+    def sequential_step(self, spec_in, aux_in, epoch, alpha_, mse_loss=None, nll_loss=None, bce_lgt_loss=None):
+        """
+        Train on one batch with the multi-optimizer schedule: each loss term has its own
+        forward pass, backward pass and optimizer step.
+
+        Returns
+        -------
+        losses : dictionary of training losses, keyed by the names used in `losses.csv`.
+        """
+        styles = self.encoder(spec_in) # exclude the free style
+        spec_out = self.decoder(styles) # reconstructed spectra
+
+        # Use gradient reversal method or standard GAN structure
+        if self.gradient_reversal:
+            self.zerograd()
+            dis_loss_train = adversarial_loss(
+                spec_in, styles, self.discriminator, alpha_,
+                batch_size=self.batch_size, 
+                nll_loss=bce_lgt_loss, 
+                device=self.device
+            )
+            self.optimizer_step("adversarial", dis_loss_train)
+            gen_loss_train = torch.tensor(0)
+        else:
+            # Init gradients, discriminator loss
+            self.zerograd()
+            styles = self.encoder(spec_in)
+
+            dis_loss_train = discriminator_loss(
+                styles, self.discriminator, 
+                batch_size=self.batch_size, 
+                loss_fn=bce_lgt_loss,
+                device=self.device
+            )
+            self.optimizer_step("discriminator", dis_loss_train)
+
+            # Init gradients, generator loss
+            self.zerograd()
+            gen_loss_train = generator_loss(
+                spec_in, self.encoder, self.discriminator, 
+                loss_fn=nll_loss,
+                device=self.device
+            )
+            self.optimizer_step("generator", gen_loss_train)
+
+        # Kendall constraint
+        self.zerograd()
+        styles = self.encoder(spec_in)
+        aux_loss_train = self.aux_loss(aux_in, styles[:,:aux_in.size()[-1]], n_pairs=self.kendall_pairs)
+        self.optimizer_step("correlation", aux_loss_train)
+
+        # Init gradients, reconstruction loss
+        self.zerograd()
+        spec_out  = self.decoder(self.encoder(spec_in)) # retain the graph?
+        recon_loss_train = recon_loss(
+            spec_in, spec_out, 
+            scale=self.use_flex_spec_target,
+            mse_loss=mse_loss,
+            device=self.device
+        )
+        self.optimizer_step("reconstruction", recon_loss_train)
+
+        # Init gradients, mutual information loss
+        self.zerograd()
+        styles = self.encoder(spec_in)
+        mutual_info_loss_train = mutual_info_loss(
+            spec_in, styles,
+            encoder=self.encoder, 
+            decoder=self.decoder, 
+            mse_loss=mse_loss, 
+            device=self.device
+        )
+        self.optimizer_step("mutual_info", mutual_info_loss_train)
+
+        # Init gradients, smoothness loss
+        if epoch < self.epoch_stop_smooth: # turn off smooth loss after 500
+            self.zerograd()
+            spec_out  = self.decoder(self.encoder(spec_in)) # retain the graph?
+            smooth_loss_train = smoothness_loss(
+                spec_out, 
+                gs_kernel_size=self.gau_kernel_size,
+                mse_loss=mse_loss,
+                device=self.device,
+                smoother=self.smoother
+            )
+            self.optimizer_step("smoothness", smooth_loss_train)
+        else:
+            smooth_loss_train = torch.tensor(0)
+
+        return {
+            "D": dis_loss_train,
+            "G": gen_loss_train,
+            "Aux": aux_loss_train,
+            "Recon": recon_loss_train,
+            "Smooth": smooth_loss_train,
+            "Mutual_Info": mutual_info_loss_train
+        }
+
+
+    def fused_step(self, spec_in, aux_in, epoch, alpha_, mse_loss=None, nll_loss=None, bce_lgt_loss=None):
+        """
+        Train on one batch with a single encoder/decoder forward pass shared by all the loss terms
+        and one backward pass of their weighted sum (see `fused_loss_weights`), stepped by the
+        "fused" optimizer. Unlike the sequential schedule, the smoothness term also reaches the
+        encoder and the Kendall/generator terms also reach the decoder through the shared graph.
+        Without gradient reversal, the discriminator is still trained in its own step.
+
+        Returns
+        -------
+        losses : dictionary of training losses, keyed by the names used in `losses.csv`.
+        """
+        self.zerograd()
+        styles = self.encoder(spec_in)
+        spec_out = self.decoder(styles)
+
+        losses = {}
+        if self.gradient_reversal:
+            losses["D"] = adversarial_loss(
+                spec_in, styles, self.discriminator, alpha_,
+                batch_size=self.batch_size, 
+                nll_loss=bce_lgt_loss, 
+                device=self.device
+            )
+            losses["G"] = torch.tensor(0)
+        else:
+            losses["D"] = discriminator_loss(
+                styles.detach(), self.discriminator, 
+                batch_size=self.batch_size, 
+                loss_fn=bce_lgt_loss,
+                device=self.device
+            )
+            self.optimizer_step("discriminator", losses["D"])
+            self.zerograd()
+            losses["G"] = generator_loss(
+                spec_in, self.encoder, self.discriminator, 
+                loss_fn=nll_loss,
+                device=self.device,
+                styles=styles
+            )
+        losses["Aux"] = self.aux_loss(aux_in, styles[:,:aux_in.size()[-1]], n_pairs=self.kendall_pairs)
+        losses["Recon"] = recon_loss(
+            spec_in, spec_out, 
+            scale=self.use_flex_spec_target,
+            mse_loss=mse_loss,
+            device=self.device
+        )
+        losses["Mutual_Info"] = mutual_info_loss(
+            spec_in, styles,
+            encoder=self.encoder, 
+            decoder=self.decoder, 
+            mse_loss=mse_loss, 
+            device=self.device
+        )
+        if epoch < self.epoch_stop_smooth:
+            losses["Smooth"] = smoothness_loss(
+                spec_out, 
+                gs_kernel_size=self.gau_kernel_size,
+                mse_loss=mse_loss,
+                device=self.device,
+                smoother=self.smoother
+            )
+        else:
+            losses["Smooth"] = torch.tensor(0)
+
+        if self.check_finite:
+            for name, loss in losses.items():
+                self.assert_finite(name, loss)
+        weights = self.fused_loss_weights()
+        total_loss = sum(
+            weights[name] * loss for name, loss in losses.items()
+            if name != "D" or self.gradient_reversal # the discriminator step is done above.
+        )
+        self.optimizer_step("fused", total_loss)
+
+        return losses
+
+
+    def optimizer_step(self, name, loss):
+        """
+        Backpropagate `loss` and step the optimizer `name`, with the optional debug checks:
+        `check_finite` raises on NaN/Inf losses and `record_grad_norm` keeps the norm of the
+        gradients of the optimizer's parameters (logged as an epoch average).
+        """
+        if self.check_finite:
+            self.assert_finite(name, loss)
+        with autocast(self.device_type, enabled=False):
+            if self.grad_scaler is not None:
+                loss = self.grad_scaler.scale(loss)
+            loss.backward()
+        if self.record_grad_norm:
+            if self.grad_scaler is not None:
+                self.grad_scaler.unscale_(self.optimizers[name])
+            grads = [
+                p.grad.detach().norm() for group in self.optimizers[name].param_groups
+                for p in group['params'] if p.grad is not None
+            ]
+            if len(grads) > 0:
+                self.grad_norms[name].append(torch.stack(grads).norm())
+        if self.grad_scaler is not None:
+            self.grad_scaler.step(self.optimizers[name])
+            self.grad_scaler.update()
+        else:
+            self.optimizers[name].step()
+
+
+    def autocast(self):
+        """
+        The autocast context of the training steps: mixed precision (`amp_dtype`) if `amp` is
+        set. The style BatchNorm, the Kendall constraint and the discriminator losses stay in
+        fp32, and so does `validate`, so the metrics are those of full precision.
+        """
+        return autocast(self.device_type, dtype=getattr(torch, self.amp_dtype), enabled=self.amp)
+
+
+    def loss_functions(self):
+        """
+        The MSE, NLL and BCE-with-logits loss modules used by the training steps and `validate`.
+        """
+        return (
+            nn.MSELoss().to(self.device),
+            nn.NLLLoss().to(self.device),
+            nn.BCEWithLogitsLoss().to(self.device)
+        )
+
+
+    def aux_loss(self, aux_in, styles, n_pairs=None):
+        """
+        The Kendall constraint between the descriptors `aux_in` and the corresponding `styles`.
+        """
+        return kendall_constraint(
+            aux_in, styles, 
+            activate=self.kendall_activation,
+            device=self.device,
+            chunk_size=self.kendall_chunk_size,
+            n_pairs=n_pairs
+        )
+
+
+    def assert_finite(self, name, loss):
+        if not torch.isfinite(loss).all():
+            raise RuntimeError(f"Non-finite {name} loss ({loss.tolist()}) at epoch {self.epoch}.")
+
+
+    def log_grad_norms(self):
+        """
+        Log the average gradient norm of each optimizer in the epoch and reset the records.
+
+        Returns
+        -------
+        grad_norms : `{name: average gradient norm}` of the optimizers stepped in the epoch.
+        """
+        grad_norms = {name: torch.stack(norms).mean().item() for name, norms in self.grad_norms.items()}
+        self.logger.info(
+            "Gradient norms: " + ", ".join(f"{name}={norm:.4g}" for name, norm in grad_norms.items())
+        )
+        self.grad_norms = defaultdict(list)
+        return grad_norms
+
+
+    def fused_loss_weights(self):
+        """
+        Weights of the loss terms in the fused step. They are the learning rate ratios of the
+        terms in the sequential schedule relative to the reconstruction one, whose learning rate
+        the "fused" optimizer uses for the encoder and decoder.
+        """
+        return {
+            "D": self.lr_ratio_dis / self.lr_ratio_Reconn,
+            "G": self.lr_ratio_gen / self.lr_ratio_Reconn,
+            "Aux": self.lr_ratio_Corr / self.lr_ratio_Reconn,
+            "Recon": 1.0,
+            "Smooth": self.lr_ratio_Smooth / self.lr_ratio_Reconn,
+            "Mutual_Info": self.lr_ratio_Mutual / self.lr_ratio_Reconn
+        }
+
+
+    def load_validation_data(self):
+        """
+        Concatenate the validation set into `(spec, aux)` tensors on the device.
+        The validation set never changes, so with `val_cache` (default) this is only done once.
+        """
+        if self.val_cache and self._val_data is not None:
+            return self._val_data
+        spec_in_val, aux_in_val = [torch.cat(x, dim=0).to(self.device) for x in zip(*list(self.val_loader))]
+        assert len(aux_in_val.size()) == 2
+        if self.val_cache:
+            self._val_data = (spec_in_val, aux_in_val)
+        return spec_in_val, aux_in_val
+
+
+    def validate(self, alpha_=None, mse_loss=None, nll_loss=None, bce_lgt_loss=None):
+        """
+        Evaluate the losses on the validation set without building autograd graphs.
+        The encoder/decoder passes run in chunks of `val_chunk_size` spectra (the whole set
+        if None) to bound the memory, the per-chunk losses are averaged weighted by the chunk
+        sizes. The Kendall constraint is computed on the styles of the whole validation set.
+
+        Returns
+        -------
+        z : the styles of the validation set.
+        losses : dictionary of validation losses, keyed by the names used in `losses.csv`.
+        """
+        spec_in_val, aux_in_val = self.load_validation_data()
+        n_val = spec_in_val.size()[0]
+        chunk_size = self.val_chunk_size if self.val_chunk_size else n_val
+        losses = {
+            name: torch.zeros((), device=self.device) for name in ["D", "G", "Recon", "Smooth", "Mutual_Info"]
+        }
+        z_list = []
+        with torch.no_grad():
+            for i in range(0, n_val, chunk_size):
+                spec_in = spec_in_val[i:i+chunk_size]
+                weight = spec_in.size()[0] / n_val
+                z = self.encoder(spec_in)
+                spec_out = self.decoder(z)
+                z_list.append(z)
+                losses["Recon"] = losses["Recon"] + weight * recon_loss(
+                    spec_in, 
+                    spec_out, 
+                    mse_loss=mse_loss, 
+                    device=self.device
+                )
+                losses["Smooth"] = losses["Smooth"] + weight * smoothness_loss(
+                    spec_out, 
+                    gs_kernel_size=self.gau_kernel_size,
+                    mse_loss=mse_loss,
+                    device=self.device,
+                    smoother=self.smoother
+                )
+                losses["Mutual_Info"] = losses["Mutual_Info"] + weight * mutual_info_loss(
+                    spec_in, z,
+                    encoder=self.encoder, 
+                    decoder=self.decoder, 
+                    mse_loss=mse_loss, 
+                    device=self.device
+                )
+                if self.gradient_reversal:
+                    losses["D"] = losses["D"] + weight * adversarial_loss(
+                        spec_in, z, self.discriminator, alpha_,
+                        batch_size=self.batch_size, 
+                        nll_loss=bce_lgt_loss, 
+                        device=self.device
+                    )
+                else:
+                    losses["D"] = losses["D"] + weight * discriminator_loss(
+                        z, self.discriminator, 
+                        batch_size=len(z),
+                        loss_fn=bce_lgt_loss,
+                        device=self.device
+                    )
+                    losses["G"] = losses["G"] + weight * generator_loss(
+                        spec_in, 
+                        self.encoder, 
+                        self.discriminator, 
+                        loss_fn=nll_loss, 
+                        device=self.device
+                    )
+            z = torch.cat(z_list, dim=0)
+            n_aux = aux_in_val.size()[-1]
+            losses["Aux"] = self.aux_loss(aux_in_val, z[:,:n_aux])
+        return z, losses
+
+
+    def state_dict(self, epoch, loop_state=None):
+        """
+        The full training state at the beginning of `epoch`: models, optimizers, schedulers,
+        random number generators and the variables of the training loop (`loop_state`).
+        """
+        state = {
+            "epoch": epoch,
+            "Encoder": self.encoder.state_dict(),
+            "Decoder": self.decoder.state_dict(),
+            "Style Discriminator": self.discriminator.state_dict(),
+            "optimizers": {name: opt.state_dict() for name, opt in self.optimizers.items()},
+            "schedulers": {name: sch.state_dict() for name, sch in self.schedulers.items()},
+            "grad_scaler": self.grad_scaler.state_dict() if self.grad_scaler is not None else None,
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                "numpy": np.random.get_state(),
+                "random": random.getstate()
+            },
+            "loop": loop_state
+        }
+        return state
+
+
+    def load_state_dict(self, state):
+        """
+        Restore a state saved by `state_dict`, `train` then continues from `state["epoch"]`.
+        """
+        self.encoder.load_state_dict(state["Encoder"])
+        self.decoder.load_state_dict(state["Decoder"])
+        self.discriminator.load_state_dict(state["Style Discriminator"])
+        for name, opt_state in state["optimizers"].items():
+            self.optimizers[name].load_state_dict(opt_state)
+        for name, sch_state in state["schedulers"].items():
+            self.schedulers[name].load_state_dict(sch_state)
+        if self.grad_scaler is not None and state.get("grad_scaler") is not None:
+            self.grad_scaler.load_state_dict(state["grad_scaler"])
+        if self.val_cache:
+            # iterating a DataLoader draws from the RNG, cache the validation set before restoring it.
+            self.load_validation_data()
+        torch.set_rng_state(state["rng"]["torch"])
+        if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+        np.random.set_state(state["rng"]["numpy"])
+        random.setstate(state["rng"]["random"])
+        self.start_epoch = state["epoch"]
+        self.resumed_state = state["loop"]
+
+
     def zerograd(self):
         self.encoder.zero_grad()
         self.decoder.zero_grad()
         self.discriminator.zero_grad()
 
+    def write_metrics(
+        self, metrics_writer, epoch, train_losses, val_losses, metrics, z=None, learning_rates=None, grad_norms=None
+    ):
+        """
+        Queue the epoch means of the training losses, the validation losses, the metrics, the
+        learning rates of the optimizers (`{name: lr}`, by default read from the optimizers), the
+        average gradient norms of `log_grad_norms` if given and, if `z` is given, the histograms
+        of the styles (see `get_style_distribution_plot`) to a `MetricsWriter`.
+        """
+        if learning_rates is None:
+            learning_rates = {name: opt.param_groups[0]["lr"] for name, opt in self.optimizers.items()}
+        scalars = {}
+        for name, loss_train, loss_val in zip(self.loss_names, train_losses, val_losses):
+            scalars[f"Train/{name}"], scalars[f"Val/{name}"] = loss_train, loss_val
+        scalars.update({f"Metrics/{name}": metric for name, metric in zip(self.metric_names, metrics)})
+        scalars["Metrics/Combined"] = - (np.array(self.metric_weights) * np.array(metrics)).sum()
+        scalars.update({f"LR/{name}": lr for name, lr in learning_rates.items()})
+        if grad_norms is not None:
+            scalars.update({f"GradNorm/{name}": norm for name, norm in grad_norms.items()})
+        metrics_writer.add_scalars(scalars, epoch)
+        if z is not None:
+            z = z.detach().float().cpu()
+            metrics_writer.add_histograms({f"Styles/Style_{i+1}": z[:, i] for i in range(z.size(1))}, epoch)
+
+
     def get_style_distribution_plot(self, z):
         # noinspection PyTypeChecker
         fig, ax_list = plt.subplots(
@@ -332,6 +746,8 @@ class Trainer:
 
     def load_optimizers(self):
         opt_cls = OPTIM_DICT[self.optimizer_name]
+        if opt_cls is SharedMomentAdamW: # the moments are shared by the optimizers of this trainer only.
+            opt_cls = functools.partial(SharedMomentAdamW, shared_state={})
         recon_optimizer = opt_cls(
             [
                 {'params': self.encoder.parameters()}, 
@@ -396,49 +812,68 @@ class Trainer:
             "adversarial": adv_optimizer
         }
 
+        if self.train_step == "fused":
+            fused_groups = [
+                {'params': self.encoder.parameters()}, 
+                {'params': self.decoder.parameters()}
+            ]
+            if self.gradient_reversal: # otherwise the discriminator has its own step.
+                fused_groups.append(
+                    {
+                        'params': self.discriminator.parameters(),
+                        'lr': self.lr_ratio_dis * self.lr_base,
+                        'betas': (self.dis_beta * 0.9, self.dis_beta * 0.009 + 0.99)
+                    }
+                )
+            self.optimizers["fused"] = opt_cls(
+                fused_groups,
+                lr = self.lr_ratio_Reconn * self.lr_base,
+                weight_decay = self.weight_decay
+            )
+
 
     def load_schedulers(self):
         
         self.schedulers = {name:
             ReduceLROnPlateau(
                 optimizer, mode="min", factor=self.sch_factor, patience=self.sch_patience, 
-                cooldown=0, threshold=0.01,verbose=self.verbose
+                cooldown=0, threshold=0.01
             ) 
             for name, optimizer in self.optimizers.items()
         }
 
 
-    @classmethod
-    def from_data(
-        cls, csv_fn, 
-        igpu=0, verbose=True, work_dir='.', 
-        train_ratio=0.7, validation_ratio=0.15, test_ratio=0.15, 
-        config_parameters = Parameters({}),
-        logger = logging.getLogger("from_data"),
-        loss_logger = logging.getLogger("losses")
-    ):
+    @staticmethod
+    def get_device(igpu=0, verbose=True, logger=logging.getLogger("from_data")):
+        # Use GPU if possible
+        if torch.cuda.is_available():
+            if verbose:
+                logger.info("Use GPU")
+            return torch.device(f"cuda:{igpu}")
+        if verbose:
+            logger.warn("Use Slow CPU!")
+        return torch.device("cpu")
 
-        p = config_parameters
-        assert p.ae_form in AE_CLS_DICT
 
+    @staticmethod
+    def get_loaders(csv_fn, p, device, split_ratio=(0.7, 0.15, 0.15)):
         # load training and validation dataset
         dl_train, dl_val, _ = get_dataloaders(
-            csv_fn, p.batch_size, (train_ratio, validation_ratio, test_ratio), n_aux=p.n_aux)
-
+            csv_fn, p.batch_size, split_ratio, n_aux=p.n_aux,
+            cache=p.get("data_cache", False),
+            device_resident=p.get("device_resident_loader", False),
+            device=device
+        )
+        for loader in [dl_train, dl_val]:
+            loader.pin_memory = False
+        return dl_train, dl_val
 
-        # Use GPU if possible
-        if torch.cuda.is_available():
-            if verbose:
-                logger.info("Use GPU")
-            device = torch.device(f"cuda:{igpu}")
-            for loader in [dl_train, dl_val]:
-                loader.pin_memory = False
-        else:
-            if verbose:
-                logger.warn("Use Slow CPU!")
-            device = torch.device("cpu")
 
-        # Load encoder, decoder and discriminator
+    @staticmethod
+    def build_models(p, device):
+        """
+        Build a new (randomly initialized) encoder, decoder and discriminator from the config `p`.
+        """
         encoder = AE_CLS_DICT[p.ae_form]["encoder"](
             nstyle = p.nstyle, 
             dropout_rate = p.dropout_rate, 
@@ -464,6 +899,27 @@ class Trainer:
 
         for net in [encoder, decoder, discriminator]:
             net.to(device)
+        return encoder, decoder, discriminator
+
+
+    @classmethod
+    def from_data(
+        cls, csv_fn, 
+        igpu=0, verbose=True, work_dir='.', 
+        train_ratio=0.7, validation_ratio=0.15, test_ratio=0.15, 
+        config_parameters = Parameters({}),
+        logger = logging.getLogger("from_data"),
+        loss_logger = logging.getLogger("losses")
+    ):
+
+        p = config_parameters
+        assert p.ae_form in AE_CLS_DICT
+
+        device = cls.get_device(igpu, verbose=verbose, logger=logger)
+        dl_train, dl_val = cls.get_loaders(csv_fn, p, device, (train_ratio, validation_ratio, test_ratio))
+
+        # Load encoder, decoder and discriminator
+        encoder, decoder, discriminator = cls.build_models(p, device)
 
         # Load trainer
         trainer = Trainer(
@@ -472,6 +928,3 @@ class Trainer:
             config_parameters=p, logger=logger, loss_logger=loss_logger
         )
         return trainer
-
-
- 
\ No newline at end of file
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import torch
+from sc.clustering.trainer import Trainer
+from sc.utils.parameter import Parameters
+from sc.utils.affinity import available_cpus
+
+
+def make_synthetic_data(csv_fn, n_spectra, n_aux=5, n_grid=256, seed=0):
+    """
+    Write a csv file of `n_spectra` synthetic spectra in the format of the training data: two
+    index columns, `n_aux` descriptors (AUX_*) and the spectra on a grid of `n_grid` points
+    (ENE_*). Each spectrum is a sum of three Gaussian peaks, the descriptors are functions of
+    the peaks (AUX_1 is a coordination number between 4 and 6).
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.linspace(0, 1, n_grid)
+    centers = rng.uniform(0.2, 0.8, (n_spectra, 3))
+    widths = rng.uniform(0.02, 0.1, (n_spectra, 3))
+    heights = rng.uniform(0.5, 1.5, (n_spectra, 3))
+    spec = (heights[:, :, None] * np.exp(- (grid - centers[:, :, None])**2 / (2 * widths[:, :, None]**2))).sum(axis=1)
+    spec = (spec / spec.mean(axis=1, keepdims=True)).astype(np.float32)
+    descriptors = [centers[:, 0], np.digitize(heights[:, 0], [5/6, 7/6]) + 4.0, widths[:, 0], heights[:, 1], centers[:, 1]]
+    aux = np.stack([descriptors[i % len(descriptors)] for i in range(n_aux)], axis=1) if n_aux > 0 else np.zeros((n_spectra, 0))
+    columns = [f"AUX_{i}" for i in range(n_aux)] + [f"ENE_{e:.4f}" for e in grid * 30]
+    index = pd.MultiIndex.from_arrays([[f"syn-{i}" for i in range(n_spectra)], rng.integers(0, 4, n_spectra)])
+    pd.DataFrame(np.concatenate([aux, spec], axis=1), index=index, columns=columns).to_csv(csv_fn)
+
+
+class PhaseTimer():
+    """
+    Time the phases of the epochs of a `Trainer`: each loss term of the training steps (from the
+    end of the previous term: its forward pass, backward pass and optimizer step), the
+    validation, and the rest of the epoch (data loading, metrics, checkpoints) as "other".
+    """
+
+    def __init__(self, trainer):
+        self.trainer = trainer
+        self.sync = torch.cuda.synchronize if trainer.device_type == "cuda" else lambda: None
+        self.phase_times = defaultdict(lambda: defaultdict(float)) # epoch -> phase -> seconds
+        self.epoch_times = {}
+        self._mark = None
+        self._epoch_start = None
+        for name in ["sequential_step", "fused_step"]:
+            setattr(trainer, name, self._time_step(getattr(trainer, name)))
+        trainer.optimizer_step = self._time_optimizer_step(trainer.optimizer_step)
+        trainer.validate = self._time_phase("validation", trainer.validate)
+
+    def _time_step(self, step):
+        def timed_step(*args, **kwargs):
+            if self._epoch_start is None:
+                self._epoch_start = time.time()
+            self.sync()
+            self._mark = time.time()
+            return step(*args, **kwargs)
+        return timed_step
+
+    def _time_optimizer_step(self, optimizer_step):
+        def timed_optimizer_step(name, loss):
+            optimizer_step(name, loss)
+            self.sync()
+            now = time.time()
+            self.phase_times[self.trainer.epoch][name] += now - self._mark
+            self._mark = now
+        return timed_optimizer_step
+
+    def _time_phase(self, name, fn):
+        def timed_fn(*args, **kwargs):
+            self.sync()
+            start = time.time()
+            result = fn(*args, **kwargs)
+            self.sync()
+            self.phase_times[self.trainer.epoch][name] += time.time() - start
+            return result
+        return timed_fn
+
+    def __call__(self, epoch, metrics):
+        """
+        The `callback` of `Trainer.train`, called at the end of each epoch.
+        """
+        self.sync()
+        now = time.time()
+        self.epoch_times[epoch] = now - self._epoch_start
+        self.phase_times[epoch]["other"] = self.epoch_times[epoch] - sum(self.phase_times[epoch].values())
+        self._epoch_start = now
+        return False
+
+
+def peak_memory_mb(device_type):
+    if device_type == "cuda":
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 # kB on Linux
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the training throughput on synthetic data and report it as JSON."
+    )
+    parser.add_argument('-c', '--config', type=str, default=os.path.join(os.path.dirname(__file__), "fix_config.yaml"),
+                        help="Training config in YAML format, default is the fix_config.yaml of the package")
+    parser.add_argument('-w', "--work_dir", type=str, default=None,
+                        help="Working directory of the data and the training files, default is a temporary directory")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="JSON file of the results, they are printed in any case")
+    parser.add_argument('--ae_form', type=str, default=None, choices=["normal", "compact", "qved", "FC"],
+                        help="Model form, default is that of the config")
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help="Batch size, default is that of the config")
+    parser.add_argument('--n_layers', type=int, default=None,
+                        help="Number of layers of the FC models, default is that of the config")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Torch threads, default is the number of available CPUs")
+    parser.add_argument('--n_spectra', type=int, default=10000,
+                        help="Number of synthetic spectra (70%% for training, 15%% for validation)")
+    parser.add_argument('--epochs', type=int, default=3,
+                        help="Number of timed epochs")
+    parser.add_argument('--warmup', type=int, default=1,
+                        help="Number of epochs run before the timed epochs")
+    parser.add_argument('--igpu', type=int, default=0,
+                        help="GPU to run on if CUDA is available")
+    args = parser.parse_args()
+
+    p = Parameters.from_yaml(args.config)
+    for key in ["ae_form", "batch_size", "n_layers"]:
+        if getattr(args, key) is not None:
+            p.update({key: getattr(args, key)})
+    if p.ae_form == "normal":
+        p.update({"dim_in": 256, "dim_out": 256})
+    elif p.ae_form == "qved":
+        p.update({"dim_in": 12, "dim_out": 12})
+    p.update({
+        "max_epoch": args.warmup + args.epochs, "verbose": False, "tensorboard": False,
+        "early_stop_patience": 0, "resume_interval": 0
+    })
+    n_threads = args.threads or len(available_cpus())
+    torch.set_num_threads(n_threads)
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="sc_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        csv_fn = os.path.join(work_dir, "synthetic.csv")
+        make_synthetic_data(csv_fn, args.n_spectra, n_aux=p.n_aux, n_grid=p.dim_in)
+        torch.manual_seed(0)
+        trainer = Trainer.from_data(csv_fn, igpu=args.igpu, verbose=False, work_dir=work_dir, config_parameters=p)
+        timer = PhaseTimer(trainer)
+        if trainer.device_type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        trainer.train(callback=timer)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    timed_epochs = list(range(args.warmup, args.warmup + args.epochs))
+    n_train = len(trainer.train_loader.dataset)
+    epoch_time = np.mean([timer.epoch_times[epoch] for epoch in timed_epochs])
+    phases = sorted(set(name for epoch in timed_epochs for name in timer.phase_times[epoch]))
+    result = {
+        "ae_form": p.ae_form,
+        "batch_size": p.batch_size,
+        "n_layers": p.n_layers,
+        "train_step": trainer.train_step,
+        "amp": trainer.amp,
+        "device": str(trainer.device),
+        "threads": n_threads,
+        "n_train": n_train,
+        "epochs": args.epochs,
+        "samples_per_sec": n_train / epoch_time,
+        "epoch_time": epoch_time,
+        "phase_time": { # seconds per epoch
+            name: np.mean([timer.phase_times[epoch][name] for epoch in timed_epochs]) for name in phases
+        },
+        "peak_memory_mb": peak_memory_mb(trainer.device_type),
+        "torch": torch.__version__
+    }
+    print(json.dumps(result, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
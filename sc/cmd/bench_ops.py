@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+
+import torch
+from torch import nn
+from sc.clustering.model import EncodingBlock, DecodingBlock, FCEncoder, FCDecoder, DiscriminatorFC, DiscriminatorCNN
+from sc.utils.functions import (
+    kendall_constraint,
+    recon_loss,
+    smoothness_loss,
+    mutual_info_loss,
+    adversarial_loss,
+    discriminator_loss,
+    get_gaussian_smoother
+)
+from sc.utils.affinity import available_cpus
+
+
+DIM_SPEC = 256 # length of the spectra
+
+
+def _backward(loss, *modules):
+    for module in modules:
+        for p in module.parameters():
+            p.grad = None
+    loss.backward()
+
+
+def kendall_case(batch_size, n_aux):
+    descriptors = torch.randn(batch_size, n_aux)
+    styles = (descriptors + torch.randn(batch_size, n_aux)).requires_grad_(True)
+    return lambda: kendall_constraint(descriptors, styles).backward()
+
+
+def recon_case(batch_size):
+    spec_in = torch.rand(batch_size, DIM_SPEC)
+    spec_out = torch.rand(batch_size, DIM_SPEC, requires_grad=True)
+    mse_loss = nn.MSELoss()
+    return lambda: recon_loss(spec_in, spec_out, mse_loss=mse_loss).backward()
+
+
+def smoothness_case(batch_size, gs_kernel_size=17):
+    spec_out = torch.rand(batch_size, DIM_SPEC, requires_grad=True)
+    smoother = get_gaussian_smoother(gs_kernel_size)
+    mse_loss = nn.MSELoss()
+    return lambda: smoothness_loss(spec_out, gs_kernel_size, mse_loss=mse_loss, smoother=smoother).backward()
+
+
+def mutual_info_case(batch_size, nstyle):
+    encoder, decoder = FCEncoder(nstyle=nstyle, n_layers=5), FCDecoder(nstyle=nstyle, n_layers=5)
+    spec_in, styles = torch.rand(batch_size, DIM_SPEC), torch.randn(batch_size, nstyle)
+    mse_loss = nn.MSELoss()
+    return lambda: _backward(mutual_info_loss(spec_in, styles, encoder, decoder, mse_loss=mse_loss), encoder, decoder)
+
+
+def adversarial_case(batch_size, nstyle):
+    discriminator = DiscriminatorFC(nstyle=nstyle)
+    spec_in = torch.rand(batch_size, DIM_SPEC)
+    styles = torch.randn(batch_size, nstyle, requires_grad=True)
+    bce_lgt_loss = nn.BCEWithLogitsLoss()
+    return lambda: _backward(
+        adversarial_loss(spec_in, styles, discriminator, 0.5, batch_size=batch_size, nll_loss=bce_lgt_loss),
+        discriminator
+    )
+
+
+def discriminator_case(batch_size, nstyle):
+    discriminator = DiscriminatorCNN(nstyle=nstyle) # two logits, as expected by the cross entropy
+    styles = torch.randn(batch_size, nstyle, requires_grad=True)
+    return lambda: _backward(discriminator_loss(styles, discriminator, batch_size=batch_size), discriminator)
+
+
+def module_case(module, x, *args):
+    x.requires_grad_(True)
+    return lambda: _backward(module(x, *args).square().mean(), module)
+
+
+# name -> (function building the forward+backward closure, the grid parameters it takes)
+CASES = {
+    "kendall_constraint": (kendall_case, ["batch_size", "n_aux"]),
+    "recon_loss": (recon_case, ["batch_size"]),
+    "smoothness_loss": (smoothness_case, ["batch_size"]),
+    "mutual_info_loss": (mutual_info_case, ["batch_size", "nstyle"]),
+    "adversarial_loss": (adversarial_case, ["batch_size", "nstyle"]),
+    "discriminator_loss": (discriminator_case, ["batch_size", "nstyle"]),
+    "EncodingBlock": ( # the first block of `CompactEncoder`
+        lambda batch_size: module_case(
+            EncodingBlock(in_channels=1, out_channels=4, in_len=DIM_SPEC, out_len=64, kernel_size=11, stride=2),
+            torch.rand(batch_size, 1, DIM_SPEC)
+        ),
+        ["batch_size"]
+    ),
+    "DecodingBlock": ( # the last block of `CompactDecoder`
+        lambda batch_size: module_case(
+            DecodingBlock(in_channels=4, out_channels=4, in_len=64, excitation=4), torch.rand(batch_size, 4, 64)
+        ),
+        ["batch_size"]
+    ),
+    "FCEncoder": (
+        lambda batch_size, nstyle: module_case(FCEncoder(nstyle=nstyle, n_layers=5), torch.rand(batch_size, DIM_SPEC)),
+        ["batch_size", "nstyle"]
+    ),
+    "DiscriminatorFC": (
+        lambda batch_size, nstyle: module_case(DiscriminatorFC(nstyle=nstyle), torch.randn(batch_size, nstyle), None),
+        ["batch_size", "nstyle"]
+    ),
+}
+
+
+def run_benchmarks(grid, cases=None, min_run_time=0.5, num_threads=1):
+    """
+    Time the forward and backward passes of each case of `CASES` (all by default) for every
+    combination of the grid parameters it takes.
+
+    Parameters
+    ----------
+    grid : dict
+        Values of the grid parameters, e.g. `{"batch_size": [128, 512], "nstyle": [5], "n_aux": [5]}`.
+    min_run_time : float
+        Minimum measured time (seconds) of each benchmark, see `torch.utils.benchmark.Timer`.
+
+    Returns
+    -------
+    results : `{key: {"case", "params", "median", "iqr"}}`, times in seconds per call, keyed by
+    e.g. `"kendall_constraint[batch_size=512,n_aux=5]"`.
+    """
+    from torch.utils.benchmark import Timer # torch >= 1.10
+
+    results = {}
+    for name in (cases if cases is not None else CASES):
+        build, param_names = CASES[name]
+        for values in itertools.product(*[grid[p] for p in param_names]):
+            params = dict(zip(param_names, values))
+            torch.manual_seed(0)
+            fn = build(**params)
+            fn() # warm up
+            measurement = Timer(stmt="fn()", globals={"fn": fn}, num_threads=num_threads).blocked_autorange(
+                min_run_time=min_run_time
+            )
+            key = f"{name}[{','.join(f'{k}={v}' for k, v in params.items())}]"
+            results[key] = {"case": name, "params": params, "median": measurement.median, "iqr": measurement.iqr}
+    return results
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    Compare the median times of the benchmarks in both `baseline` and `current` (the
+    `results` of `run_benchmarks`).
+
+    Returns
+    -------
+    A list of `(key, baseline time, current time, ratio, regressed)` sorted by decreasing
+    ratio, `regressed` if the current time is more than `1 + threshold` times the baseline.
+    """
+    rows = []
+    for key in baseline:
+        if key in current:
+            ratio = current[key]["median"] / baseline[key]["median"]
+            rows.append((key, baseline[key]["median"], current[key]["median"], ratio, ratio > 1 + threshold))
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the forward and backward passes of the loss functions and model blocks."
+    )
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Save the results as a JSON baseline")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="JSON baseline to compare with, the exit status is 1 if any benchmark regressed")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Relative slowdown over the baseline reported as a regression")
+    parser.add_argument('--cases', type=str, nargs='+', default=None, choices=list(CASES),
+                        help="Benchmarks to run, default is all")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[128, 512, 2048])
+    parser.add_argument('--nstyles', type=int, nargs='+', default=[5, 8])
+    parser.add_argument('--n_aux', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--min_run_time', type=float, default=0.5,
+                        help="Minimum measured time of each benchmark in seconds")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Torch threads, 1 by default as in the parallel trials, 0 for all the available CPUs")
+    args = parser.parse_args()
+
+    threads = args.threads or len(available_cpus())
+    grid = {"batch_size": args.batch_sizes, "nstyle": args.nstyles, "n_aux": args.n_aux}
+    results = run_benchmarks(grid, cases=args.cases, min_run_time=args.min_run_time, num_threads=threads)
+    for key, r in results.items():
+        print(f"{key:60s} {r['median'] * 1e3:10.3f} ms  (IQR {r['iqr'] * 1e3:.3f} ms)")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "meta": {
+                    "torch": torch.__version__, "threads": threads, "python": platform.python_version(),
+                    "machine": platform.machine(), "processor": platform.processor()
+                },
+                "grid": grid,
+                "results": results
+            }, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline["results"], results, threshold=args.threshold)
+        print(f"\nComparison with {args.compare} (torch {baseline['meta']['torch']}, {baseline['meta']['threads']} thread(s)):")
+        for key, base_time, current_time, ratio, regressed in rows:
+            print(
+                f"{key:60s} {base_time * 1e3:10.3f} -> {current_time * 1e3:10.3f} ms  {ratio - 1:+7.1%}"
+                + ("  REGRESSION" if regressed else "")
+            )
+        n_regressed = sum(row[4] for row in rows)
+        print(f"{n_regressed} of {len(rows)} benchmarks slower than the baseline by more than {args.threshold:.0%}.")
+        if n_regressed > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
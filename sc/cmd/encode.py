@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from sc.utils import compat
+from sc.utils.parallel import get_executor
+from sc.utils.affinity import available_cpus, plan_cpu_sets, format_plan
+
+
+SCAN_GRANULE = 1024 # rows between two recorded byte offsets of the csv file, the shards start at these rows.
+
+
+def scan_spectra_csv(csv_fn):
+    """
+    Read the header of a spectra csv file (2 index columns, then the AUX_/ENE_ columns) and
+    count its rows without parsing them.
+
+    Returns
+    -------
+    columns : the names of the data columns.
+    n_rows : the number of rows.
+    offsets : the byte offsets of the rows 0, SCAN_GRANULE, 2*SCAN_GRANULE, ...
+    """
+    columns = pd.read_csv(csv_fn, index_col=[0, 1], comment='#', nrows=0).columns.to_list()
+    n_rows, offsets, position, header = 0, [], 0, True
+    with open(csv_fn, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'#') and line.strip():
+                if header:
+                    header = False
+                else:
+                    if n_rows % SCAN_GRANULE == 0:
+                        offsets.append(position)
+                    n_rows += 1
+            position += len(line)
+    return columns, n_rows, offsets
+
+
+def open_spectra_npy(npy_fn):
+    """
+    Memory map a binary spectra file: a float array of spectra, or the `data.npy` of a spectra
+    cache (see `sc.clustering.dataloader.build_spectra_cache`), whose `meta.json` gives the
+    columns and the index.
+
+    Returns
+    -------
+    data, spec_columns (the positions of the spectra columns in `data`), index (or None)
+    """
+    data = np.load(npy_fn, mmap_mode='r')
+    meta_fn = os.path.join(os.path.dirname(os.path.abspath(npy_fn)), "meta.json")
+    if not os.path.exists(meta_fn):
+        return data, list(range(data.shape[1])), None
+    with open(meta_fn) as f:
+        meta = json.load(f)
+    spec_columns = [i for i, col in enumerate(meta["columns"]) if col.startswith("ENE_")]
+    return data, spec_columns, meta["index"]
+
+
+def iter_spectra(input_file, first_row, n_rows, batch_size, offset=None):
+    """
+    Yield `(spec, index)` chunks of at most `batch_size` rows of the rows
+    [first_row, first_row + n_rows) of the input file, `index` is a list of labels or None.
+    For a csv file, `offset` is the byte offset of `first_row` (see `scan_spectra_csv`).
+    """
+    if input_file.endswith(".npy"):
+        data, spec_columns, index = open_spectra_npy(input_file)
+        for start in range(first_row, first_row + n_rows, batch_size):
+            end = min(start + batch_size, first_row + n_rows)
+            yield (
+                np.asarray(data[start:end][:, spec_columns], dtype=np.float32),
+                index[start:end] if index is not None else None
+            )
+        return
+    columns = pd.read_csv(input_file, index_col=[0, 1], comment='#', nrows=0).columns.to_list()
+    spec_columns = [i + 2 for i, col in enumerate(columns) if col.startswith("ENE_")]
+    with open(input_file, 'rb') as f:
+        f.seek(offset)
+        reader = pd.read_csv(f, header=None, comment='#', chunksize=batch_size, nrows=n_rows)
+        for chunk in reader:
+            yield (
+                chunk.iloc[:, spec_columns].to_numpy(dtype=np.float32),
+                chunk.iloc[:, :2].values.tolist()
+            )
+
+
+def encode_shard(
+    shard_id, model_file, input_file, output_dir, first_row, n_rows, offset=None,
+    batch_size=4096, decode=False, device="cpu"
+):
+    """
+    Encode the rows [first_row, first_row + n_rows) of the input file into the `styles.npy`
+    (and `recon.npy` if `decode`) arrays of `output_dir`, batch by batch.
+
+    Returns
+    -------
+    shard_id, n_rows, time_used
+    """
+    start = time.time()
+    model = compat.load(model_file, map_location=device)
+    encoder, decoder = model["Encoder"].eval(), model["Decoder"].eval()
+    styles_out = np.load(os.path.join(output_dir, "styles.npy"), mmap_mode='r+')
+    recon_out = np.load(os.path.join(output_dir, "recon.npy"), mmap_mode='r+') if decode else None
+    index_file = open(os.path.join(output_dir, f"index.csv.shard_{shard_id}"), 'w')
+    row = first_row
+    with compat.inference_mode():
+        for spec, index in iter_spectra(input_file, first_row, n_rows, batch_size, offset=offset):
+            spec = torch.from_numpy(spec).to(device)
+            styles = encoder(spec)
+            styles_out[row:row+len(spec)] = styles.cpu().numpy()
+            if decode:
+                recon_out[row:row+len(spec)] = decoder(styles).cpu().numpy()
+            if index is not None:
+                index_file.writelines(
+                    ",".join(str(x) for x in (label if isinstance(label, (list, tuple)) else [label])) + "\n"
+                    for label in index
+                )
+            row += len(spec)
+    index_file.close()
+    assert row == first_row + n_rows, f"Shard {shard_id} read {row - first_row} rows instead of {n_rows}."
+    styles_out.flush()
+    if decode:
+        recon_out.flush()
+    return shard_id, n_rows, time.time() - start
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Encode a spectra file into styles (and reconstructions) with a trained model."
+    )
+    parser.add_argument('-m', '--model', type=str, required=True,
+                        help="The trained model file, e.g. best.pt or final.pt of a trial")
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help="Spectra csv file, or .npy file (a float array of spectra or the data.npy of a spectra cache)")
+    parser.add_argument('-o', '--output_dir', type=str, default="encoded",
+                        help="Output directory of styles.npy, recon.npy and index.csv")
+    parser.add_argument('-b', '--batch_size', type=int, default=4096,
+                        help="Number of spectra encoded at once")
+    parser.add_argument('--decode', action='store_true',
+                        help="Also write the reconstructed spectra")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes, each encodes a contiguous shard of the file")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Torch threads per process, default is to share the CPUs between the processes")
+    parser.add_argument('--device', type=str, default="cpu",
+                        help="Torch device, e.g. cpu or cuda:0")
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.input.endswith(".npy"):
+        data, spec_columns, _ = open_spectra_npy(args.input)
+        n_rows, n_grid, offsets = data.shape[0], len(spec_columns), None
+    else:
+        columns, n_rows, offsets = scan_spectra_csv(args.input)
+        n_grid = sum(col.startswith("ENE_") for col in columns)
+    model = compat.load(args.model, map_location="cpu")
+    with compat.inference_mode():
+        nstyle = model["Encoder"].eval()(torch.zeros(2, n_grid)).size(1)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    np.lib.format.open_memmap(
+        os.path.join(args.output_dir, "styles.npy"), mode='w+', dtype=np.float32, shape=(n_rows, nstyle)
+    ).flush()
+    if args.decode:
+        np.lib.format.open_memmap(
+            os.path.join(args.output_dir, "recon.npy"), mode='w+', dtype=np.float32, shape=(n_rows, n_grid)
+        ).flush()
+
+    # contiguous shards starting at multiples of SCAN_GRANULE rows, the csv offsets are known there.
+    n_shards = max(min(args.workers, math.ceil(n_rows / SCAN_GRANULE)), 1)
+    shard_rows = math.ceil(n_rows / n_shards / SCAN_GRANULE) * SCAN_GRANULE
+    shards = [
+        (i, first_row, min(shard_rows, n_rows - first_row),
+         offsets[first_row // SCAN_GRANULE] if offsets is not None else None)
+        for i, first_row in enumerate(range(0, n_rows, shard_rows))
+    ]
+    if len(shards) > 1:
+        cpu_sets = plan_cpu_sets(len(shards), args.threads)
+        print(format_plan(cpu_sets))
+        executor = get_executor("process", cpu_sets=cpu_sets)
+    else:
+        torch.set_num_threads(args.threads or len(available_cpus()))
+        executor = get_executor("serial")
+    n_jobs = len(shards)
+    result = executor.map_unordered(
+        encode_shard,
+        [s[0] for s in shards],
+        [args.model] * n_jobs,
+        [args.input] * n_jobs,
+        [args.output_dir] * n_jobs,
+        [s[1] for s in shards],
+        [s[2] for s in shards],
+        [s[3] for s in shards],
+        [args.batch_size] * n_jobs,
+        [args.decode] * n_jobs,
+        [args.device] * n_jobs
+    )
+    for shard_id, n, time_used in result:
+        print(f"Shard {shard_id}: {n} spectra in {time_used:.2f}s.")
+    executor.shutdown()
+
+    # the index labels of the shards, in order
+    with open(os.path.join(args.output_dir, "index.csv"), 'w') as f:
+        for shard_id, *_ in shards:
+            shard_fn = os.path.join(args.output_dir, f"index.csv.shard_{shard_id}")
+            with open(shard_fn) as f_shard:
+                shutil.copyfileobj(f_shard, f)
+            os.remove(shard_fn)
+    print(f"Encoded {n_rows} spectra into {args.output_dir} in {time.time() - start:.2f}s.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+
+import torch
+from sc.utils import compat
+from sc.utils.export import export_model, EXPORT_FORMATS
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Export the encoder and decoder of a trained model for inference with torch alone."
+    )
+    parser.add_argument('-m', '--model', type=str, required=True,
+                        help="The trained model file, e.g. best.pt or final.pt of a trial")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="Prefix of the exported files, default is the model file without extension")
+    parser.add_argument('--dim_in', type=int, default=256,
+                        help="Length of the input spectra, fixed in the exported encoder")
+    parser.add_argument('--format', type=str, default="torchscript", choices=EXPORT_FORMATS,
+                        help="torchscript (loaded by torch.jit.load) or export (torch.export.load)")
+    parser.add_argument('--no_fold', action='store_true',
+                        help="Do not remove the Dropout layers and fold the BatchNorm layers")
+    args = parser.parse_args()
+
+    model = compat.load(args.model, map_location="cpu")
+    encoder, decoder = model["Encoder"].eval(), model["Decoder"].eval()
+    prefix = args.output if args.output is not None else os.path.splitext(args.model)[0]
+    extension = "ts" if args.format == "torchscript" else "pt2"
+
+    spec = torch.rand(2, args.dim_in) # batch of 2, a batch of 1 would be fixed by `torch.export`
+    with torch.no_grad():
+        styles = encoder(spec)
+        z = torch.randn(2, styles.size(1))
+        spec_out = decoder(z)
+    for name, module, example, reference in [
+        ("encoder", encoder, spec, styles), ("decoder", decoder, z, spec_out)
+    ]:
+        file_path = f"{prefix}_{name}.{extension}"
+        exported = export_model(module, example, file_path, format=args.format, fold=not args.no_fold)
+        with torch.no_grad():
+            error = (exported(example) - reference).abs().max().item()
+        print(f"Exported the {name} to {file_path} (max. deviation from the model {error:.3g}).")
+
+
+if __name__ == '__main__':
+    main()
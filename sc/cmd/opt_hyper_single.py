@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import time
+import logging
+
+import yaml
+import numpy as np
+from sc.clustering.trainer import Trainer
+from sc.cmd.train_sc import run_training, TrainingTimeout
+from sc.utils.parameter import Parameters
+from sc.utils.logger import create_logger
+from sc.utils.parallel import get_executor
+from sc.utils.affinity import available_cpus, plan_cpu_sets, format_plan
+from sc.utils.search import SearchSpace, Study, AshaCallback
+
+
+def run_trial(
+    trial_id,
+    work_dir,
+    base_config,
+    params,
+    study_path,
+    asha_config,
+    timeout_hours=0,
+    logger = logging.getLogger("search"),
+    num_threads=None
+):
+    """
+    Train one trial of the search with the parameters `params` on top of `base_config`, and
+    record its outcome in the study. The training is stopped after `timeout_hours` (0: no limit)
+    or at the deadline of the study, whichever comes first.
+
+    Returns
+    -------
+    trial_id, state, value
+    """
+    study = Study(study_path)
+    deadline = study.get_meta("deadline")
+    if deadline is not None and time.time() > deadline:
+        study.set_state(trial_id, "TIMEOUT")
+        return trial_id, "TIMEOUT", None
+    if deadline is not None: # the alarm of the trial goes off at the deadline at the latest.
+        hours_left = (deadline - time.time()) / 3600
+        timeout_hours = min(timeout_hours, hours_left) if timeout_hours > 0 else hours_left
+    study.set_state(trial_id, "RUNNING")
+
+    train_config = Parameters(dict(base_config))
+    train_config.update(params)
+    callback = AshaCallback(study_path, trial_id, Trainer.metric_weights, **asha_config)
+    start = time.time()
+    try:
+        metrics, time_used = run_training(
+            trial_id,
+            work_dir,
+            train_config,
+            train_config.get("verbose", False),
+            os.path.join(work_dir, train_config.get("data_file", None)),
+            timeout_hours = timeout_hours,
+            logger = logger,
+            num_threads = num_threads,
+            callback = callback
+        )
+    except TrainingTimeout:
+        logger.info(f"Trial {trial_id+1} stopped after {timeout_hours:.3g} hours.")
+        metrics, time_used = None, time.time() - start
+        callback.timed_out = True
+
+    if callback.timed_out:
+        state = "TIMEOUT"
+    elif callback.pruned:
+        state = "PRUNED"
+    else:
+        state = "COMPLETE"
+    value = float(callback.best_metric) if np.isfinite(callback.best_metric) else None
+    if metrics is not None:
+        metrics = [None if m is None else float(m) for m in metrics]
+    study.set_state(trial_id, state, value=value, metrics=metrics, time=time_used)
+    return trial_id, state, value
+
+
+def set_deadline(study, budget_hours):
+    """
+    Set the deadline of the study to `budget_hours` after the start of its first run, which is
+    kept in the study so that rerunning an interrupted search does not extend the budget.
+    No deadline if `budget_hours` is 0.
+    """
+    start = study.get_meta("start")
+    if start is None:
+        start = time.time()
+        study.set_meta("start", start)
+    deadline = start + budget_hours * 3600 if budget_hours > 0 else None
+    study.set_meta("deadline", deadline)
+    return deadline
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help='Search space and settings of the search in YAML format')
+    parser.add_argument('-w', "--work_dir", type=str, default='.',
+                        help="Working directory to write the output files")
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(os.path.expanduser(args.work_dir))
+    assert os.path.exists(work_dir)
+    with open(os.path.join(work_dir, args.config)) as f:
+        search_config = yaml.full_load(f)
+    base_config = Parameters.from_yaml(os.path.join(work_dir, search_config["base_config"])).to_dict()
+    space = SearchSpace(search_config["space"])
+    n_trials = search_config.get("n_trials", 16)
+    seed = search_config.get("seed", 0)
+    budget_hours = search_config.get("budget_hours", 0)
+    timeout = base_config.get("timeout", 10)
+
+    logger = create_logger("Hyperparameter search:", f'{work_dir}/search_message.txt', append=True)
+    logger.info("START")
+
+    # The study file keeps the trials of previous (possibly interrupted) runs of the search.
+    study_path = os.path.join(work_dir, search_config.get("study", "study.db"))
+    study = Study(study_path)
+    set_deadline(study, budget_hours)
+    for trial_id in range(n_trials):
+        study.add_trial(trial_id, space.sample(seed + trial_id))
+    trials = [t for t in study.trials() if t["state"] not in Study.FINISHED and t["trial_id"] < n_trials]
+    for t in trials:
+        study.reset_trial(t["trial_id"]) # interrupted or timed out trials start over
+    logger.info(
+        f"{len(trials)} of {n_trials} trials to run, "
+        f"{len(study.trials(Study.FINISHED))} finished in previous runs of the search."
+    )
+
+    executor_name = search_config.get("executor", "process")
+    cpu_sets, num_threads = None, None
+    if executor_name == "process":
+        cpu_sets = plan_cpu_sets(
+            search_config.get("executor_workers", None) or max(len(trials), 1), search_config.get("executor_threads", None)
+        )
+        logger.info(format_plan(cpu_sets))
+    elif executor_name == "serial":
+        num_threads = len(available_cpus())
+    executor = get_executor(executor_name, work_dir=work_dir, cpu_sets=cpu_sets)
+    logger.info("Running with {} process(es).".format(executor.n_workers))
+
+    n_jobs = len(trials)
+    result = executor.map_unordered(
+        run_trial,
+        [t["trial_id"] for t in trials],
+        [work_dir] * n_jobs,
+        [base_config] * n_jobs,
+        [t["params"] for t in trials],
+        [study_path] * n_jobs,
+        [search_config.get("asha", {})] * n_jobs,
+        [timeout] * n_jobs,
+        [logger] * n_jobs,
+        [num_threads] * n_jobs
+    )
+    for i, (trial_id, state, value) in enumerate(result):
+        logger.info(f"{i+1}/{n_jobs} trials finished, trial {trial_id+1}: {state}, combined metric {value}.")
+    executor.shutdown()
+
+    best = study.best_trial()
+    if best is None:
+        logger.info("No trial finished.")
+    else:
+        logger.info(f"Best trial {best['trial_id']+1}: combined metric {best['value']}, {best['params']}.")
+        best_config = dict(base_config)
+        best_config.update(best["params"])
+        with open(os.path.join(work_dir, "best_config.yaml"), 'w') as f:
+            yaml.dump(best_config, f, sort_keys=False)
+    logger.info("END\n\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,17 @@ import argparse
 
 import torch
 from sc.clustering.trainer import Trainer
+from sc.clustering.packed_trainer import PackedTrainer
 from sc.utils.parameter import Parameters
+from sc.utils import compat
 from sc.utils.logger import create_logger
+from sc.utils.parallel import get_executor, ProcessExecutor
+from sc.utils.affinity import available_cpus, plan_cpu_sets, format_plan
+from sc.utils.pruning import MedianPruner
 import os
+import shutil
 import yaml
 import socket
-import ipyparallel as ipp
 import logging
 import signal
 import time
@@ -18,31 +23,45 @@ import numpy as np
 
 engine_id = -1
 
+class TrainingTimeout(Exception):
+    pass
+
+
 def timeout_handler(signum, frame):
-    raise Exception("Training Overtime!")
+    raise TrainingTimeout("Training Overtime!")
 
 
-def get_parallel_map_func(work_dir=".", logger=logging.getLogger("Parallel")):
-    
-    c = ipp.Client(
-        connection_info=f"{work_dir}/ipypar/security/ipcontroller-client.json"
-    )
+def truncate_loss_log(log_path, start_epoch):
+    """
+    Drop the rows of the loss log logged at or after `start_epoch`, they are logged again after
+    resuming.
+    """
+    if not os.path.exists(log_path):
+        return
+    with open(log_path) as f:
+        lines = f.readlines()
+    kept = [
+        line for line in lines 
+        if not line.split(",")[0].strip().isdigit() or int(line.split(",")[0]) < start_epoch
+    ]
+    with open(log_path, 'w') as f:
+        f.writelines(kept)
 
-    with c[:].sync_imports():
-        import torch
-        from sc.clustering.trainer import Trainer
-        from sc.utils.parameter import Parameters
-        from sc.utils.logger import create_logger
-        import os
-        import socket
-        import logging
-        import signal
-        import time
-    logger.info(f"Engine IDs: {c.ids}")
-    c[:].push(dict(run_training=run_training, timeout_handler=timeout_handler),
-              block=True)
 
-    return c.load_balanced_view().map_sync, len(c.ids)
+def get_pruner(work_dir, job_number, train_config, resume=False):
+    """
+    The `MedianPruner` of the trial `job_number` if `prune_trials` is set in the config.
+    """
+    if not train_config.get("prune_trials", False):
+        return None
+    return MedianPruner(
+        f"{work_dir}/pruning", job_number + 1, Trainer.metric_weights,
+        warmup_epochs = train_config.get("prune_warmup", 100),
+        interval = train_config.get("prune_interval", 10),
+        min_trials = train_config.get("prune_min_trials", 4),
+        percentile = train_config.get("prune_percentile", 50),
+        resume = resume
+    )
 
 
 def run_training(
@@ -52,20 +71,38 @@ def run_training(
     verbose, 
     data_file, 
     timeout_hours=0,
-    logger = logging.getLogger("training")
+    logger = logging.getLogger("training"),
+    resume=False,
+    num_threads=None,
+    callback=None
 ):
 
+    pruner = get_pruner(work_dir, job_number, train_config, resume=resume)
+    callbacks = [c for c in (pruner, callback) if c is not None]
     work_dir = f'{work_dir}/training/job_{job_number+1}'
     if not os.path.exists(work_dir):
         os.makedirs(work_dir, exist_ok=True)
 
+    resume_file = os.path.join(work_dir, "resume.pt")
+    resume_state = None
+    if resume and os.path.exists(resume_file):
+        resume_state = compat.load(resume_file, map_location='cpu')
+        truncate_loss_log(os.path.join(work_dir, "losses.csv"), resume_state["epoch"])
+
     # Set up a logger to record general training information
-    logger = create_logger(f"subtraining_{job_number+1}", os.path.join(work_dir, "messages.txt"))
+    logger = create_logger(
+        f"subtraining_{job_number+1}", os.path.join(work_dir, "messages.txt"), append=resume_state is not None
+    )
     
     # Set up a logger to record losses against epochs during training 
-    loss_logger = create_logger(f"losses_{job_number+1}", os.path.join(work_dir, "losses.csv"), simple_fmt=True)
+    loss_logger = create_logger(
+        f"losses_{job_number+1}", os.path.join(work_dir, "losses.csv"), 
+        append=resume_state is not None, simple_fmt=True
+    )
 
-    if torch.get_num_interop_threads() > 2:
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    elif torch.get_num_interop_threads() > 2:
         torch.set_num_interop_threads(1)
         torch.set_num_threads(1)
     
@@ -88,10 +125,15 @@ def run_training(
         logger = logger,
         loss_logger = loss_logger,
     )
+    if resume_state is not None:
+        trainer.load_state_dict(resume_state)
+        logger.info(f"Resumed from epoch {trainer.start_epoch}.")
     signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(int(timeout_hours * 3600))
+    signal.alarm(int(np.ceil(timeout_hours * 3600)))
 
-    metrics = trainer.train()
+    metrics = trainer.train(
+        callback=(lambda epoch, m: any([c(epoch, m) for c in callbacks])) if callbacks else None
+    )
     logger.info(metrics)
 
     signal.alarm(0)
@@ -102,6 +144,130 @@ def run_training(
     return metrics, time_used
 
 
+def run_packed_training(
+    job_numbers, 
+    work_dir, 
+    train_config,  
+    verbose, 
+    data_file, 
+    timeout_hours=0,
+    logger = logging.getLogger("training"),
+    resume=False,
+    num_threads=None
+):
+    """
+    Train the trials `job_numbers` together with a `PackedTrainer`, into the same per-trial
+    directories as `run_training`. Returns the list of (metrics, time_used) of the trials, the
+    time being the time of the pack divided by the number of trials.
+    """
+    pruners = [get_pruner(work_dir, job_number, train_config) for job_number in job_numbers]
+    work_dirs = [f'{work_dir}/training/job_{job_number+1}' for job_number in job_numbers]
+    for job_dir in work_dirs:
+        os.makedirs(job_dir, exist_ok=True)
+
+    loggers = [
+        create_logger(f"subtraining_{job_number+1}", os.path.join(job_dir, "messages.txt"))
+        for job_number, job_dir in zip(job_numbers, work_dirs)
+    ]
+    loss_loggers = [
+        create_logger(f"losses_{job_number+1}", os.path.join(job_dir, "losses.csv"), simple_fmt=True)
+        for job_number, job_dir in zip(job_numbers, work_dirs)
+    ]
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    elif torch.get_num_interop_threads() > 2:
+        torch.set_num_interop_threads(1)
+        torch.set_num_threads(1)
+
+    ngpus_per_node = torch.cuda.device_count()
+    local_id = int(os.environ.get("SLURM_LOCALID", 0))
+    igpu = local_id % ngpus_per_node if torch.cuda.is_available() else -1
+
+    start = time.time()
+    for job_number, job_logger in zip(job_numbers, loggers):
+        job_logger.info(f"Training started for trial {job_number+1} (packed with {len(job_numbers)} trials).")
+
+    trainer = PackedTrainer.from_data(
+        data_file,
+        igpu = igpu,
+        verbose = verbose,
+        work_dirs = work_dirs,
+        config_parameters = train_config,
+        loggers = loggers,
+        loss_loggers = loss_loggers,
+    )
+    signal.signal(signal.SIGALRM, timeout_handler)
+    signal.alarm(int(np.ceil(timeout_hours * 3600)))
+
+    if train_config.get("prune_trials", False):
+        callback = lambda epoch, metrics: [pruner(epoch, m) for pruner, m in zip(pruners, metrics)]
+    else:
+        callback = None
+    metrics = trainer.train(callback=callback)
+
+    signal.alarm(0)
+
+    time_used = (time.time() - start) / len(job_numbers)
+    for job_metrics, job_logger in zip(metrics, loggers):
+        job_logger.info(job_metrics)
+        job_logger.info(f"Training finished. Time used: {time_used:.2f}s (per trial of the pack).\n\n")
+
+    return [(job_metrics, time_used) for job_metrics in metrics]
+
+
+def time_epochs(job_number, work_dir, train_config, verbose, data_file, timeout_hours=0):
+    """
+    `run_training` of a benchmark trial, returns the mean time of its epochs after the first
+    one (which also loads the data and builds the models).
+    """
+    epoch_ends = []
+    run_training(
+        job_number, work_dir, train_config, verbose, data_file,
+        timeout_hours = timeout_hours,
+        callback = lambda epoch, metrics: epoch_ends.append(time.time())
+    )
+    return np.diff(epoch_ends).mean()
+
+
+def benchmark_threads(work_dir, train_config, verbose, data_file, timeout, logger, epochs=5):
+    """
+    Run one wave of concurrent trials for each number of threads per trial (powers of 2) and
+    report the throughput in trials per hour. The trials only run `epochs` epochs, without
+    checkpoints nor resume states, the throughput is extrapolated from their epoch time to
+    trials of `max_epoch` epochs.
+    """
+    assert epochs >= 2, "The epoch time is measured after the first epoch."
+    max_epoch = train_config.max_epoch
+    bench_config = Parameters(train_config.to_dict())
+    bench_config.update({
+        "max_epoch": epochs, "checkpoint_top_k": 0, "resume_interval": 0,
+        "prune_trials": False, "early_stop_patience": 0, "tensorboard": False
+    })
+    n_cpus = len(available_cpus())
+    threads_per_trial = 1
+    while threads_per_trial <= n_cpus:
+        cpu_sets = plan_cpu_sets(n_cpus, threads_per_trial)
+        n_trials = len(cpu_sets)
+        executor = ProcessExecutor(cpu_sets=cpu_sets)
+        epoch_times = list(executor.map_unordered(
+            time_epochs,
+            list(range(n_trials)),
+            [f"{work_dir}/benchmark/threads_{threads_per_trial}"] * n_trials,
+            [bench_config] * n_trials,
+            [verbose] * n_trials,
+            [data_file] * n_trials,
+            [timeout] * n_trials
+        ))
+        executor.shutdown()
+        epoch_time = np.mean(epoch_times)
+        logger.info(
+            f"Benchmark: {n_trials} trial(s) x {threads_per_trial} thread(s), {epoch_time:.3f}s per epoch, "
+            f"{n_trials / (epoch_time * max_epoch) * 3600:.1f} trials/hour of {max_epoch} epochs."
+        )
+        threads_per_trial *= 2
+
+
 def main():
     
     parser = argparse.ArgumentParser()
@@ -109,6 +275,13 @@ def main():
                         help='Config for training parameter in YAML format')
     parser.add_argument('-w', "--work_dir", type=str, default='.',
                         help="Working directory to write the output files")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume the trials from their last saved training state (resume.pt)")
+    parser.add_argument('--benchmark_threads', action='store_true',
+                        help="Sweep the number of threads per trial and report the trials/hour")
+    parser.add_argument('--benchmark_epochs', type=int, default=5,
+                        help="Epochs of each benchmark trial (instead of max_epoch), the trials/hour "
+                        "are extrapolated from their epoch time")
     args = parser.parse_args()
 
     work_dir = os.path.abspath(os.path.expanduser(args.work_dir))
@@ -124,25 +297,64 @@ def main():
     logger = create_logger("Main training:", f'{work_dir}/main_process_message.txt', append=True)
     logger.info("START")
 
-    if trials > 1:
-        par_map, nprocesses = get_parallel_map_func(work_dir, logger=logger)
-    else:
-        par_map, nprocesses = map, 1
-    logger.info("Running with {} process(es).".format(nprocesses))
+    if args.benchmark_threads:
+        benchmark_threads(work_dir, train_config, verbose, data_file, timeout, logger, epochs=args.benchmark_epochs)
+        logger.info("END\n\n")
+        return
+
+    executor_name = train_config.get("executor", "ipyparallel" if trials > 1 else "serial")
+    cpu_sets, num_threads = None, None
+    n_processes = -(-trials // train_config.get("pack_trials", 1))
+    if executor_name == "process":
+        cpu_sets = plan_cpu_sets(
+            train_config.get("executor_workers", None) or n_processes, train_config.get("executor_threads", None)
+        )
+        logger.info(format_plan(cpu_sets))
+    elif executor_name == "serial":
+        num_threads = len(available_cpus())
+        logger.info(f"CPU plan: 1 trial at a time x {num_threads} thread(s).")
+    executor = get_executor(executor_name, work_dir=work_dir, cpu_sets=cpu_sets)
+    if executor_name == "ipyparallel":
+        logger.info(f"Engine IDs: {executor.client.ids}")
+    logger.info("Running with {} process(es).".format(executor.n_workers))
     
+    if not args.resume and os.path.isdir(f"{work_dir}/pruning"):
+        shutil.rmtree(f"{work_dir}/pruning") # the records of a previous sweep
+    
+    # Several trials can be trained together in one process by a `PackedTrainer`.
+    pack_trials = train_config.get("pack_trials", 1)
+    if pack_trials > 1:
+        jobs = [list(range(trials))[i:i+pack_trials] for i in range(0, trials, pack_trials)]
+        run_fn = run_packed_training
+        if args.resume:
+            logger.warning("Packed trials can not be resumed, they start over.")
+        logger.info(f"Packing {pack_trials} trials per process.")
+    else:
+        jobs = list(range(trials))
+        run_fn = run_training
+    n_jobs = len(jobs)
+
     start = time.time()
-    result = par_map(
-        run_training,
-        list(range(trials)),
-        [work_dir] * trials,
-        [train_config] * trials,
-        [verbose] * trials,
-        [data_file] * trials,
-        [timeout] * trials,
-        [logger] * trials
+    result = executor.map_unordered(
+        run_fn,
+        jobs,
+        [work_dir] * n_jobs,
+        [train_config] * n_jobs,
+        [verbose] * n_jobs,
+        [data_file] * n_jobs,
+        [timeout] * n_jobs,
+        [logger] * n_jobs,
+        [args.resume and pack_trials <= 1] * n_jobs,
+        [num_threads] * n_jobs
     )
 
-    time_trials = np.array([r[1] for r in list(result)])
+    time_trials = []
+    for r in result:
+        for _, time_used in (r if pack_trials > 1 else [r]):
+            time_trials.append(time_used)
+            logger.info(f"{len(time_trials)}/{trials} trials finished, the last one took {time_used:.2f}s.")
+    executor.shutdown()
+    time_trials = np.array(time_trials)
     logger.info(
         f"Time used for each trial: {time_trials.mean():.2f} +/- {time_trials.std():.2f}s.\n" + 
         ' '.join([f"{t:.2f}s" for t in time_trials])
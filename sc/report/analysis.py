@@ -3,6 +3,7 @@ import os
 import itertools
 import torch
 import pickle
+import hashlib
 import numpy as np
 from numpy.polynomial import Polynomial
 from scipy import stats
@@ -15,6 +16,11 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import plotly.express as px
 
+from sc.clustering.dataloader import _file_hash
+from sc.utils.parallel import get_executor
+from sc.utils import compat
+from sc.utils.affinity import plan_cpu_sets
+
 
 
 def create_plotly_colormap(n_colors):
@@ -103,25 +109,108 @@ def plot_spectra_variation(
 
     return style_variation, spec_out
 
+EVALUATION_CACHE_VERSION = 1
+
+
+def dataset_hash(test_ds):
+    """
+    SHA1 of the spectra and descriptors of a dataset, part of the key of the cached evaluations.
+    """
+    sha1 = hashlib.sha1()
+    for x in [test_ds.spec, test_ds.aux]:
+        if x is not None:
+            sha1.update(np.ascontiguousarray(x, dtype=np.float32).tobytes())
+    return sha1.hexdigest()
+
+
+def get_evaluation_cache(model_file):
+    """
+    The `evaluate_model` result of a model is cached next to it, e.g. `final.pt` -> `final.pt.evaluation.pkl`.
+    """
+    return f"{model_file}.evaluation.pkl"
+
+
+def load_cached_evaluation(model_file, data_hash):
+    """
+    The cached evaluation of `model_file` on the dataset of hash `data_hash`, or None if it is
+    missing or out of date (the model file or the dataset has changed).
+    """
+    cache_file = get_evaluation_cache(model_file)
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):
+        return None
+    key = cache["key"]
+    stat = os.stat(model_file)
+    if key["version"] != EVALUATION_CACHE_VERSION or key["data"] != data_hash or key["size"] != stat.st_size:
+        return None
+    if key["mtime"] != stat.st_mtime and key["sha1"] != _file_hash(model_file):
+        return None # the model has been overwritten
+    return cache["result"]
+
+
+def evaluate_job(job, model_path, test_ds, data_hash=None, device=torch.device('cpu')):
+    """
+    Evaluate the `final.pt` model of `job` and cache the result next to it.
+
+    Returns
+    -------
+    job, result
+    """
+    model_file = os.path.join(model_path, job, "final.pt")
+    stat = os.stat(model_file)
+    model = compat.load(model_file, map_location=device)
+    result = evaluate_model(test_ds, model, device=device)
+    if data_hash is not None:
+        key = {
+            "version": EVALUATION_CACHE_VERSION, "data": data_hash,
+            "size": stat.st_size, "mtime": stat.st_mtime, "sha1": _file_hash(model_file)
+        }
+        cache_file = get_evaluation_cache(model_file)
+        with open(f"{cache_file}.tmp", 'wb') as f:
+            pickle.dump({"key": key, "result": result}, f)
+        os.replace(f"{cache_file}.tmp", cache_file)
+    return job, result
+
+
 def evaluate_all_models(
     model_path, test_ds, 
-    device=torch.device('cpu')
+    device=torch.device('cpu'),
+    n_workers=1,
+    use_cache=True
 ):
     '''
-    Sort models according to multi metrics, in descending order of goodness.
-    '''
+    Evaluate the `final.pt` model of every `job_*` folder in `model_path`.
 
-    # evaluate model
-    result = {}
-    for job in os.listdir(model_path):
-        if job.startswith("job_"):
-            model = torch.load(
-                os.path.join(model_path, job, "final.pt"), 
-                map_location = device
-            )
-            result[job] = evaluate_model(test_ds, model, device=device)
+    The result of each model is cached next to it (see `evaluate_job`), keyed by the model file
+    and the dataset, so only new or retrained models are evaluated again. On the CPU, the models
+    are evaluated by `n_workers` processes.
+    '''
+    jobs = [job for job in os.listdir(model_path) if job.startswith("job_")]
+    data_hash = dataset_hash(test_ds) if use_cache else None
+    result, missing = {}, []
+    for job in jobs:
+        cached = load_cached_evaluation(os.path.join(model_path, job, "final.pt"), data_hash) if use_cache else None
+        if cached is None:
+            missing.append(job)
+        else:
+            result[job] = cached
+
+    if n_workers > 1 and len(missing) > 1 and torch.device(device).type == "cpu":
+        executor = get_executor("process", cpu_sets=plan_cpu_sets(min(n_workers, len(missing)), 1))
+    else:
+        executor = get_executor("serial")
+    n_jobs = len(missing)
+    for job, job_result in executor.map_unordered(
+        evaluate_job, missing, [model_path] * n_jobs, [test_ds] * n_jobs, [data_hash] * n_jobs, [device] * n_jobs
+    ):
+        result[job] = job_result
+    executor.shutdown()
     
-    return result
+    return {job: result[job] for job in jobs}
 
 def load_evaluations(evaluation_path="./report_model_evaluations.pkl"):
     with open(evaluation_path, 'rb') as f:
@@ -230,9 +319,35 @@ def sort_all_models(
     return result_dict, ranked_jobs, fig
 
 
-def get_confusion_matrix(cn, style_cn, ax=None):
+def f1_score_curve(scores, labels, thresholds, greater=False):
+    """
+    F1 scores of the binary predictions `scores > th` (`greater`) or `scores < th` of the
+    boolean `labels`, for every `th` in `thresholds`, equal to
+    `[f1_score(scores < th, labels, zero_division=0) for th in thresholds]` but computed from
+    one sort of the scores and cumulative counts.
+    """
+    scores, labels = np.asarray(scores, dtype=float), np.asarray(labels, dtype=bool)
+    valid = ~np.isnan(scores) # NaN is never predicted positive
+    sorted_all = np.sort(scores[valid])
+    sorted_pos = np.sort(scores[valid & labels])
+    if greater:
+        n_pred = len(sorted_all) - np.searchsorted(sorted_all, thresholds, side='right')
+        tp = len(sorted_pos) - np.searchsorted(sorted_pos, thresholds, side='right')
+    else:
+        n_pred = np.searchsorted(sorted_all, thresholds, side='left')
+        tp = np.searchsorted(sorted_pos, thresholds, side='left')
+    fp, fn = n_pred - tp, labels.sum() - tp
+    denominator = 2 * tp + fp + fn
+    return np.where(denominator > 0, 2 * tp / np.maximum(denominator, 1), 0.0)
+
+
+def get_confusion_matrix(cn, style_cn, ax=None, exact_thresholds=False):
     """
     get donfusion matrix for a discrete descriptor, such as coordination number.
+
+    The CN4/CN5 and CN5/CN6 thresholds of the style maximize the F1 scores of CN4 and CN6,
+    searched on a grid of 700 thresholds in [-3.5, 3.5], or, if `exact_thresholds`, on the
+    midpoints between consecutive distinct style values (every distinct split of the data).
     """
     result = {
         "F1 score": None,
@@ -240,12 +355,16 @@ def get_confusion_matrix(cn, style_cn, ax=None):
         "CN56 Threshold": None
     }
     data_length = len(cn)
-    thresh_grid = np.linspace(-3.5, 3.5, 700)
+    if exact_thresholds:
+        values = np.unique(style_cn[~np.isnan(style_cn)])
+        thresh_grid = np.concatenate([values[:1] - 1, (values[1:] + values[:-1]) / 2, values[-1:] + 1])
+    else:
+        thresh_grid = np.linspace(-3.5, 3.5, 700)
     cn_classes = (cn - 4).astype(int) # the minimum CN is 4 by default.
     cn_class_sets = list(set(cn_classes))
 
-    cn4_f1_scores = [f1_score(style_cn < th, cn_classes<1,zero_division=0) for th in thresh_grid]
-    cn6_f1_scores = [f1_score(style_cn > th, cn_classes>1,zero_division=0) for th in thresh_grid]
+    cn4_f1_scores = f1_score_curve(style_cn, cn_classes<1, thresh_grid)
+    cn6_f1_scores = f1_score_curve(style_cn, cn_classes>1, thresh_grid, greater=True)
     cn45_thresh = thresh_grid[np.argmax(cn4_f1_scores)]
     cn56_thresh = thresh_grid[np.argmax(cn6_f1_scores)]
 
@@ -261,9 +380,9 @@ def get_confusion_matrix(cn, style_cn, ax=None):
     
     sep_threshold_f1_score = f1_score(cn_classes, sep_pred_cn_classes, average='weighted')
 
-    result["F1 score"] = round(sep_threshold_f1_score.tolist(), 4)
-    result["CN45 Threshold"] = round(cn45_thresh.tolist(), 4)
-    result["CN56 Threshold"] = round(cn56_thresh.tolist(), 4)
+    result["F1 score"] = round(float(sep_threshold_f1_score), 4)
+    result["CN45 Threshold"] = round(float(cn45_thresh), 4)
+    result["CN56 Threshold"] = round(float(cn56_thresh), 4)
 
     if ax is not None:
         sns.set_palette('bright', 2)
@@ -412,11 +531,13 @@ def evaluate_model(
     
     # Get styles via encoder
     spec_in = torch.tensor(test_ds.spec, dtype=torch.float32, device=device)
-    styles = encoder(spec_in)
+    with torch.no_grad():
+        styles = encoder(spec_in)
     result["Input"] = spec_in.cpu().numpy()
 
     if reconstruct:
-        spec_out = decoder(styles).clone().detach().cpu().numpy()
+        with torch.no_grad():
+            spec_out = decoder(styles).clone().detach().cpu().numpy()
         mae_list = []
         for s1, s2 in zip(spec_in.cpu().numpy(), spec_out):
             mae_list.append(mean_absolute_error(s1, s2))
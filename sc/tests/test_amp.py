@@ -0,0 +1,49 @@
+import os
+import torch
+from sc.clustering.model import Encoder, CompactEncoder, Decoder
+from sc.utils.functions import kendall_constraint, recon_loss
+
+
+class Test_MixedPrecision():
+
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+    torch.manual_seed(0)
+    spec = torch.rand(64, 256)
+
+    def test_fixture_models(self):
+        # bf16 autocast of the trained test models stays close to their fp32 output.
+        model = torch.load(
+            os.path.join(self.data_dir, "training/job_1/final.pt"), map_location="cpu", weights_only=False
+        )
+        encoder, decoder = model["Encoder"].eval(), model["Decoder"].eval()
+        z = torch.randn(256, 6)
+        with torch.no_grad():
+            spec = decoder(z) # spectra in the domain of the models
+            styles = encoder(spec)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                spec_amp = decoder(z)
+                styles_amp = encoder(spec)
+        assert (spec_amp.float() - spec).abs().max() < 0.02 * spec.abs().max()
+        assert (styles_amp.float() - styles).abs().max() < 0.02 * styles.abs().max()
+        assert recon_loss(spec, spec_amp.float()).item() < 1e-4 * (spec**2).mean().item()
+
+    def test_fp32_parts(self):
+        for encoder_cls in [Encoder, CompactEncoder]:
+            encoder = encoder_cls(nstyle=5)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                styles = encoder(self.spec)
+                spec_out = Decoder(nstyle=5)(styles)
+            assert styles.dtype == torch.float32 # the style BatchNorm
+            assert spec_out.dtype == torch.bfloat16
+        descriptors = torch.randn(64, 3)
+        styles = (descriptors + torch.randn(64, 3)).requires_grad_(True)
+        loss = kendall_constraint(descriptors, styles)
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            loss_amp = kendall_constraint(descriptors, styles.bfloat16())
+        assert loss_amp.dtype == torch.float32
+        assert torch.isclose(loss_amp, loss, rtol=0.01)
+
+
+if __name__ == "__main__":
+    Test_MixedPrecision().test_fixture_models()
+    Test_MixedPrecision().test_fp32_parts()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.metrics import f1_score
+from sc.clustering.dataloader import AuxSpectraDataset
+import sc.report.analysis as analysis
+
+
+class Test_EvaluationCache():
+
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+
+    def write_dataset(self, csv_fn, n_spec=200, n_grid=256):
+        rng = np.random.default_rng(0)
+        aux = rng.random((n_spec, 5))
+        aux[:, 1] = rng.integers(4, 7, n_spec) # coordination number
+        columns = [f"AUX_{i}" for i in range(5)] + [f"ENE_{e:.2f}" for e in np.linspace(0, 30, n_grid)]
+        index = pd.MultiIndex.from_arrays([[f"mp-{i}" for i in range(n_spec)], rng.integers(0, 4, n_spec)])
+        df = pd.DataFrame(np.concatenate([aux, rng.random((n_spec, n_grid))], axis=1), index=index, columns=columns)
+        df.to_csv(csv_fn)
+        return AuxSpectraDataset(csv_fn, "train", train_val_test_ratios=(1, 0, 0), n_aux=5)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            test_ds = self.write_dataset(os.path.join(tmp, "data.csv"))
+            model_path = os.path.join(tmp, "training")
+            for job in ["job_1", "job_2"]:
+                os.makedirs(os.path.join(model_path, job))
+                shutil.copy(
+                    os.path.join(self.data_dir, "training", job, "final.pt"), os.path.join(model_path, job, "final.pt")
+                )
+            model_file = os.path.join(model_path, "job_1", "final.pt")
+            result = analysis.evaluate_all_models(model_path, test_ds)
+            assert sorted(result) == ["job_1", "job_2"]
+            data_hash = analysis.dataset_hash(test_ds)
+            cached = analysis.load_cached_evaluation(model_file, data_hash)
+            assert cached["Reconstruct Err"] == result["job_1"]["Reconstruct Err"]
+
+            os.utime(model_file) # same content, newer mtime
+            assert analysis.load_cached_evaluation(model_file, data_hash) is not None
+            test_ds.spec = test_ds.spec + 1.0 # other dataset
+            assert analysis.load_cached_evaluation(model_file, analysis.dataset_hash(test_ds)) is None
+            shutil.copy(os.path.join(model_path, "job_2", "final.pt"), model_file) # retrained model
+            assert analysis.load_cached_evaluation(model_file, data_hash) is None
+
+
+class Test_ConfusionMatrix():
+
+    rng = np.random.default_rng(0)
+    cn = rng.integers(4, 7, 300)
+    style_cn = np.round(rng.normal(cn - 5, 1.0), 1) # with ties
+    thresh_grid = np.linspace(-3.5, 3.5, 700)
+
+    def test_f1_score_curve(self):
+        cn_classes = self.cn - 4
+        cn4_f1_scores = [f1_score(self.style_cn < th, cn_classes<1, zero_division=0) for th in self.thresh_grid]
+        cn6_f1_scores = [f1_score(self.style_cn > th, cn_classes>1, zero_division=0) for th in self.thresh_grid]
+        assert np.allclose(analysis.f1_score_curve(self.style_cn, cn_classes<1, self.thresh_grid), cn4_f1_scores)
+        assert np.allclose(
+            analysis.f1_score_curve(self.style_cn, cn_classes>1, self.thresh_grid, greater=True), cn6_f1_scores
+        )
+        assert np.all(analysis.f1_score_curve(self.style_cn, np.zeros(300, dtype=bool), self.thresh_grid) == 0)
+
+    def test_exact_thresholds(self):
+        result = analysis.get_confusion_matrix(self.cn, self.style_cn)
+        cn45_f1_score = f1_score(self.style_cn < result["CN45 Threshold"], self.cn<5)
+        result_exact = analysis.get_confusion_matrix(self.cn, self.style_cn, exact_thresholds=True)
+        assert f1_score(self.style_cn < result_exact["CN45 Threshold"], self.cn<5) >= cn45_f1_score
+        assert result_exact["F1 score"] >= result["F1 score"] - 0.01
+
+
+if __name__ == "__main__":
+    Test_EvaluationCache().test_cache()
+    Test_ConfusionMatrix().test_f1_score_curve()
+    Test_ConfusionMatrix().test_exact_thresholds()
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import numpy as np
+from sc.clustering.dataloader import AuxSpectraDataset
+from sc.cmd.bench import make_synthetic_data
+from sc.cmd.bench_ops import CASES, run_benchmarks, compare_results
+
+
+class Test_Bench():
+
+    def test_synthetic_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "synthetic.csv")
+            make_synthetic_data(csv_fn, 200, n_aux=5, n_grid=64)
+            ds = AuxSpectraDataset(csv_fn, "train", n_aux=5)
+            assert ds.spec.shape == (140, 64) and ds.aux.shape == (140, 5)
+            assert np.allclose(ds.spec.mean(axis=1), 1.0, atol=1e-5)
+            assert set(np.unique(ds.aux[:, 1])) <= {4.0, 5.0, 6.0}
+            make_synthetic_data(csv_fn, 20, n_aux=0, n_grid=12)
+            assert AuxSpectraDataset(csv_fn, "train", n_aux=0).spec.shape == (14, 12)
+
+
+class Test_BenchOps():
+
+    def test_run_and_compare(self):
+        grid = {"batch_size": [16, 32], "nstyle": [5], "n_aux": [3]}
+        results = run_benchmarks(grid, cases=list(CASES), min_run_time=0.001)
+        assert len(results) == 2 * len(CASES)
+        assert results["kendall_constraint[batch_size=32,n_aux=3]"]["params"] == {"batch_size": 32, "n_aux": 3}
+        assert all(r["median"] > 0 for r in results.values())
+
+        baseline = {key: dict(r) for key, r in results.items()}
+        baseline["recon_loss[batch_size=16]"]["median"] = results["recon_loss[batch_size=16]"]["median"] / 2
+        del baseline["FCEncoder[batch_size=16,nstyle=5]"]
+        rows = compare_results(baseline, results, threshold=0.2)
+        assert len(rows) == 2 * len(CASES) - 1
+        assert rows[0][0] == "recon_loss[batch_size=16]" and abs(rows[0][3] - 2.0) < 1e-9 and rows[0][4]
+        assert sum(row[4] for row in rows) == 1
+
+
+if __name__ == "__main__":
+    Test_Bench().test_synthetic_data()
+    Test_BenchOps().test_run_and_compare()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import torch
+from torch import nn
+from sc.utils.checkpoint import CheckpointManager
+
+
+class Test_CheckpointManager():
+
+    def _train_and_save(self, asynchronous):
+        chkpt_dir = tempfile.mkdtemp()
+        model = nn.Linear(4, 2)
+        manager = CheckpointManager(chkpt_dir, {"Encoder": model}, top_k=2, asynchronous=asynchronous)
+        for epoch, metric in enumerate([0.1, 0.5, 0.3, 0.9, 0.7]):
+            with torch.no_grad():
+                model.bias.fill_(metric)
+            manager.save(metric, epoch)
+        manager.save_final(os.path.join(chkpt_dir, "final.pt"))
+        manager.save_best(os.path.join(chkpt_dir, "best.pt"))
+        manager.close()
+        return chkpt_dir
+
+    def test_top_k(self):
+        for asynchronous in [False, True]:
+            chkpt_dir = self._train_and_save(asynchronous)
+            files = sorted(f for f in os.listdir(chkpt_dir) if f.startswith("epoch_"))
+            assert files == ["epoch_000003_loss_00000.9.pt", "epoch_000004_loss_00000.7.pt"]
+            best = torch.load(os.path.join(chkpt_dir, "best.pt"), weights_only=False)
+            final = torch.load(os.path.join(chkpt_dir, "final.pt"), weights_only=False)
+            assert isinstance(best["Encoder"], nn.Linear)
+            assert torch.allclose(best["Encoder"].bias, torch.tensor(0.9))
+            assert torch.allclose(final["Encoder"].bias, torch.tensor(0.7))
+            assert not any(f.endswith(".tmp") for f in os.listdir(chkpt_dir))
+
+    def test_save_object(self):
+        chkpt_dir = tempfile.mkdtemp()
+        model = nn.Linear(4, 2)
+        manager = CheckpointManager(chkpt_dir, {"Encoder": model}, top_k=2)
+        manager.save(0.5, 0)
+        state = {"epoch": 1, "Encoder": model.state_dict(), "checkpoints": manager.state_dict()}
+        manager.save_object(state, os.path.join(chkpt_dir, "resume.pt"))
+        with torch.no_grad():
+            model.bias.fill_(1.0) # the saved object is a copy
+        manager.close()
+        resumed = torch.load(os.path.join(chkpt_dir, "resume.pt"), weights_only=False)
+        assert resumed["epoch"] == 1
+        assert not torch.allclose(resumed["Encoder"]["bias"], torch.tensor(1.0))
+        manager = CheckpointManager(chkpt_dir, {"Encoder": model}, top_k=2)
+        manager.load_state_dict(resumed["checkpoints"])
+        assert [m for m, _ in manager.checkpoints] == [0.5]
+        manager.close()
+
+    def test_load_state_dict(self):
+        # the checkpoints saved after the resumed state are deleted
+        chkpt_dir = tempfile.mkdtemp()
+        model = nn.Linear(4, 2)
+        manager = CheckpointManager(chkpt_dir, {"Encoder": model}, top_k=3, asynchronous=False, greater_is_better=False)
+        manager.save(0.5, 0)
+        manager.save(0.3, 1)
+        state = manager.state_dict()
+        manager.save(0.4, 2)
+        manager.save(0.1, 3) # deletes the checkpoint of epoch 0
+        with open(f"{chkpt_dir}/epoch_000004_loss_00000.2.pt.tmp", "w"): # interrupted while writing
+            pass
+        manager.close()
+        manager = CheckpointManager(chkpt_dir, {"Encoder": model}, top_k=3, asynchronous=False, greater_is_better=False)
+        manager.load_state_dict(state)
+        assert [m for m, _ in manager.checkpoints] == [0.3]
+        assert os.listdir(chkpt_dir) == ["epoch_000001_loss_00000.3.pt"]
+        manager.save(0.4, 2)
+        manager.close()
+        assert sorted(os.listdir(chkpt_dir)) == ["epoch_000001_loss_00000.3.pt", "epoch_000002_loss_00000.4.pt"]
+
+
+if __name__ == "__main__":
+    Test_CheckpointManager().test_top_k()
+    Test_CheckpointManager().test_save_object()
+    Test_CheckpointManager().test_load_state_dict()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+import torch
+from sc.clustering.dataloader import AuxSpectraDataset, TensorBatchLoader, get_cache_dir, build_spectra_cache
+
+
+def write_spectra_csv(file_path, n_spec=100, n_aux=3, n_grid=16):
+    rng = np.random.default_rng(0)
+    columns = [f"AUX_{i}" for i in range(n_aux)] + [f"ENE_{e:.1f}" for e in np.linspace(0, 30, n_grid)]
+    index = pd.MultiIndex.from_arrays([[f"mp-{i}" for i in range(n_spec)], rng.integers(0, 4, n_spec)])
+    df = pd.DataFrame(rng.random((n_spec, n_aux + n_grid)), index=index, columns=columns)
+    df.to_csv(file_path)
+
+
+class Test_SpectraCache():
+
+    tmp_dir = tempfile.mkdtemp()
+    data_file = os.path.join(tmp_dir, "spectra.csv")
+    write_spectra_csv(data_file)
+
+    def test_cache_matches_csv(self):
+        for portion in ["train", "val", "test"]:
+            ds_csv = AuxSpectraDataset(self.data_file, portion, n_aux=3, cache=False)
+            ds_cache = AuxSpectraDataset(self.data_file, portion, n_aux=3, cache=True)
+            assert os.path.isdir(get_cache_dir(self.data_file))
+            assert np.allclose(ds_csv.spec, ds_cache.spec, atol=1e-6)
+            assert np.allclose(ds_csv.aux, ds_cache.aux, atol=1e-6)
+            assert np.allclose(ds_csv.grid, ds_cache.grid)
+            assert ds_csv.atom_index == ds_cache.atom_index
+            assert isinstance(ds_cache.spec, np.memmap)
+
+    def test_cache_rebuilt_on_change(self):
+        data_file = os.path.join(self.tmp_dir, "changed.csv")
+        write_spectra_csv(data_file, n_spec=50)
+        assert len(AuxSpectraDataset(data_file, "train", n_aux=3, cache=True)) == 35
+        write_spectra_csv(data_file, n_spec=80)
+        assert len(AuxSpectraDataset(data_file, "train", n_aux=3, cache=True)) == 56
+
+    def test_concurrent_build(self):
+        data_file = os.path.join(self.tmp_dir, "concurrent.csv")
+        write_spectra_csv(data_file, n_spec=50)
+        cache_dir = build_spectra_cache(data_file)
+        data_path = os.path.join(cache_dir, "data.npy")
+        inode = os.stat(data_path).st_ino
+        # a process finding the cache valid right before replacing it keeps the other's files
+        build_spectra_cache(data_file)
+        assert os.stat(data_path).st_ino == inode
+        # a stale cache is replaced
+        write_spectra_csv(data_file, n_spec=80)
+        build_spectra_cache(data_file)
+        assert os.stat(data_path).st_ino != inode
+        assert not any(f.startswith(".tmp_") for f in os.listdir(self.tmp_dir))
+
+    def test_unwritable_cache(self):
+        data_file = os.path.join(self.tmp_dir, "unwritable.csv")
+        write_spectra_csv(data_file, n_spec=50)
+        with open(get_cache_dir(data_file), 'w') as f: # the cache cannot be created
+            f.write("not a directory")
+        try:
+            build_spectra_cache(data_file)
+            assert False
+        except OSError:
+            pass
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            ds = AuxSpectraDataset(data_file, "train", n_aux=3, cache=True)
+        assert len(ds) == 35 and not isinstance(ds.spec, np.memmap)
+        assert any("reading the csv file" in str(w.message) for w in caught)
+
+    def test_tensor_batch_loader(self):
+        ds = AuxSpectraDataset(self.data_file, "train", n_aux=3, cache=True)
+        loader = TensorBatchLoader(ds, batch_size=16, shuffle=True)
+        assert len(loader) == 5
+        batches = list(loader)
+        assert [len(spec) for spec, _ in batches] == [16, 16, 16, 16, 6]
+        spec = torch.cat([spec for spec, _ in batches]).numpy()
+        aux = torch.cat([aux for _, aux in batches]).numpy()
+        order = np.lexsort(spec.T)
+        assert np.allclose(spec[order], ds.spec[np.lexsort(ds.spec.T)])
+        assert np.allclose(aux[order], ds.aux[np.lexsort(ds.spec.T)])
+        spec_in, _ = batches[0]
+        spec_in += 1.0 # batches are copies
+        assert np.allclose(loader.spec.numpy(), ds.spec)
+
+
+if __name__ == "__main__":
+    Test_SpectraCache().test_cache_matches_csv()
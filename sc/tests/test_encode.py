@@ -0,0 +1,62 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+import sc.cmd.encode as encode
+
+
+class Test_Encode():
+
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+    model_file = os.path.join(data_dir, "training/job_1/final.pt")
+
+    def write_csv(self, file_path, n_spec=300, n_aux=2, n_grid=256):
+        rng = np.random.default_rng(0)
+        columns = [f"AUX_{i}" for i in range(n_aux)] + [f"ENE_{e:.2f}" for e in np.linspace(0, 30, n_grid)]
+        index = pd.MultiIndex.from_arrays([[f"mp-{i}" for i in range(n_spec)], rng.integers(0, 4, n_spec)])
+        df = pd.DataFrame(rng.random((n_spec, n_aux + n_grid)), index=index, columns=columns)
+        df.to_csv(file_path)
+        return df
+
+    def test_scan_and_iter(self):
+        encode.SCAN_GRANULE = 100
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                csv_fn = os.path.join(tmp, "spectra.csv")
+                df = self.write_csv(csv_fn, n_spec=250)
+                columns, n_rows, offsets = encode.scan_spectra_csv(csv_fn)
+                assert n_rows == 250 and len(offsets) == 3 and columns == df.columns.to_list()
+                chunks = list(encode.iter_spectra(csv_fn, 100, 150, 40, offset=offsets[1]))
+                assert [len(spec) for spec, _ in chunks] == [40, 40, 40, 30]
+                spec = np.concatenate([spec for spec, _ in chunks])
+                assert np.allclose(spec, df.iloc[100:, 2:].to_numpy(), atol=1e-6)
+                assert chunks[0][1][0] == list(df.index[100])
+        finally:
+            encode.SCAN_GRANULE = 1024
+
+    def test_encode_shards(self):
+        model = torch.load(self.model_file, map_location="cpu", weights_only=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "spectra.csv")
+            df = self.write_csv(csv_fn, n_spec=300)
+            np.lib.format.open_memmap(
+                os.path.join(tmp, "styles.npy"), mode='w+', dtype=np.float32, shape=(300, 6)
+            ).flush()
+            # two shards, the second one starts at the second line of data
+            _, _, offsets = encode.scan_spectra_csv(csv_fn)
+            with open(csv_fn, 'rb') as f:
+                f.readline()
+                f.readline()
+                offset_1 = f.tell()
+            encode.encode_shard(0, self.model_file, csv_fn, tmp, 0, 1, offset=offsets[0], batch_size=64)
+            encode.encode_shard(1, self.model_file, csv_fn, tmp, 1, 299, offset=offset_1, batch_size=64)
+            styles = np.load(os.path.join(tmp, "styles.npy"))
+        with torch.no_grad():
+            styles_ref = model["Encoder"].eval()(torch.tensor(df.iloc[:, 2:].to_numpy(), dtype=torch.float32))
+        assert np.allclose(styles, styles_ref.numpy(), atol=1e-5)
+
+
+if __name__ == "__main__":
+    Test_Encode().test_scan_and_iter()
+    Test_Encode().test_encode_shards()
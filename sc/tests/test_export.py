@@ -0,0 +1,64 @@
+import os
+import tempfile
+import torch
+from torch import nn
+from sc.clustering.model import FCEncoder, FCDecoder, Encoder, Decoder
+from sc.utils.export import fold_batchnorm, export_model
+
+
+def random_running_stats(model):
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm1d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2.0)
+    return model.eval()
+
+
+class Test_FoldBatchnorm():
+
+    torch.manual_seed(0)
+
+    def test_fold_fc(self):
+        for model, x in [
+            (FCEncoder(nstyle=5, n_layers=4), torch.rand(8, 256)), (FCDecoder(nstyle=5, n_layers=4), torch.randn(8, 5))
+        ]:
+            model = random_running_stats(model)
+            folded = fold_batchnorm(model, x)
+            assert not any(isinstance(m, (nn.BatchNorm1d, nn.Dropout)) for m in folded.modules())
+            assert torch.allclose(folded(x), model(x), atol=1e-5)
+
+    def test_fold_cnn(self):
+        for model, x in [
+            (Encoder(nstyle=5), torch.rand(8, 256)), 
+            (Decoder(nstyle=5, last_layer_activation="Softplus"), torch.randn(8, 5))
+        ]:
+            model = random_running_stats(model)
+            folded = fold_batchnorm(model, x)
+            n_bn = lambda m: sum(isinstance(l, nn.BatchNorm1d) for l in m.modules())
+            assert n_bn(folded) < n_bn(model) # the others are not exactly foldable
+            with torch.no_grad():
+                assert torch.allclose(folded(x), model(x), atol=1e-5)
+
+
+class Test_ExportModel():
+
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+
+    def test_export_fixture(self):
+        model = torch.load(
+            os.path.join(self.data_dir, "training/job_1/final.pt"), map_location="cpu", weights_only=False
+        )
+        encoder = model["Encoder"].eval()
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "encoder.ts")
+            export_model(encoder, torch.rand(2, 256), file_path)
+            exported = torch.jit.load(file_path)
+        spec = torch.rand(16, 256) # another batch size
+        with torch.no_grad():
+            assert torch.allclose(exported(spec), encoder(spec), atol=1e-4)
+
+
+if __name__ == "__main__":
+    Test_FoldBatchnorm().test_fold_fc()
+    Test_FoldBatchnorm().test_fold_cnn()
+    Test_ExportModel().test_export_fixture()
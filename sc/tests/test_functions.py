@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+from torch import nn
+from sc.clustering.model import GaussianSmoothing
+import itertools
+from scipy.stats import shapiro, spearmanr
+from sc.utils.functions import (
+    kendall_constraint, 
+    GaussianSmoother, 
+    get_gaussian_smoother, 
+    style_normality, 
+    style_coupling
+)
+
+
+def kendall_constraint_dense(descriptors, styles, activate=False):
+    """
+    Reference implementation materializing the full (B, B, n_aux) tensors.
+    """
+    n_aux = styles.shape[1]
+    aux_target = torch.sign(descriptors[:, np.newaxis, :] - descriptors[np.newaxis, :, :])
+    aux_pred = styles[:, np.newaxis, :] - styles[np.newaxis, :, :]
+    aux_len = aux_pred.size()[0]
+    product = aux_pred * aux_target
+    if activate:
+        full_same_sel = product > 0
+        full_opp_sel = product < 0
+        aux_indices = torch.arange(n_aux)
+        for i in range(n_aux):
+            aux_sel = aux_indices == i
+            n_same = max(torch.numel(product[full_same_sel & aux_sel]), 1)
+            n_opp = max(torch.numel(product[full_opp_sel & aux_sel]), 1)
+            product[full_same_sel & aux_sel] *= n_opp / max(n_same, n_opp)
+    return - product.sum() / ((aux_len**2 - aux_len) * n_aux)
+
+
+class Test_KendallConstraint():
+
+    torch.manual_seed(0)
+    descriptors = torch.randn(300, 4)
+    descriptors[:, 1] = torch.randint(4, 7, (300,)).float() # discrete descriptor with ties
+    styles = descriptors + torch.randn(300, 4)
+
+    def _loss_and_grad(self, fn, **kwargs):
+        styles = self.styles.clone().requires_grad_(True)
+        loss = fn(self.descriptors, styles, **kwargs)
+        loss.backward()
+        return loss.item(), styles.grad
+
+    def test_tiled_matches_dense(self):
+        for activate in [False, True]:
+            loss_ref, grad_ref = self._loss_and_grad(kendall_constraint_dense, activate=activate)
+            for chunk_size in [7, 64, 1000]:
+                loss, grad = self._loss_and_grad(kendall_constraint, activate=activate, chunk_size=chunk_size)
+                assert np.isclose(loss, loss_ref, rtol=1e-5, atol=1e-7)
+                assert torch.allclose(grad, grad_ref, rtol=1e-4, atol=1e-8)
+
+    def test_sampled_pairs(self):
+        torch.manual_seed(0)
+        loss_ref, _ = self._loss_and_grad(kendall_constraint_dense)
+        loss, grad = self._loss_and_grad(kendall_constraint, n_pairs=50000)
+        assert np.isclose(loss, loss_ref, rtol=0.05)
+        assert grad.shape == self.styles.shape
+
+
+class Test_GaussianSmoother():
+
+    spec = torch.rand(8, 256).cumsum(dim=1)
+
+    def _reference(self, kernel_size):
+        gaussian_smoothing = GaussianSmoothing(channels=1, kernel_size=kernel_size, sigma=3.0, dim=1)
+        padding4smooth = nn.ReplicationPad1d(padding=(kernel_size - 1)//2)
+        return gaussian_smoothing(padding4smooth(self.spec.unsqueeze(dim=1))).squeeze(dim=1)
+
+    def test_direct_and_fft_match(self):
+        for kernel_size in [17, 101]:
+            spec_ref = self._reference(kernel_size)
+            for method in ["direct", "fft", "auto"]:
+                spec_smoothed = GaussianSmoother(kernel_size, method=method)(self.spec)
+                assert spec_smoothed.shape == self.spec.shape
+                assert torch.allclose(spec_smoothed, spec_ref, atol=1e-4)
+
+    def test_smoother_cached(self):
+        assert get_gaussian_smoother(17) is get_gaussian_smoother(17)
+        assert get_gaussian_smoother(17) is not get_gaussian_smoother(17, method="fft")
+
+
+class Test_StyleMetrics():
+
+    torch.manual_seed(0)
+    styles = torch.randn(500, 5)
+    styles[:, 1] = styles[:, 0] + 0.5 * styles[:, 1]
+    styles[:, 2] = torch.rand(500) # not normal
+
+    def test_style_normality(self):
+        w = style_normality(self.styles).numpy()
+        w_ref = np.array([shapiro(x).statistic for x in self.styles.numpy().T])
+        assert np.allclose(w, w_ref, atol=5e-3)
+        assert np.argmin(w) == 2
+
+    def test_style_coupling(self):
+        corr, max_corr = style_coupling(self.styles)
+        style_np = self.styles.numpy().T
+        corr_ref = [
+            spearmanr(style_np[j1], style_np[j2]).correlation 
+            for j1, j2 in itertools.combinations(range(5), 2)
+        ]
+        assert np.allclose(corr.numpy()[np.triu_indices(5, 1)], corr_ref)
+        assert np.isclose(max_corr.item(), np.max(np.fabs(corr_ref)))
+
+
+if __name__ == "__main__":
+    Test_KendallConstraint().test_tiled_matches_dense()
@@ -0,0 +1,33 @@
+import tempfile
+import torch
+from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+from sc.utils.metrics_writer import MetricsWriter
+
+
+class Test_MetricsWriter():
+
+    def test_write(self):
+        for asynchronous in [False, True]:
+            log_dir = tempfile.mkdtemp()
+            writer = MetricsWriter(log_dir, asynchronous=asynchronous)
+            z = torch.randn(100, 2)
+            for epoch in range(5):
+                writer.add_scalars({"Train/Recon": 1.0 / (epoch + 1), "LR/reconstruction": torch.tensor(0.01)}, epoch)
+                if epoch % 2 == 0:
+                    writer.add_histograms({"Styles/Style_1": z[:, 0], "Styles/Style_2": z[:, 1]}, epoch)
+            z.fill_(0.0) # the histograms are computed from copies
+            writer.close()
+
+            events = EventAccumulator(log_dir, size_guidance={"scalars": 0, "histograms": 0})
+            events.Reload()
+            assert sorted(events.Tags()["scalars"]) == ["LR/reconstruction", "Train/Recon"]
+            assert [e.step for e in events.Scalars("Train/Recon")] == [0, 1, 2, 3, 4]
+            assert abs(events.Scalars("Train/Recon")[3].value - 0.25) < 1e-6
+            histograms = events.Histograms("Styles/Style_2")
+            assert [e.step for e in histograms] == [0, 2, 4]
+            assert histograms[0].histogram_value.num == 100
+            assert histograms[0].histogram_value.max > 0.0
+
+
+if __name__ == "__main__":
+    Test_MetricsWriter().test_write()
@@ -0,0 +1,63 @@
+import copy
+import torch
+from torch import nn
+from sc.utils.optim import SharedMomentAdamW
+
+
+class Test_SharedMomentAdamW():
+
+    def _steps(self, model, optimizers, n_steps=5):
+        torch.manual_seed(1)
+        for _ in range(n_steps):
+            x = torch.randn(8, 4)
+            for optimizer in optimizers:
+                model.zero_grad()
+                model(x).pow(2).mean().backward()
+                optimizer.step()
+
+    def test_matches_adamw(self):
+        torch.manual_seed(0)
+        model = nn.Linear(4, 3)
+        model_ref = copy.deepcopy(model)
+        self._steps(model, [SharedMomentAdamW(model.parameters(), lr=0.01, betas=(0.8, 0.99), weight_decay=0.1)])
+        self._steps(model_ref, [torch.optim.AdamW(model_ref.parameters(), lr=0.01, betas=(0.8, 0.99), weight_decay=0.1)])
+        for p, p_ref in zip(model.parameters(), model_ref.parameters()):
+            assert torch.allclose(p, p_ref, atol=1e-6)
+
+    def test_shared_state(self):
+        torch.manual_seed(0)
+        model = nn.Linear(4, 3)
+        shared_state = {}
+        optimizers = [
+            SharedMomentAdamW(model.parameters(), lr=0.01, shared_state=shared_state),
+            SharedMomentAdamW([model.weight], lr=0.1, betas=(0.0, 0.99), shared_state=shared_state)
+        ]
+        self._steps(model, optimizers, n_steps=1)
+        assert optimizers[0].state[model.weight] is optimizers[1].state[model.weight]
+        assert optimizers[0].state[model.weight]["step"] == 2
+        assert abs(optimizers[1].state[model.weight]["beta1_product"]) < 1e-12
+
+        # a resumed copy stays shared and in step with the original
+        model_resumed = copy.deepcopy(model)
+        shared_state_resumed = {}
+        optimizers_resumed = [
+            SharedMomentAdamW(model_resumed.parameters(), lr=0.01, shared_state=shared_state_resumed),
+            SharedMomentAdamW([model_resumed.weight], lr=0.1, betas=(0.0, 0.99), shared_state=shared_state_resumed)
+        ]
+        for optimizer, optimizer_resumed in zip(optimizers, optimizers_resumed):
+            optimizer_resumed.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+        assert optimizers_resumed[0].state[model_resumed.weight] is optimizers_resumed[1].state[model_resumed.weight]
+        self._steps(model, optimizers, n_steps=3)
+        self._steps(model_resumed, optimizers_resumed, n_steps=3)
+        for p, p_resumed in zip(model.parameters(), model_resumed.parameters()):
+            assert torch.allclose(p, p_resumed)
+
+        # a new set of optimizers of the same parameters starts from scratch
+        optimizer_new = SharedMomentAdamW(model.parameters(), lr=0.01, shared_state={})
+        assert len(optimizer_new.state[model.weight]) == 0
+        assert optimizer_new.state[model.weight] is not optimizers[0].state[model.weight]
+
+
+if __name__ == "__main__":
+    Test_SharedMomentAdamW().test_matches_adamw()
+    Test_SharedMomentAdamW().test_shared_state()
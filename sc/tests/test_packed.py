@@ -0,0 +1,145 @@
+import copy
+import os
+import tempfile
+import torch
+from torch import nn
+from sc.clustering.model import FCEncoder, FCDecoder, DiscriminatorFC, Encoder
+from sc.clustering.packed import pack_models, unpack_model, ReplicaLoss
+from sc.clustering.packed_trainer import PackedTrainer
+from sc.clustering.trainer import Trainer
+from sc.cmd.bench import make_synthetic_data
+from sc.utils.parameter import Parameters
+
+
+class Test_PackedModels():
+
+    n_replicas, batch_size = 3, 16
+
+    def _models(self, cls, **kwargs):
+        torch.manual_seed(0)
+        models = [cls(dropout_rate=0.0, **kwargs) for _ in range(self.n_replicas)]
+        return models, pack_models(models)
+
+    def test_forward_matches(self):
+        for cls, dim_in in [(FCEncoder, 256), (FCDecoder, 5)]:
+            models, packed = self._models(cls, n_layers=4)
+            x = torch.randn(self.n_replicas * self.batch_size, dim_in)
+            for training in [True, False]: # batch statistics and running statistics
+                packed.train(training)
+                out = packed(x)
+                out_ref = torch.cat([
+                    m.train(training)(x_k) for m, x_k in zip(models, x.split(self.batch_size))
+                ])
+                assert torch.allclose(out, out_ref, atol=1e-5)
+
+    def test_independent_gradients(self):
+        models, packed = self._models(DiscriminatorFC)
+        x = torch.randn(self.n_replicas * self.batch_size, 5)
+        target = torch.rand(self.n_replicas * self.batch_size)
+        packed.eval()
+        loss_fn = ReplicaLoss(nn.BCEWithLogitsLoss(), self.n_replicas)
+        loss = loss_fn(packed(x, None).squeeze(), target)
+        assert loss.shape == (self.n_replicas,)
+        loss.sum().backward()
+        for k, (m, x_k, t_k) in enumerate(zip(models, x.split(self.batch_size), target.split(self.batch_size))):
+            m.eval()
+            loss_k = nn.BCEWithLogitsLoss()(m(x_k, None).squeeze(), t_k)
+            loss_k.backward()
+            assert torch.isclose(loss[k], loss_k, atol=1e-6)
+            assert torch.allclose(packed.main[0].weight.grad[k], m.main[0].weight.grad, atol=1e-6)
+
+    def test_unpack(self):
+        models, packed = self._models(FCEncoder, n_layers=3)
+        packed.train()
+        packed(torch.randn(self.n_replicas * self.batch_size, 256)) # update the running statistics
+        model = unpack_model(packed, 1, FCEncoder(nstyle=5, n_layers=3))
+        packed.eval()
+        model.eval()
+        x = torch.randn(self.batch_size, 256)
+        assert torch.allclose(packed(x.repeat(self.n_replicas, 1))[self.batch_size:2*self.batch_size], model(x), atol=1e-5)
+
+    def test_conv_not_packed(self):
+        try:
+            pack_models([Encoder(), Encoder()])
+            assert False
+        except ValueError:
+            pass
+
+
+class Test_PackedTrainer():
+
+    n_replicas = 3
+
+    def test_step_matches(self):
+        # a packed training step of the replicas is the training step of each replica alone,
+        # the random samples of the losses (gaussian styles) are replayed from the single steps.
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "synthetic.csv")
+            make_synthetic_data(csv_fn, 200)
+            p = Parameters.from_yaml(os.path.join(os.path.dirname(__file__), "data/fix_config.yaml"))
+            # the first steps of RAdam are those of SGD with momentum, unlike Adam they do not blow
+            # up the rounding errors of the vanishing gradients (e.g. of the biases before a BatchNorm).
+            p.update({
+                "batch_size": 32, "verbose": False, "dropout_rate": 0.0, "dis_dropout_rate": 0.0, "dis_noise": 0.0,
+                "optimizer_name": "RAdam"
+            })
+            device = torch.device("cpu")
+            torch.manual_seed(0)
+            models = [Trainer.build_models(p, device) for _ in range(self.n_replicas)]
+            train_loader, val_loader = Trainer.get_loaders(csv_fn, p, device)
+            spec_in, aux_in = next(iter(train_loader))
+            randn = torch.randn
+
+            for gradient_reversal in [True, False]:
+                p.update({"gradient_reversal": gradient_reversal})
+                alpha_ = 0.5 if gradient_reversal else None
+                draws, losses, trainers = [], [], []
+                for k in range(self.n_replicas):
+                    trainer = Trainer(
+                        *copy.deepcopy(models[k]), device, train_loader, val_loader,
+                        verbose=False, work_dir=tmp, config_parameters=p
+                    )
+                    draws.append([])
+                    torch.randn = lambda *args, **kwargs: draws[-1].append(randn(*args, **kwargs)) or draws[-1][-1]
+                    try:
+                        mse_loss, nll_loss, bce_lgt_loss = trainer.loss_functions()
+                        losses.append(trainer.sequential_step(
+                            spec_in, aux_in, 0, alpha_, mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
+                        ))
+                    finally:
+                        torch.randn = randn
+                    trainers.append(trainer)
+
+                encoders, decoders, discriminators = zip(*copy.deepcopy(models))
+                packed = PackedTrainer(
+                    encoders, decoders, discriminators, device, train_loader, val_loader,
+                    verbose=False, work_dirs=[tmp] * self.n_replicas, config_parameters=p
+                )
+                replay = iter(zip(*draws))
+                torch.randn = lambda *args, **kwargs: torch.cat(next(replay))
+                try:
+                    mse_loss, nll_loss, bce_lgt_loss = packed.loss_functions()
+                    packed_losses = packed.sequential_step(
+                        spec_in.repeat(self.n_replicas, 1), aux_in.repeat(self.n_replicas, 1), 0, alpha_,
+                        mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
+                    )
+                finally:
+                    torch.randn = randn
+
+                for k, trainer in enumerate(trainers):
+                    for name, loss in losses[k].items():
+                        packed_loss = packed_losses[name].reshape(-1).expand(self.n_replicas)[k]
+                        assert torch.isclose(packed_loss.float(), loss.float(), rtol=1e-5, atol=1e-6), name
+                    replica = packed.replica_checkpoint_models(k)
+                    for model, replica_model in [
+                        (trainer.encoder, replica["Encoder"]),
+                        (trainer.decoder, replica["Decoder"]),
+                        (trainer.discriminator, replica["Style Discriminator"])
+                    ]:
+                        for (key, w), w_replica in zip(model.state_dict().items(), replica_model.state_dict().values()):
+                            assert torch.allclose(w, w_replica, rtol=1e-5, atol=1e-6), key
+
+
+if __name__ == "__main__":
+    Test_PackedModels().test_forward_matches()
+    Test_PackedTrainer().test_step_matches()
@@ -0,0 +1,46 @@
+import os
+from sc.utils.parallel import get_executor
+from sc.utils.affinity import plan_cpu_sets, available_cpus
+
+
+def get_affinity(_):
+    return sorted(os.sched_getaffinity(0))
+
+
+class Test_Executor():
+
+    def test_map_unordered(self):
+        for name in ["serial", "process"]:
+            executor = get_executor(name, n_workers=2, num_threads=1)
+            result = executor.map_unordered(pow, [1, 2, 3, 4], [2] * 4)
+            assert sorted(result) == [1, 4, 9, 16]
+            executor.shutdown()
+
+    def test_cpu_sets(self):
+        cpu_sets = [[cpu] for cpu in available_cpus()[:2]]
+        executor = get_executor("process", cpu_sets=cpu_sets)
+        assert executor.n_workers == len(cpu_sets)
+        affinities = list(executor.map_unordered(get_affinity, range(len(cpu_sets))))
+        assert all(a in cpu_sets for a in affinities)
+        executor.shutdown()
+
+
+class Test_CpuPlan():
+
+    cpus = list(range(64))
+
+    def test_even_split(self):
+        cpu_sets = plan_cpu_sets(8, cpus=self.cpus)
+        assert len(cpu_sets) == 8 and all(len(s) == 8 for s in cpu_sets)
+        assert sorted(sum(cpu_sets, [])) == self.cpus
+
+    def test_threads_per_trial(self):
+        cpu_sets = plan_cpu_sets(100, threads_per_trial=4, cpus=self.cpus)
+        assert len(cpu_sets) == 16
+        assert len(set(sum(cpu_sets, []))) == 64
+        assert plan_cpu_sets(3, threads_per_trial=128, cpus=self.cpus) == [self.cpus]
+        assert len(plan_cpu_sets(100, cpus=self.cpus[:4])) == 4
+
+
+if __name__ == "__main__":
+    Test_CpuPlan().test_even_split()
@@ -0,0 +1,29 @@
+import tempfile
+from sc.utils.pruning import MedianPruner
+
+
+class Test_MedianPruner():
+
+    weights = [1.0, 0.0, 0.0, 0.0, 0.0] # the combined metric is the first metric
+
+    def test_prune_below_median(self):
+        record_dir = tempfile.mkdtemp()
+        for trial, metric in enumerate([0.5, 0.6, 0.7, 0.8]):
+            pruner = MedianPruner(record_dir, trial, self.weights, warmup_epochs=10, interval=10, min_trials=3)
+            stops = [pruner(epoch, [metric, 0, 0, 0, 0]) for epoch in range(30)]
+            assert not any(stops)
+        pruner = MedianPruner(record_dir, 4, self.weights, warmup_epochs=10, interval=10, min_trials=3)
+        stops = [pruner(epoch, [0.55, 0, 0, 0, 0]) for epoch in range(30)]
+        assert stops.index(True) == 10 # the first check after the warmup
+        pruner = MedianPruner(record_dir, 5, self.weights, warmup_epochs=10, interval=10, min_trials=3)
+        assert not any(pruner(epoch, [0.75, 0, 0, 0, 0]) for epoch in range(30))
+
+    def test_min_trials(self):
+        record_dir = tempfile.mkdtemp()
+        MedianPruner(record_dir, 0, self.weights, warmup_epochs=0, interval=1)(0, [0.9, 0, 0, 0, 0])
+        pruner = MedianPruner(record_dir, 1, self.weights, warmup_epochs=0, interval=1, min_trials=2)
+        assert not pruner(0, [0.1, 0, 0, 0, 0])
+
+
+if __name__ == "__main__":
+    Test_MedianPruner().test_prune_below_median()
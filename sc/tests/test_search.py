@@ -0,0 +1,130 @@
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+import torch
+from sc.cmd.bench import make_synthetic_data
+from sc.cmd.opt_hyper_single import run_trial, set_deadline
+from sc.utils.parameter import Parameters
+from sc.utils.search import SearchSpace, Study, AshaCallback
+
+
+class Test_SearchSpace:
+
+    space = SearchSpace({
+        "lr_ratio_Reconn": {"type": "float", "low": 0.5, "high": 4.0, "log": True},
+        "dropout_rate": {"type": "float", "low": 0.0, "high": 0.3},
+        "n_layers": {"type": "int", "low": 3, "high": 6},
+        "optimizer_name": {"type": "categorical", "choices": ["Adam", "AdamW"]},
+    })
+
+    def test_sample(self):
+        for seed in range(20):
+            params = self.space.sample(seed)
+            assert 0.5 <= params["lr_ratio_Reconn"] <= 4.0
+            assert 0.0 <= params["dropout_rate"] <= 0.3
+            assert params["n_layers"] in [3, 4, 5, 6]
+            assert params["optimizer_name"] in ["Adam", "AdamW"]
+        assert self.space.sample(1) == self.space.sample(1)
+        assert self.space.sample(1) != self.space.sample(2)
+
+
+class Test_Study:
+
+    def test_trials(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            study = Study(os.path.join(tmp, "study.db"))
+            study.add_trial(0, {"a": 1.0})
+            study.add_trial(1, {"a": 2.0})
+            study.add_trial(0, {"a": 3.0}) # already in the study
+            study.set_state(0, "COMPLETE", value=0.5, metrics=[1.0, None], time=2.0)
+            study.set_state(1, "RUNNING")
+            # a new connection sees the same trials
+            study = Study(os.path.join(tmp, "study.db"))
+            trials = study.trials()
+            assert [t["params"]["a"] for t in trials] == [1.0, 2.0]
+            assert trials[0]["metrics"] == [1.0, None]
+            assert [t["trial_id"] for t in study.trials(Study.FINISHED)] == [0]
+            assert study.best_trial()["trial_id"] == 0
+            study.report(1, 0, 0.1)
+            study.reset_trial(1)
+            assert study.trials()[1]["state"] == "WAITING"
+            assert study.best_value(1) is None
+
+
+class Test_AshaCallback:
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "study.db")
+            weights = [0.0, 0.0, 0.0, 0.0, -1.0] # the combined metric is the last metric
+            callbacks = [
+                AshaCallback(path, k, weights, min_epochs=2, reduction_factor=2, min_trials=2) for k in range(4)
+            ]
+            callbacks = [pickle.loads(pickle.dumps(c)) for c in callbacks]
+            assert [callbacks[0].rung(e) for e in [1, 2, 3, 4, 8]] == [None, 0, None, 1, 2]
+            for k, c in enumerate(callbacks):
+                assert not c(1, [0.0, 0.0, 0.0, 0.0, float(k)])
+            # the first trial at the rung is not pruned, there are too few trials to compare
+            assert not callbacks[3](2, [0.0, 0.0, 0.0, 0.0, 3.0])
+            assert not callbacks[0](2, [0.0, 0.0, 0.0, 0.0, 0.0])
+            assert callbacks[2](2, [0.0, 0.0, 0.0, 0.0, 2.0])
+            assert not callbacks[1](2, [0.0, 0.0, 0.0, 0.0, 1.0])
+            assert callbacks[2].pruned and not callbacks[1].pruned
+            assert np.isclose(Study(path).best_value(2), 2.0)
+
+    def test_deadline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "study.db")
+            callback = AshaCallback(path, 0, [0.0, 0.0, 0.0, 0.0, -1.0], min_epochs=100)
+            assert not callback(10, [0.0] * 5)
+            Study(path).set_meta("deadline", 0.0)
+            assert not callback(11, [0.0] * 5) # checked every 10 epochs
+            assert callback(20, [0.0] * 5) and callback.timed_out
+
+
+class Test_RunTrial:
+
+    def test_set_deadline(self):
+        # a rerun of the search keeps the deadline of its first run
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "study.db")
+            start = time.time()
+            deadline = set_deadline(Study(path), 2)
+            assert start <= deadline - 2 * 3600 <= time.time()
+            time.sleep(0.01)
+            study = Study(path)
+            assert set_deadline(study, 2) == deadline
+            assert study.get_meta("deadline") == deadline
+            assert set_deadline(study, 1) == deadline - 3600
+            assert set_deadline(study, 0) is None and study.get_meta("deadline") is None
+
+    def test_deadline_alarm(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_synthetic_data(os.path.join(tmp, "synthetic.csv"), 200)
+            base_config = Parameters.from_yaml(os.path.join(os.path.dirname(__file__), "data/fix_config.yaml")).to_dict()
+            base_config.update({
+                "data_file": "synthetic.csv", "max_epoch": 10000, "batch_size": 32, "verbose": False, "resume_interval": 0
+            })
+            path = os.path.join(tmp, "study.db")
+            study = Study(path)
+            study.add_trial(0, {})
+            study.set_meta("deadline", time.time() + 5)
+            # the alarm goes off at the deadline, long before the trial timeout or the deadline check of the callback.
+            trial_id, state, value = run_trial(
+                0, tmp, base_config, {}, path, {"min_epochs": 10**6}, timeout_hours=10,
+                num_threads=torch.get_num_threads()
+            )
+            assert (trial_id, state) == (0, "TIMEOUT")
+            assert value is not None and np.isclose(study.trials()[0]["value"], value)
+            assert study.trials()[0]["state"] == "TIMEOUT"
+
+
+if __name__ == "__main__":
+    Test_SearchSpace().test_sample()
+    Test_Study().test_trials()
+    Test_AshaCallback().test_prune()
+    Test_AshaCallback().test_deadline()
+    Test_RunTrial().test_set_deadline()
+    Test_RunTrial().test_deadline_alarm()
@@ -0,0 +1,311 @@
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import torch
+from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+from sc.clustering.trainer import Trainer
+from sc.cmd.train_sc import time_epochs
+from sc.utils.functions import style_normality, style_coupling
+from sc.utils.parameter import Parameters
+from sc.utils.logger import create_logger
+
+
+data_dir = os.path.join(os.path.dirname(__file__), "data")
+
+
+def write_fixture_data(csv_fn, n_spectra=200):
+    """
+    Spectra decoded by the trained test models from random styles, the first five styles are
+    the descriptors (AUX_*).
+    """
+    models = torch.load(os.path.join(data_dir, "training/job_1/final.pt"), map_location="cpu", weights_only=False)
+    z = torch.randn(n_spectra, 6, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        spec = models["Decoder"].eval()(z).numpy()
+    columns = [f"AUX_{i}" for i in range(5)] + [f"ENE_{e:.4f}" for e in np.linspace(0, 30, spec.shape[1])]
+    index = pd.MultiIndex.from_arrays([[f"fixture-{i}" for i in range(n_spectra)], np.zeros(n_spectra, dtype=int)])
+    pd.DataFrame(np.concatenate([z[:, :5].numpy(), spec], axis=1), index=index, columns=columns).to_csv(csv_fn)
+
+
+def make_config(**config):
+    p = Parameters.from_yaml(os.path.join(data_dir, "fix_config.yaml"))
+    p.update({"max_epoch": 6, "batch_size": 32, "verbose": False, "async_checkpoint": False})
+    p.update(config)
+    return p
+
+
+def make_trainer(work_dir, csv_fn, **config):
+    torch.manual_seed(0)
+    return Trainer.from_data(csv_fn, verbose=False, work_dir=work_dir, config_parameters=make_config(**config))
+
+
+def load_weights(file_path):
+    models = torch.load(file_path, map_location="cpu", weights_only=False)
+    return {name: model.state_dict() for name, model in models.items()}
+
+
+class Test_Trainer():
+
+    def test_best_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            trainer = make_trainer(tmp, csv_fn, resume_interval=6)
+            combined_metrics = []
+            trainer.train(
+                callback=lambda epoch, metrics: combined_metrics.append(
+                    - (np.array(Trainer.metric_weights) * np.array(metrics)).sum()
+                )
+            )
+
+            best_epoch = int(np.argmin(combined_metrics))
+            loop_state = torch.load(os.path.join(tmp, "resume.pt"), weights_only=False)["loop"]
+            assert loop_state["early_stop"][1] == best_epoch
+            chkpt_files = sorted(os.listdir(os.path.join(tmp, "checkpoints")))
+            assert 0 < len(chkpt_files) <= trainer.checkpoint_top_k
+            best_file = [f for f in chkpt_files if f.startswith(f"epoch_{best_epoch:06d}_")]
+            assert len(best_file) == 1
+            assert os.path.exists(os.path.join(tmp, "best.pt"))
+            best, expected = load_weights(os.path.join(tmp, "best.pt")), load_weights(
+                os.path.join(tmp, "checkpoints", best_file[0])
+            )
+            for name in expected:
+                for key in expected[name]:
+                    assert torch.equal(best[name][key], expected[name][key])
+
+    def test_amp(self):
+        # a short training in mixed precision follows the fp32 one.
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            recon = {}
+            for amp_dtype in [None, "bfloat16", "float16"]:
+                work_dir = os.path.join(tmp, str(amp_dtype))
+                os.makedirs(work_dir)
+                trainer = make_trainer(
+                    work_dir, csv_fn, max_epoch=8, resume_interval=8, amp=amp_dtype is not None, amp_dtype=amp_dtype
+                )
+                all_metrics = []
+                trainer.train(callback=lambda epoch, metrics: all_metrics.append(metrics))
+                assert np.isfinite(all_metrics).all()
+                recon[amp_dtype] = min(metrics[Trainer.metric_names.index("Recon")] for metrics in all_metrics)
+                # only fp16 scales the gradients
+                grad_scaler_state = torch.load(os.path.join(work_dir, "resume.pt"), weights_only=False)["grad_scaler"]
+                assert (grad_scaler_state is not None) == (amp_dtype == "float16")
+                if grad_scaler_state is not None:
+                    assert grad_scaler_state["scale"] > 0
+            assert recon["bfloat16"] < 2 * recon[None] and recon["float16"] < 2 * recon[None]
+
+    def test_amp_normal(self):
+        # the CNN models of the "normal" form, built by `Trainer.from_data`
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            for amp_dtype in [None, "bfloat16", "float16"]:
+                work_dir = os.path.join(tmp, str(amp_dtype))
+                os.makedirs(work_dir)
+                trainer = make_trainer(
+                    work_dir, csv_fn, ae_form="normal", max_epoch=1, batch_size=64, resume_interval=0,
+                    amp=amp_dtype is not None, amp_dtype=amp_dtype
+                )
+                assert type(trainer.encoder).__name__ == "Encoder"
+                metrics = trainer.train()
+                assert np.isfinite(metrics).all()
+                assert os.path.exists(os.path.join(work_dir, "final.pt"))
+
+    def test_fused_step(self):
+        # without learning, dropout and noise, the fused step computes the losses of the
+        # sequential step, with or without gradient reversal.
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            for gradient_reversal in [True, False]:
+                losses = {}
+                for train_step in ["sequential", "fused"]:
+                    trainer = make_trainer(
+                        tmp, csv_fn, train_step=train_step, gradient_reversal=gradient_reversal, lr_base=0.0,
+                        dropout_rate=0.0, dis_dropout_rate=0.0, dis_noise=0.0
+                    )
+                    spec_in, aux_in = next(iter(trainer.train_loader))
+                    mse_loss, nll_loss, bce_lgt_loss = trainer.loss_functions()
+                    step = trainer.fused_step if train_step == "fused" else trainer.sequential_step
+                    torch.manual_seed(1)
+                    losses[train_step] = {
+                        name: loss.item() for name, loss in step(
+                            spec_in, aux_in, 0, 0.5 if gradient_reversal else None,
+                            mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
+                        ).items()
+                    }
+                assert np.isfinite(list(losses["fused"].values())).all()
+                for name, loss in losses["sequential"].items():
+                    assert np.isclose(losses["fused"][name], loss, rtol=1e-5, atol=1e-6), name
+
+    def test_val_chunks(self):
+        # the validation in chunks gives the styles, losses and metrics of the whole set at once.
+        # The gaussian styles of the mutual information loss are read in order from a fixed
+        # sample, those of the adversarial loss are drawn per chunk and its value is not compared.
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            trainer = make_trainer(tmp, csv_fn)
+            trainer.encoder.eval()
+            trainer.decoder.eval()
+            trainer.discriminator.eval()
+            mse_loss, nll_loss, bce_lgt_loss = trainer.loss_functions()
+            z_sample = torch.randn(1000, 6)
+            randn = torch.randn
+            results = {}
+            for val_chunk_size in [None, 7]:
+                trainer.val_chunk_size = val_chunk_size
+                n_drawn = [0]
+
+                def replay(*size, requires_grad=False, **kwargs):
+                    if requires_grad: # the real gaussian styles of the adversarial loss
+                        return randn(*size, requires_grad=requires_grad, **kwargs)
+                    n_drawn[0] += size[0]
+                    return z_sample[n_drawn[0]-size[0]:n_drawn[0]]
+
+                torch.randn = replay
+                try:
+                    z, losses = trainer.validate(
+                        0.5, mse_loss=mse_loss, nll_loss=nll_loss, bce_lgt_loss=bce_lgt_loss
+                    )
+                finally:
+                    torch.randn = randn
+                results[val_chunk_size] = z, losses, [style_normality(z).min(), style_coupling(z)[1]]
+            (z, losses, metrics), (z_chunked, losses_chunked, metrics_chunked) = results[None], results[7]
+            assert z.size()[0] > 7
+            assert torch.allclose(z_chunked, z, atol=1e-6)
+            for name in ["Recon", "Smooth", "Mutual_Info", "Aux"]:
+                assert torch.isclose(losses_chunked[name], losses[name], rtol=1e-5, atol=1e-7), name
+            assert np.isfinite(losses_chunked["D"].item())
+            for metric, metric_chunked in zip(metrics, metrics_chunked):
+                assert torch.isclose(metric_chunked, metric, rtol=1e-5, atol=1e-7)
+
+    def test_check_finite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            trainer = make_trainer(tmp, csv_fn, max_epoch=1, resume_interval=0, check_finite=True)
+            with torch.no_grad():
+                trainer.decoder.main[0].weight[0, 0] = float("nan")
+            try:
+                trainer.train()
+                assert False
+            except RuntimeError as e:
+                assert "Non-finite" in str(e)
+
+    def test_grad_norms(self):
+        # the average gradient norms of the optimizers are written with the metrics
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            for train_step, names in [
+                ("sequential", ["adversarial", "correlation", "reconstruction", "mutual_info", "smoothness"]),
+                ("fused", ["fused"])
+            ]:
+                work_dir = os.path.join(tmp, train_step)
+                os.makedirs(work_dir)
+                trainer = make_trainer(
+                    work_dir, csv_fn, max_epoch=2, resume_interval=0, train_step=train_step,
+                    record_grad_norm=True, tensorboard=True
+                )
+                trainer.train()
+                events = EventAccumulator(os.path.join(work_dir, "runs"), size_guidance={"scalars": 0})
+                events.Reload()
+                tags = [tag for tag in events.Tags()["scalars"] if tag.startswith("GradNorm/")]
+                assert sorted(tags) == sorted(f"GradNorm/{name}" for name in names)
+                for tag in tags:
+                    norms = events.Scalars(tag)
+                    assert [e.step for e in norms] == [0, 1]
+                    assert all(np.isfinite(e.value) and e.value > 0 for e in norms)
+
+    def test_train_loss_log(self):
+        # the training losses of `losses.csv` are the epoch means of the losses of the batches
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            trainer = make_trainer(tmp, csv_fn, max_epoch=3, resume_interval=0, loss_log_interval=1)
+            loss_file = os.path.join(tmp, "losses.csv")
+            trainer.loss_logger = create_logger("test_train_loss_log", loss_file, simple_fmt=True)
+            batch_losses = defaultdict(list)
+            sequential_step = trainer.sequential_step
+
+            def recorded_step(*args, **kwargs):
+                losses = sequential_step(*args, **kwargs)
+                batch_losses[trainer.epoch].append([losses[name].item() for name in trainer.loss_names])
+                return losses
+
+            trainer.sequential_step = recorded_step
+            try:
+                trainer.train()
+            finally:
+                for handler in list(trainer.loss_logger.handlers):
+                    handler.close()
+                    trainer.loss_logger.removeHandler(handler)
+            with open(loss_file) as f:
+                lines = f.read().splitlines()[1:]
+            assert len(lines) == 3
+            for line in lines:
+                values = [float(x) for x in line.split(",") if x.strip()]
+                epoch, train_losses = int(values[0]), values[1::2]
+                assert len(batch_losses[epoch]) == len(trainer.train_loader)
+                assert np.allclose(train_losses, np.mean(batch_losses[epoch], axis=0), rtol=1e-5, atol=1e-6)
+
+    def test_resume(self):
+        # a training resumed from its state at half way ends with the same weights, which needs
+        # `load_state_dict` to restore the RNG after caching the validation set.
+        for train_step in ["sequential", "fused"]:
+            with tempfile.TemporaryDirectory() as tmp:
+                csv_fn = os.path.join(tmp, "fixture.csv")
+                write_fixture_data(csv_fn)
+                work_dirs = [os.path.join(tmp, "full"), os.path.join(tmp, "resumed")]
+                for work_dir in work_dirs:
+                    os.makedirs(work_dir)
+                half_state = os.path.join(tmp, "half.pt")
+
+                def save_half(epoch, metrics):
+                    if epoch == 3: # resume.pt was saved at the end of epoch 2
+                        shutil.copy(os.path.join(work_dirs[0], "resume.pt"), half_state)
+
+                trainer = make_trainer(work_dirs[0], csv_fn, train_step=train_step, resume_interval=3)
+                trainer.train(callback=save_half)
+                resumed = make_trainer(work_dirs[1], csv_fn, train_step=train_step, resume_interval=3)
+                resumed.load_state_dict(torch.load(half_state, weights_only=False))
+                assert resumed.start_epoch == 3
+                resumed.train()
+                for model, model_resumed in [
+                    (trainer.encoder, resumed.encoder),
+                    (trainer.decoder, resumed.decoder),
+                    (trainer.discriminator, resumed.discriminator)
+                ]:
+                    for p, p_resumed in zip(model.state_dict().values(), model_resumed.state_dict().values()):
+                        assert torch.equal(p, p_resumed)
+
+    def test_time_epochs(self):
+        # a benchmark trial of `train_sc --benchmark_threads`
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_fn = os.path.join(tmp, "fixture.csv")
+            write_fixture_data(csv_fn)
+            config = make_config(max_epoch=3, checkpoint_top_k=0, resume_interval=0)
+            epoch_time = time_epochs(0, tmp, config, False, csv_fn, timeout_hours=1)
+            assert epoch_time > 0
+            job_dir = os.path.join(tmp, "training/job_1")
+            assert os.listdir(os.path.join(job_dir, "checkpoints")) == []
+            assert not os.path.exists(os.path.join(job_dir, "resume.pt"))
+
+
+if __name__ == "__main__":
+    Test_Trainer().test_best_checkpoint()
+    Test_Trainer().test_amp()
+    Test_Trainer().test_amp_normal()
+    Test_Trainer().test_fused_step()
+    Test_Trainer().test_val_chunks()
+    Test_Trainer().test_check_finite()
+    Test_Trainer().test_grad_norms()
+    Test_Trainer().test_train_loss_log()
+    Test_Trainer().test_resume()
+    Test_Trainer().test_time_epochs()
@@ -0,0 +1,77 @@
+import os
+import math
+
+
+def available_cpus():
+    """
+    The CPUs this process may run on, limited to the CPU quota of the cgroup if there is one.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = cpus[:max(quota, 1)]
+    return cpus
+
+
+def cgroup_cpu_quota():
+    """
+    The CPU quota (rounded up to whole CPUs) of the cgroup, or `None` if unlimited.
+    """
+    try: # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota == "max":
+            return None
+        return math.ceil(int(quota) / int(period))
+    except (OSError, ValueError):
+        pass
+    try: # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota <= 0:
+            return None
+        return math.ceil(quota / period)
+    except (OSError, ValueError):
+        return None
+
+
+def plan_cpu_sets(n_trials, threads_per_trial=None, cpus=None):
+    """
+    Split the available CPUs into disjoint sets, one per concurrent trial.
+
+    Parameters
+    ----------
+    n_trials : int
+        The number of trials to run.
+    threads_per_trial : int
+        The number of CPUs (and torch threads) of each trial. If `None`, the CPUs are shared
+        evenly among `n_trials` concurrent trials.
+    cpus : list
+        The CPUs to split, `available_cpus()` by default.
+
+    Returns
+    -------
+    cpu_sets : list of lists
+        The CPU set of each concurrent trial, there are at most `n_trials` of them.
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    if threads_per_trial is None:
+        threads_per_trial = max(len(cpus) // max(n_trials, 1), 1)
+    threads_per_trial = min(threads_per_trial, len(cpus))
+    n_concurrent = min(len(cpus) // threads_per_trial, n_trials)
+    return [
+        cpus[i * threads_per_trial: (i + 1) * threads_per_trial] for i in range(n_concurrent)
+    ]
+
+
+def format_plan(cpu_sets):
+    lines = [f"CPU plan: {len(cpu_sets)} concurrent trial(s) x {len(cpu_sets[0])} thread(s)."]
+    for i, cpu_set in enumerate(cpu_sets):
+        lines.append(f"  worker {i}: CPUs {','.join(str(c) for c in cpu_set)}")
+    return "\n".join(lines)
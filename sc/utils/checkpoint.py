@@ -0,0 +1,193 @@
+import os
+import copy
+import glob
+import shutil
+import threading
+import torch
+
+
+def atomic_save(obj, file_path):
+    """
+    `torch.save` to a temporary file and rename it, so that `file_path` is never half written.
+    """
+    tmp_path = f"{file_path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def to_cpu(obj):
+    """
+    Recursively copy the tensors in (nested dictionaries/lists of) `obj` to the CPU memory.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return obj.__class__((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager():
+    """
+    Write model checkpoints on a background thread.
+
+    `save` only snapshots the `state_dict`s of the models to the CPU memory, the snapshot is then
+    loaded into CPU copies of the models and pickled (the same `{name: nn.Module}` format as
+    before, so the checkpoints load with `torch.load`) and renamed into place by the writer thread.
+    Only the `top_k` best checkpoints are kept on disk: worse files are deleted, and pending
+    snapshots that already fell out of the top `top_k` are dropped without being written.
+    """
+
+    def __init__(self, chkpt_dir, models, top_k=3, asynchronous=True, greater_is_better=True):
+        self.chkpt_dir = chkpt_dir
+        self.models = models
+        self.top_k = top_k
+        self.asynchronous = asynchronous
+        self.greater_is_better = greater_is_better
+        self.checkpoints = [] # (metric, path) of the checkpoint files on disk
+        # CPU copies of the models that the snapshots are loaded into before pickling.
+        self._templates = {}
+        for name, model in models.items():
+            template = copy.deepcopy(model).cpu()
+            for p in template.parameters():
+                p.grad = None
+            self._templates[name] = template
+        self._pending = []
+        self._writing = None
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        if asynchronous:
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+
+    def snapshot(self):
+        return {
+            name: (model.training, to_cpu(model.state_dict())) for name, model in self.models.items()
+        }
+
+    def save(self, metric, epoch):
+        """
+        Checkpoint the models as `epoch_{epoch}_loss_{metric}.pt`.
+        """
+        file_path = f"{self.chkpt_dir}/epoch_{epoch:06d}_loss_{metric:07.6g}.pt"
+        self._submit({"path": file_path, "metric": metric, "snapshot": self.snapshot()})
+        return file_path
+
+    def save_final(self, file_path):
+        """
+        Save the current models to `file_path` regardless of the metric.
+        """
+        self._submit({"path": file_path, "metric": None, "snapshot": self.snapshot()})
+
+    def save_object(self, obj, file_path):
+        """
+        Save any (nested) object of tensors, e.g. a training state, the tensors are copied to CPU
+        memory before returning.
+        """
+        self._submit({"path": file_path, "metric": None, "object": to_cpu(obj)})
+
+    def save_best(self, file_path):
+        """
+        Copy the best checkpoint (if any) to `file_path`, once all pending writes are done.
+        """
+        self.flush()
+        if len(self.checkpoints) > 0:
+            shutil.copy2(self.checkpoints[0][1], file_path)
+
+    def state_dict(self):
+        """
+        The best checkpoints, including the pending ones (`load_state_dict` skips the files that
+        were never written).
+        """
+        with self._cond:
+            ranked = self._rank(
+                self.checkpoints + [(j["metric"], j["path"]) for j in self._pending if j["metric"] is not None]
+            )
+        return {"checkpoints": ranked[:self.top_k]}
+
+    def load_state_dict(self, state):
+        """
+        Restore the best checkpoints of `state`. The other checkpoint files of `chkpt_dir`, saved
+        after `state` by the interrupted run, are deleted so that they do not outlive the top `top_k`.
+        """
+        self.checkpoints = [
+            (metric, path) for metric, path in state["checkpoints"] if os.path.exists(path)
+        ]
+        kept = set(os.path.abspath(path) for _, path in self.checkpoints)
+        for path in glob.glob(os.path.join(self.chkpt_dir, "epoch_*_loss_*.pt*")):
+            if os.path.abspath(path) not in kept and (path.endswith(".pt") or path.endswith(".pt.tmp")):
+                os.remove(path)
+
+    def flush(self):
+        """
+        Block until all the submitted checkpoints are written.
+        """
+        with self._cond:
+            while len(self._pending) > 0 or self._writing is not None:
+                self._cond.wait()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to write checkpoint.") from error
+
+    def _rank(self, jobs):
+        return sorted(jobs, key=lambda job: job[0], reverse=self.greater_is_better)
+
+    def _submit(self, job):
+        self._raise_error()
+        if not self.asynchronous:
+            self._write(job)
+            return
+        with self._cond:
+            self._pending.append(job)
+            if job["metric"] is not None:
+                # drop the pending snapshots that would be deleted right after being written.
+                ranked = self._rank(
+                    self.checkpoints + [(j["metric"], j["path"]) for j in self._pending if j["metric"] is not None]
+                )
+                keep = set(path for _, path in ranked[:self.top_k])
+                self._pending = [j for j in self._pending if j["metric"] is None or j["path"] in keep]
+            self._cond.notify_all()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while len(self._pending) == 0 and not self._closed:
+                    self._cond.wait()
+                if len(self._pending) == 0:
+                    return
+                self._writing = self._pending.pop(0)
+            try:
+                self._write(self._writing)
+            except Exception as e:
+                self._error = e
+            with self._cond:
+                self._writing = None
+                self._cond.notify_all()
+
+    def _write(self, job):
+        if "object" in job:
+            atomic_save(job["object"], job["path"])
+            return
+        for name, (training, state_dict) in job["snapshot"].items():
+            self._templates[name].load_state_dict(state_dict)
+            self._templates[name].train(training)
+        atomic_save(dict(self._templates), job["path"])
+        if job["metric"] is None:
+            return
+        with self._cond:
+            ranked = self._rank(self.checkpoints + [(job["metric"], job["path"])])
+            self.checkpoints = ranked[:self.top_k]
+        for _, path in ranked[self.top_k:]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,58 @@
+import contextlib
+import inspect
+import torch
+
+try:
+    import torch.fft # a module since torch 1.7, a function before
+    HAS_FFT = inspect.ismodule(torch.fft)
+except ImportError:
+    HAS_FFT = False
+
+
+def load(file_path, map_location=None):
+    """
+    `torch.load` of the full pickled objects (e.g. the models of `final.pt`), `weights_only`
+    defaults to True since torch 2.6 and does not exist before torch 1.13.
+    """
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(file_path, map_location=map_location, weights_only=False)
+    return torch.load(file_path, map_location=map_location)
+
+
+def autocast(device_type, dtype=None, enabled=True):
+    """
+    `torch.autocast`, which needs torch >= 1.10. On older versions only the disabled context
+    is available, it does nothing since there is no autocast region to leave.
+    """
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device_type, dtype=dtype, enabled=enabled)
+    if enabled:
+        raise RuntimeError("Mixed precision training needs torch >= 1.10")
+    return contextlib.nullcontext()
+
+
+def grad_scaler(device_type):
+    """
+    The gradient scaler of the fp16 mixed precision training on `device_type`.
+    """
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type)
+    if device_type == "cuda":
+        return torch.cuda.amp.GradScaler()
+    raise RuntimeError(f"float16 mixed precision training on {device_type} needs torch >= 2.3")
+
+
+def inference_mode():
+    """
+    `torch.inference_mode`, or `torch.no_grad` before torch 1.9.
+    """
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def is_fx_proxy(x):
+    """
+    Whether `x` is traced by `torch.fx` (torch >= 1.8).
+    """
+    return hasattr(torch, "fx") and isinstance(x, torch.fx.Proxy)
@@ -0,0 +1,171 @@
+import copy
+from collections import Counter
+import torch
+from torch import nn
+
+
+FOLDABLE_LAYERS = (nn.Linear, nn.Conv1d, nn.ConvTranspose1d)
+
+
+def _batchnorm_affine(bn):
+    """
+    The per-channel `scale` and `shift` of a BatchNorm in evaluation mode, y = scale * x + shift.
+    """
+    scale = 1.0 / torch.sqrt(bn.running_var + bn.eps)
+    shift = - bn.running_mean * scale
+    if bn.affine:
+        scale, shift = scale * bn.weight, shift * bn.weight + bn.bias
+    return scale.detach(), shift.detach()
+
+
+def _channel_view(layer, x, out_channels):
+    """
+    View the per-channel vector `x` to multiply the weight of `layer` along its output channels
+    (`out_channels=True`) or its input channels.
+    """
+    weight = layer.weight
+    if isinstance(layer, nn.Linear):
+        return x.view(-1, 1) if out_channels else x.view(1, -1)
+    g = layer.groups
+    if isinstance(layer, nn.Conv1d): # weight (out, in/g, k)
+        if out_channels:
+            return x.view(-1, 1, 1)
+        return x.view(g, 1, -1, 1).expand(g, weight.size(0) // g, -1, 1).reshape(weight.size(0), -1, 1)
+    # ConvTranspose1d, weight (in, out/g, k)
+    if out_channels:
+        return x.view(g, 1, -1, 1).expand(g, weight.size(0) // g, -1, 1).reshape(weight.size(0), -1, 1)
+    return x.view(-1, 1, 1)
+
+
+def _fold_after(layer, scale, shift):
+    """
+    Fold y = scale * layer(x) + shift into `layer`.
+    """
+    with torch.no_grad():
+        bias = layer.bias if layer.bias is not None else torch.zeros_like(scale)
+        layer.weight.mul_(_channel_view(layer, scale, out_channels=True))
+        layer.bias = nn.Parameter(bias * scale + shift)
+
+
+def _fold_before(layer, scale, shift, in_shape):
+    """
+    Fold y = layer(scale * x + shift) into `layer`. The constant `shift` maps to a constant
+    output per channel (checked by `_foldable_before`), which is added to the bias.
+    """
+    with torch.no_grad():
+        const_in = shift.view(1, -1, *[1] * (len(in_shape) - 2)).expand(1, *in_shape[1:])
+        zero_in = torch.zeros_like(const_in)
+        delta = layer(const_in) - layer(zero_in)
+        delta = delta[0] if delta.dim() == 2 else delta[0, :, delta.size(-1) // 2]
+        bias = layer.bias if layer.bias is not None else torch.zeros_like(delta)
+        layer.weight.mul_(_channel_view(layer, scale, out_channels=False))
+        layer.bias = nn.Parameter(bias + delta)
+
+
+def _foldable_before(layer, in_shape):
+    """
+    Whether an affine map of the input channels of `layer` folds exactly into it: the channels
+    must be the dimension 1 of the input and a constant input must give a constant output,
+    which rules out zero padding and transposed convolutions with kernels longer than 1 (the
+    output positions see different taps).
+    """
+    if isinstance(layer, nn.Linear):
+        return len(in_shape) == 2
+    if isinstance(layer, nn.Conv1d):
+        return layer.padding_mode != "zeros" or layer.padding[0] == 0
+    return layer.padding[0] == 0 and layer.kernel_size[0] == 1 and layer.stride[0] == 1
+
+
+def fold_batchnorm(model, example_input):
+    """
+    Return an inference copy of `model` as a `torch.fx.GraphModule`, with the Dropout layers
+    removed and the BatchNorm layers folded into the adjacent Linear/Conv1d/ConvTranspose1d
+    layers where this is exact: a BatchNorm in evaluation mode is a per-channel affine map, it
+    folds into the output channels of the layer before it or the input channels of the layer
+    after it, if that layer is its only neighbour in the graph. The other BatchNorms are kept.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The encoder or the decoder.
+    example_input : torch.Tensor
+        An input of `model`, used to find the shapes of the intermediate tensors.
+    """
+    from torch.fx import symbolic_trace # torch >= 1.8
+    from torch.fx.passes.shape_prop import ShapeProp
+
+    gm = symbolic_trace(copy.deepcopy(model).eval())
+    modules = dict(gm.named_modules())
+    ShapeProp(gm).propagate(example_input)
+
+    for node in list(gm.graph.nodes):
+        if node.op == "call_module" and isinstance(modules[node.target], nn.Dropout):
+            node.replace_all_uses_with(node.args[0])
+            gm.graph.erase_node(node)
+
+    # a layer called more than once (shared weights) is left alone
+    n_calls = Counter(node.target for node in gm.graph.nodes if node.op == "call_module")
+    for node in list(gm.graph.nodes):
+        if node.op != "call_module" or not isinstance(modules[node.target], nn.modules.batchnorm._BatchNorm):
+            continue
+        bn = modules[node.target]
+        if bn.running_mean is None:
+            continue
+        scale, shift = _batchnorm_affine(bn)
+        prev, users = node.args[0], list(node.users)
+        if isinstance(prev, torch.fx.Node) and prev.op == "call_module" and n_calls[prev.target] == 1 \
+                and isinstance(modules[prev.target], FOLDABLE_LAYERS) and len(prev.users) == 1 \
+                and (not isinstance(modules[prev.target], nn.Linear) or len(node.meta["tensor_meta"].shape) == 2):
+            _fold_after(modules[prev.target], scale, shift)
+        elif len(users) == 1 and users[0].op == "call_module" and n_calls[users[0].target] == 1 \
+                and isinstance(modules[users[0].target], FOLDABLE_LAYERS) \
+                and _foldable_before(modules[users[0].target], node.meta["tensor_meta"].shape):
+            _fold_before(modules[users[0].target], scale, shift, node.meta["tensor_meta"].shape)
+        else:
+            continue
+        node.replace_all_uses_with(prev)
+        gm.graph.erase_node(node)
+
+    gm.graph.eliminate_dead_code()
+    gm.delete_all_unused_submodules()
+    gm.recompile()
+    return gm
+
+
+EXPORT_FORMATS = ["torchscript", "export"]
+
+
+def export_model(model, example_input, file_path, format="torchscript", fold=True):
+    """
+    Save an inference artifact of `model` that loads with torch alone, without the `sc`
+    package. The inputs must have the shape of `example_input` except for the batch size.
+
+    Parameters
+    ----------
+    format : str
+        "torchscript": a traced and frozen TorchScript module, loaded by `torch.jit.load`.
+        "export": a `torch.export` program (.pt2), loaded by `torch.export.load(...).module()`,
+        needs torch >= 2.1.
+    fold : bool
+        Remove the Dropout layers and fold the BatchNorm layers first, see `fold_batchnorm`.
+
+    Returns
+    -------
+    The exported module.
+    """
+    assert format in EXPORT_FORMATS, f"Unknown export format {format}"
+    model = fold_batchnorm(model, example_input) if fold else copy.deepcopy(model).eval()
+    if format == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_input)
+        exported = traced.eval()
+        if hasattr(torch.jit, "optimize_for_inference"): # torch >= 1.9
+            exported = torch.jit.optimize_for_inference(torch.jit.freeze(exported))
+        torch.jit.save(exported, file_path)
+        return exported
+    if not hasattr(torch, "export"):
+        raise RuntimeError("The export format needs torch >= 2.1, use torchscript instead")
+    batch = torch.export.Dim("batch", min=1)
+    program = torch.export.export(model, (example_input,), dynamic_shapes=({0: batch},))
+    torch.export.save(program, file_path)
+    return program.module()
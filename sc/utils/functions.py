@@ -1,8 +1,10 @@
 from typing import no_type_check_decorator
 import torch
 from torch import nn
+import math
 import numpy as np
 from sc.clustering.model import GaussianSmoothing
+from sc.utils.compat import autocast, HAS_FFT
 
 
 class TrainingLossGeneral():
@@ -34,7 +36,77 @@ class KendallConstraint(TrainingLossGeneral):
         pass
       
     
-def kendall_constraint(descriptors, styles, activate=False, device=None):
+KENDALL_CHUNK_SIZE = 256 # rows of the pairwise (chunk, batch, n_aux) tiles in `kendall_constraint`.
+
+
+class _KendallConstraintTiled(torch.autograd.Function):
+    """
+    Exact Kendall constraint evaluated tile by tile, so the peak memory is
+    O(chunk_size * batch_size * n_aux) instead of O(batch_size^2 * n_aux).
+
+    The loss is linear in `styles` once the signs of the pair products are fixed, so the
+    gradient w.r.t. `styles[i, k]` is `-2 / norm * sum_j w[i,j,k] * aux_target[i,j,k]`, where
+    `w` is the reweighting factor of the positive products (1 for the others). It is accumulated
+    in the forward pass and only this (batch_size, n_aux) array is kept for the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, styles, descriptors, activate, chunk_size):
+        n_batch, n_aux = styles.size()
+        n_same = torch.zeros(n_aux, device=styles.device)
+        n_opp = torch.zeros(n_aux, device=styles.device)
+        sum_same = torch.zeros(n_aux, dtype=styles.dtype, device=styles.device)
+        sum_all = torch.zeros(n_aux, dtype=styles.dtype, device=styles.device)
+        grad_same = torch.zeros_like(styles)
+        grad_all = torch.zeros_like(styles)
+        for i in range(0, n_batch, chunk_size):
+            aux_target = torch.sign(descriptors[i:i+chunk_size, np.newaxis, :] - descriptors[np.newaxis, :, :])
+            aux_pred = styles[i:i+chunk_size, np.newaxis, :] - styles[np.newaxis, :, :]
+            product = aux_pred * aux_target
+            same_sel = product > 0
+            n_same += same_sel.sum(dim=(0, 1))
+            n_opp += (product < 0).sum(dim=(0, 1))
+            sum_same += (product * same_sel).sum(dim=(0, 1))
+            sum_all += product.sum(dim=(0, 1))
+            grad_same[i:i+chunk_size] = (aux_target * same_sel).sum(dim=1)
+            grad_all[i:i+chunk_size] = aux_target.sum(dim=1)
+
+        if activate: # reweight the pairs ranked in the same order, see `kendall_constraint`.
+            n_same = n_same.clamp(min=1)
+            n_opp = n_opp.clamp(min=1)
+            factor = (n_opp / torch.max(n_same, n_opp)).to(styles.dtype)
+        else:
+            factor = torch.ones(n_aux, dtype=styles.dtype, device=styles.device)
+        norm = (n_batch**2 - n_batch) * n_aux
+        aux_loss = - (factor * sum_same + sum_all - sum_same).sum() / norm
+        ctx.save_for_backward(- 2.0 * (factor * grad_same + grad_all - grad_same) / norm)
+        return aux_loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_styles, = ctx.saved_tensors
+        return grad_output * grad_styles, None, None, None
+
+
+def _kendall_constraint_sampled(descriptors, styles, activate, n_pairs):
+    """
+    Estimate the Kendall constraint from `n_pairs` random ordered pairs (i, j), i != j.
+    Without `activate`, this is an unbiased estimator of the exact loss.
+    """
+    n_batch, n_aux = styles.size()
+    index_i = torch.randint(0, n_batch, (n_pairs,), device=styles.device)
+    index_j = (index_i + torch.randint(1, n_batch, (n_pairs,), device=styles.device)) % n_batch
+    aux_target = torch.sign(descriptors[index_i] - descriptors[index_j])
+    product = (styles[index_i] - styles[index_j]) * aux_target
+    if activate:
+        n_same = (product > 0).sum(dim=0).clamp(min=1)
+        n_opp = (product < 0).sum(dim=0).clamp(min=1)
+        factor = (n_opp / torch.max(n_same, n_opp)).to(styles.dtype)
+        product = torch.where(product > 0, product * factor, product)
+    return - product.sum() / (n_pairs * n_aux)
+
+
+def kendall_constraint(descriptors, styles, activate=False, device=None, chunk_size=None, n_pairs=None):
     """
     Implement kendall_constraint. It runs on GPU.
     Kendall Rank Correlation Coefficeint:
@@ -46,6 +118,15 @@ def kendall_constraint(descriptors, styles, activate=False, device=None):
         Array of hape (M, N) where M is the number of data points, N is the number of descriptors.
     styles : array_like
         It has the same shape of `descriptors`.
+    activate : bool
+        If True, for each descriptor the pairs ranked in the same order by the style are
+        down-weighted by `n_opp / max(n_same, n_opp)`.
+    chunk_size : int
+        Number of rows of the pairwise tiles, which bounds the memory of the exact loss.
+        Default is `KENDALL_CHUNK_SIZE`.
+    n_pairs : int
+        If given (and smaller than the number of pairs), estimate the loss from `n_pairs` randomly
+        sampled pairs instead of all of them.
 
     Notes
     -----
@@ -54,29 +135,18 @@ def kendall_constraint(descriptors, styles, activate=False, device=None):
     """
     if device is None:
         device = torch.device('cpu')
+    if chunk_size is None:
+        chunk_size = KENDALL_CHUNK_SIZE
     
-    try:
-        n_aux = styles.shape[1]
-    except:
-        raise
-
-    aux_target = torch.sign(descriptors[:, np.newaxis, :] - descriptors[np.newaxis, :, :])
     assert len(styles.size()) == 2
-    aux_pred = styles[:, np.newaxis, :] - styles[np.newaxis, :, :]
-    aux_len = aux_pred.size()[0]
-    product = aux_pred * aux_target
-    if activate:
-        full_same_sel = product > 0
-        full_opp_sel = product < 0
-        aux_indices = torch.arange(n_aux, device=device)
-        for i in range(n_aux):
-            aux_sel = aux_indices == i
-            n_same = max(torch.numel(product[full_same_sel & aux_sel]), 1)
-            n_opp = max(torch.numel(product[full_opp_sel & aux_sel]), 1)
-            product[full_same_sel & aux_sel] *= n_opp / max(n_same, n_opp)
-    aux_loss = - product.sum() / ((aux_len**2 - aux_len) * n_aux)
-
-    return aux_loss
+    n_batch = styles.size()[0]
+    if styles.dtype in [torch.float16, torch.bfloat16]: # the sign products are computed in fp32
+        styles = styles.float()
+    descriptors = descriptors.to(styles.dtype)
+    with autocast(styles.device.type, enabled=False):
+        if n_pairs is not None and n_pairs < n_batch**2 - n_batch:
+            return _kendall_constraint_sampled(descriptors, styles, activate, n_pairs)
+        return _KendallConstraintTiled.apply(styles, descriptors, activate, chunk_size)
 
 def recon_loss(spec_in, spec_out, scale=False, mse_loss=None, device=None):
     """
@@ -100,9 +170,13 @@ def recon_loss(spec_in, spec_out, scale=False, mse_loss=None, device=None):
         recon_loss = mse_loss(spec_out, spec_in)
     else:
         spec_scale = torch.abs(spec_out.mean(dim=1)) / torch.abs(spec_in.mean(dim=1))
-        recon_loss = ((spec_scale - 1.0) ** 2).mean() * 0.1
+        scale_penalty = (spec_scale - 1.0) ** 2
         spec_scale = torch.clamp(spec_scale.detach(), min=0.7, max=1.3)
-        recon_loss += mse_loss(spec_out,(spec_in.T * spec_scale).T)
+        mse = mse_loss(spec_out,(spec_in.T * spec_scale).T)
+        # the penalty is averaged over the same spectra as the MSE, e.g. per replica for the
+        # vector of a `ReplicaLoss`.
+        scale_penalty = scale_penalty.reshape(mse.numel(), -1).mean(dim=1).reshape(mse.size())
+        recon_loss = scale_penalty * 0.1 + mse
     
     return recon_loss
 
@@ -126,12 +200,24 @@ def adversarial_loss(spec_in, styles, D, alpha, batch_size=100,  nll_loss=None,
     fake_gauss_pred = D(styles, alpha)
     fake_gauss_label = torch.zeros(spec_in.size()[0], dtype=torch.float32, requires_grad=False,device=device)
             
-    adversarial_loss = nll_loss(real_gauss_pred.squeeze(), real_gauss_label) \
-                        + nll_loss(fake_gauss_pred.squeeze(), fake_gauss_label)
+    # the logits are cast to fp32 for the loss under mixed precision
+    adversarial_loss = nll_loss(real_gauss_pred.squeeze().float(), real_gauss_label) \
+                        + nll_loss(fake_gauss_pred.squeeze().float(), fake_gauss_label)
 
     return adversarial_loss
 
 
+def _gauss_labels(pred, label, loss_fn):
+    """
+    The labels (1: real gaussian samples, 0: styles) of the discriminator output `pred`: class
+    indices for the NLL and cross entropy losses, targets of the shape of the logit of
+    `DiscriminatorFC` for `BCEWithLogitsLoss`.
+    """
+    if isinstance(getattr(loss_fn, "loss_fn", loss_fn), nn.BCEWithLogitsLoss): # also wrapped by `ReplicaLoss`
+        return torch.full(pred.size(), label, dtype=torch.float32, device=pred.device)
+    return torch.full((pred.size()[0],), label, dtype=torch.long, device=pred.device)
+
+
 def discriminator_loss(styles, D, batch_size=100,  loss_fn=None, device=None):
     """
     Parameters
@@ -145,28 +231,32 @@ def discriminator_loss(styles, D, batch_size=100,  loss_fn=None, device=None):
 
     z_real_gauss = torch.randn(batch_size, styles.size()[1], requires_grad=True, device=device)
     real_gauss_pred = D(z_real_gauss, None) # no gradient reversal, alpha=None
-    real_gauss_label = torch.ones(batch_size, dtype=torch.long, requires_grad=False, device=device)
+    real_gauss_label = _gauss_labels(real_gauss_pred, 1, loss_fn)
     
     fake_gauss_pred = D(styles, None)
-    fake_gauss_label = torch.zeros(styles.size()[0], dtype=torch.long, requires_grad=False,device=device)
+    fake_gauss_label = _gauss_labels(fake_gauss_pred, 0, loss_fn)
             
-    loss = loss_fn(real_gauss_pred, real_gauss_label) + loss_fn(fake_gauss_pred, fake_gauss_label)
+    loss = loss_fn(real_gauss_pred.float(), real_gauss_label) + loss_fn(fake_gauss_pred.float(), fake_gauss_label)
 
     return loss
 
 
-def generator_loss(spec_in, encoder, D, loss_fn=None, device=None):
+def generator_loss(spec_in, encoder, D, loss_fn=None, device=None, styles=None):
+    """
+    If `styles` is given, it is used as the encoded `spec_in` instead of calling `encoder` again.
+    """
     if device is None:
         device = torch.device('cpu')
     if loss_fn is None:
         loss_fn = nn.CrossEntropyLoss.to(device)
 
-    styles = encoder(spec_in)
+    if styles is None:
+        styles = encoder(spec_in)
     fake_gauss_pred = D(styles, None) # no gradient reversal, alpha=None
 
-    fake_gauss_label = torch.zeros(styles.size()[0], dtype=torch.long, requires_grad=False,device=device)
+    fake_gauss_label = _gauss_labels(fake_gauss_pred, 0, loss_fn)
             
-    loss = loss_fn(fake_gauss_pred, fake_gauss_label)
+    loss = loss_fn(fake_gauss_pred.float(), fake_gauss_label)
 
     return loss
 
@@ -191,26 +281,130 @@ def mutual_info_loss(spec_in, styles, encoder, decoder, mse_loss=None, device=No
     
     return mutual_info_loss
 
-def smoothness_loss(spec_out, gs_kernel_size, mse_loss=None, device=None):
+class GaussianSmoother(object):
+    """
+    Gaussian smoothing of a batch of spectra of shape (batch_size, n_grid), with replication
+    padding so that the output has the same length as the input.
+    The kernel is built once. Two equivalent paths are available:
+        "direct" : `conv1d` with the kernel, O(n_grid * kernel_size).
+        "fft" : product of the real FFTs, O(n_grid * log(n_grid)), for long kernels/spectra.
+        "auto" : "fft" for odd kernels longer than `FFT_MIN_KERNEL_SIZE`, "direct" otherwise.
+    The "fft" path needs the `torch.fft` module (torch >= 1.7), "auto" is "direct" without it.
+    Use `get_gaussian_smoother` to share the instances.
+    """
+
+    FFT_MIN_KERNEL_SIZE = 64
+
+    def __init__(self, kernel_size, sigma=3.0, device=None, dtype=torch.float32, method="auto"):
+        if device is None:
+            device = torch.device('cpu')
+        assert method in ["auto", "direct", "fft"]
+        if method == "auto":
+            use_fft = HAS_FFT and kernel_size % 2 == 1 and kernel_size > self.FFT_MIN_KERNEL_SIZE
+            method = "fft" if use_fft else "direct"
+        if method == "fft":
+            assert kernel_size % 2 == 1, "The FFT path requires an odd kernel size."
+            assert HAS_FFT, "The FFT path requires torch >= 1.7."
+        gaussian_smoothing = GaussianSmoothing(
+            channels=1, kernel_size=kernel_size, sigma=sigma, dim=1,
+            device = device
+        )
+        self.weight = gaussian_smoothing.weight.to(dtype) # shape (1, 1, kernel_size)
+        self.kernel_size = kernel_size
+        self.padding = (kernel_size - 1) // 2
+        self.method = method
+        self.dtype = dtype
+        self._kernel_fft = {} # keyed by the FFT length
+
+    def __call__(self, spec):
+        spec = spec.to(self.dtype)
+        spec_padded = nn.functional.pad(spec.unsqueeze(dim=1), (self.padding, self.padding), mode='replicate')
+        if self.method == "direct":
+            return nn.functional.conv1d(spec_padded, self.weight).squeeze(dim=1)
+
+        # The kernel is symmetric, so the valid part of the (full) convolution equals the
+        # cross-correlation computed by `conv1d`.
+        spec_padded = spec_padded.squeeze(dim=1)
+        n_grid = spec.size()[-1]
+        n_fft = spec_padded.size()[-1] + self.kernel_size - 1
+        if n_fft not in self._kernel_fft:
+            self._kernel_fft[n_fft] = torch.fft.rfft(self.weight.view(-1), n=n_fft)
+        spec_smoothed = torch.fft.irfft(
+            torch.fft.rfft(spec_padded, n=n_fft) * self._kernel_fft[n_fft], n=n_fft
+        )
+        return spec_smoothed[:, self.kernel_size-1:self.kernel_size-1+n_grid]
+
+
+_SMOOTHER_CACHE = {}
+
+def get_gaussian_smoother(kernel_size, sigma=3.0, device=None, dtype=torch.float32, method="auto"):
+    """
+    Return the `GaussianSmoother` for (kernel_size, sigma, device, dtype, method), built only once.
+    """
+    if device is None:
+        device = torch.device('cpu')
+    key = (kernel_size, sigma, str(device), dtype, method)
+    if key not in _SMOOTHER_CACHE:
+        _SMOOTHER_CACHE[key] = GaussianSmoother(kernel_size, sigma, device=device, dtype=dtype, method=method)
+    return _SMOOTHER_CACHE[key]
+
+
+def smoothness_loss(spec_out, gs_kernel_size, mse_loss=None, device=None, smoother=None):
     """
     Return the smoothness loss.
+    If `smoother` is not given, the cached smoother of `gs_kernel_size` and `device` is used.
     """
     if device is None:
         device = torch.device('cpu')
     if mse_loss is None:
         mse_loss = nn.MSELoss().to(device)
+    if smoother is None:
+        smoother = get_gaussian_smoother(gs_kernel_size, device=device, dtype=spec_out.dtype)
 
-    gaussian_smoothing = GaussianSmoothing(
-        channels=1, kernel_size=gs_kernel_size, sigma=3.0, dim=1,
-        device = device
-    )
-    padding4smooth = nn.ReplicationPad1d(padding=(gs_kernel_size - 1)//2).to(device)
-    spec_out_padded = padding4smooth(spec_out.unsqueeze(dim=1))
-    spec_smoothed = gaussian_smoothing(spec_out_padded).squeeze(dim=1)
+    spec_smoothed = smoother(spec_out)
     smooth_loss_train = mse_loss(spec_out, spec_smoothed)
 
     return smooth_loss_train
 
+def style_normality(styles):
+    """
+    Shapiro-Francia W' statistic of each column of `styles`, computed for all the styles at once.
+    W' is the squared correlation between the sorted samples and the expected normal order
+    statistics (Blom scores), a close approximation of the Shapiro-Wilk W.
+
+    Parameters
+    ----------
+    styles : torch.Tensor
+        2-D tensor of shape (n_samples, nstyle).
+    """
+    styles = styles.detach().double()
+    n_samples = styles.size()[0]
+    rank = torch.arange(1, n_samples + 1, dtype=styles.dtype, device=styles.device)
+    blom = (rank - 0.375) / (n_samples + 0.25)
+    m = math.sqrt(2.0) * torch.erfinv(2.0 * blom - 1.0) # normal quantiles
+    m = m - m.mean()
+    x = torch.sort(styles, dim=0).values
+    x = x - x.mean(dim=0)
+    w = (m @ x) ** 2 / ((m ** 2).sum() * (x ** 2).sum(dim=0))
+    return w
+
+
+def style_coupling(styles):
+    """
+    Spearman correlation matrix of the columns of `styles` (rank transform by argsort, then
+    one Pearson correlation matrix). Ties are ranked by order of appearance.
+    Return the correlation matrix and the maximum absolute off-diagonal correlation.
+    """
+    styles = styles.detach()
+    n_samples, nstyle = styles.size()
+    ranks = torch.argsort(torch.argsort(styles, dim=0), dim=0).double()
+    ranks = ranks - ranks.mean(dim=0)
+    ranks = ranks / ranks.norm(dim=0)
+    corr = ranks.T @ ranks
+    off_diagonal = torch.triu_indices(nstyle, nstyle, offset=1, device=styles.device)
+    return corr, corr[off_diagonal[0], off_diagonal[1]].abs().max()
+
+
 def alpha(epoch_percentage, step=800, limit=0.7):
     """
     `epoch_percentage = epoch / max_epoch`
@@ -0,0 +1,94 @@
+import threading
+from sc.utils.checkpoint import to_cpu
+
+
+class MetricsWriter():
+    """
+    Write scalars and histograms to TensorBoard event files on a background thread.
+
+    The training loop only queues Python numbers and CPU copies of tensors; the summaries are
+    built (histograms included) and written by the writer thread through a
+    `torch.utils.tensorboard.SummaryWriter`, which requires the `tensorboard` package.
+    """
+
+    def __init__(self, log_dir, asynchronous=True, flush_secs=30):
+        from torch.utils.tensorboard import SummaryWriter
+        self.log_dir = log_dir
+        self.asynchronous = asynchronous
+        self.summary_writer = SummaryWriter(log_dir=log_dir, flush_secs=flush_secs)
+        self._pending = []
+        self._writing = False
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        if asynchronous:
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+
+    def add_scalars(self, scalars, step):
+        """
+        Queue the scalars `{tag: value}` of `step`, e.g. `{"Loss/Train_Recon": 0.05}`.
+        """
+        self._submit(("scalar", {tag: float(value) for tag, value in scalars.items()}, step))
+
+    def add_histograms(self, values, step):
+        """
+        Queue the histograms of the tensors `{tag: values}` of `step`, the tensors are copied to
+        the CPU memory before returning.
+        """
+        self._submit(("histogram", to_cpu(values), step))
+
+    def flush(self):
+        """
+        Block until all the queued summaries are written to the event file.
+        """
+        with self._cond:
+            while len(self._pending) > 0 or self._writing:
+                self._cond.wait()
+        self._raise_error()
+        self.summary_writer.flush()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.summary_writer.close()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to write the metrics.") from error
+
+    def _submit(self, job):
+        self._raise_error()
+        if not self.asynchronous:
+            self._write([job])
+            return
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify_all()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while len(self._pending) == 0 and not self._closed:
+                    self._cond.wait()
+                if len(self._pending) == 0:
+                    return
+                jobs, self._pending, self._writing = self._pending, [], True
+            try:
+                self._write(jobs)
+            except Exception as e:
+                self._error = e
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+    def _write(self, jobs):
+        for kind, values, step in jobs:
+            for tag, value in values.items():
+                if kind == "scalar":
+                    self.summary_writer.add_scalar(tag, value, step)
+                else:
+                    self.summary_writer.add_histogram(tag, value.float().numpy(), step)
@@ -0,0 +1,76 @@
+import math
+import torch
+
+
+class SharedMomentAdamW(torch.optim.Optimizer):
+    """
+    AdamW whose moment buffers are shared by the optimizers given the same `shared_state`
+    dictionary: a parameter registered in several of them (one per loss term in
+    `Trainer.load_optimizers`) has a single pair of first and second moments instead of one
+    pair per optimizer. Without `shared_state`, the state is private to the optimizer.
+
+    Each optimizer folds the gradient of its own loss term into the shared moments with its
+    own betas, then applies its own learning rate and weight decay. The bias correction keeps
+    the product of the betas applied to each parameter, so it stays exact when the optimizers
+    use different betas. A parameter in a single optimizer is updated as by `torch.optim.AdamW`.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2, shared_state=None):
+        assert lr >= 0.0, f"Invalid learning rate {lr}"
+        assert 0.0 <= betas[0] < 1.0 and 0.0 <= betas[1] < 1.0, f"Invalid betas {betas}"
+        assert eps >= 0.0 and weight_decay >= 0.0
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay))
+        # parameter -> its state, shared by the optimizers of the parameter.
+        self._shared_state = shared_state if shared_state is not None else {}
+        self._link_state()
+
+    def _link_state(self):
+        """
+        Point the state of every parameter to its shared state, the state of this optimizer
+        (e.g. just loaded by `load_state_dict`) replaces the shared one.
+        """
+        for group in self.param_groups:
+            for p in group['params']:
+                if p not in self._shared_state:
+                    self._shared_state[p] = {}
+                shared = self._shared_state[p]
+                if p in self.state and self.state[p] is not shared:
+                    shared.clear()
+                    shared.update(self.state[p])
+                self.state[p] = shared
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        self._link_state()
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['beta1_product'] = 1.0
+                    state['beta2_product'] = 1.0
+                    state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                    state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                state['step'] += 1
+                state['beta1_product'] *= beta1
+                state['beta2_product'] *= beta2
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+                exp_avg.lerp_(p.grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+                bias_correction1 = 1 - state['beta1_product']
+                bias_correction2 = 1 - state['beta2_product']
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                p.addcdiv_(exp_avg, denom, value=-group['lr'] / bias_correction1)
+        return loss
@@ -1,5 +1,103 @@
 import os
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+
+
+def init_worker(num_threads=1, cpu_queue=None):
+    """
+    Pin the number of torch threads of a worker process, so that concurrent trials do not
+    oversubscribe the cores. If `cpu_queue` is given, the worker takes one CPU set from it, binds
+    to those CPUs and uses one thread per CPU.
+    """
+    if cpu_queue is not None:
+        cpu_set = cpu_queue.get()
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpu_set)
+        num_threads = len(cpu_set)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+
+class SerialExecutor():
+    """
+    Run the trials one after another in the current process.
+    """
+    def __init__(self, **kwargs):
+        self.n_workers = 1
+
+    def map_unordered(self, fn, *iterables):
+        for args in zip(*iterables):
+            yield fn(*args)
+
+    def shutdown(self):
+        pass
+
+
+class ProcessExecutor():
+    """
+    Run the trials on a local pool of spawned processes, each pinned to `num_threads` torch threads,
+    or, if `cpu_sets` is given (see `sc.utils.affinity.plan_cpu_sets`), one worker per CPU set
+    bound to it.
+    """
+    def __init__(self, n_workers=None, num_threads=1, cpu_sets=None, **kwargs):
+        context = multiprocessing.get_context("spawn")
+        cpu_queue = None
+        if cpu_sets is not None:
+            n_workers = len(cpu_sets)
+            cpu_queue = context.Queue()
+            for cpu_set in cpu_sets:
+                cpu_queue.put(cpu_set)
+        self.n_workers = n_workers or max(os.cpu_count() // num_threads, 1)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(num_threads, cpu_queue)
+        )
+
+    def map_unordered(self, fn, *iterables):
+        futures = [self.pool.submit(fn, *args) for args in zip(*iterables)]
+        for future in as_completed(futures):
+            yield future.result()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class IpyparallelExecutor():
+    """
+    Run the trials on the engines of a running ipcluster (see `ipcluster`).
+    """
+    def __init__(self, work_dir=".", **kwargs):
+        import ipyparallel as ipp
+        self.client = ipp.Client(
+            connection_info=f"{work_dir}/ipypar/security/ipcontroller-client.json"
+        )
+        self.n_workers = len(self.client.ids)
+
+    def map_unordered(self, fn, *iterables):
+        return self.client.load_balanced_view().map(fn, *iterables, ordered=False, block=False)
+
+    def shutdown(self):
+        self.client.close()
+
+
+EXECUTOR_DICT = {
+    "serial": SerialExecutor,
+    "process": ProcessExecutor,
+    "ipyparallel": IpyparallelExecutor
+}
+
+
+def get_executor(name, **kwargs):
+    """
+    Create the executor `name` ("serial", "process" or "ipyparallel"). `map_unordered` of the
+    executor yields the results as the trials finish.
+    """
+    assert name in EXECUTOR_DICT, f"Unknown executor: {name}"
+    return EXECUTOR_DICT[name](**kwargs)
 
 
 def ipcluster(action, n=8, ipypar_path='.ipypar'):
@@ -10,6 +10,7 @@ from sc.clustering.model import (
 )
 import torch_optimizer as ex_optim
 from torch import optim
+from sc.utils.optim import SharedMomentAdamW
 
 AE_CLS_DICT = {
     "normal": {
@@ -35,7 +36,8 @@ OPTIM_DICT = {
     "Adam": optim.Adam, 
     "AdamW": optim.AdamW,
     "AdaBound": ex_optim.AdaBound, 
-    "RAdam": ex_optim.RAdam
+    "RAdam": ex_optim.RAdam,
+    "SharedMomentAdamW": SharedMomentAdamW # one pair of Adam moments per parameter for all the optimizers.
 }
 
 
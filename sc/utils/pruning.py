@@ -0,0 +1,92 @@
+import os
+import numpy as np
+
+
+class MedianPruner():
+    """
+    Stop a trial whose best combined metric so far is worse than the median (or another
+    `percentile`) of the best combined metrics of its peers at the same epoch.
+
+    The trials share their curves through files in `record_dir` (one `trial_{k}.csv` of
+    "epoch,best_combined_metric" rows per trial), so the trials can run in different processes
+    or on different nodes. Trials that ran earlier count as peers too, as long as they reached
+    the epoch. The combined metric is the one of `Trainer`, lower is better as for the learning
+    rate schedulers.
+
+    Parameters
+    ----------
+    record_dir : str
+        The directory shared by the trials.
+    trial : int
+        The number of this trial.
+    metric_weights : list
+        The weights of the metrics in the combined metric, `Trainer.metric_weights`.
+    warmup_epochs : int
+        No trial is pruned before this epoch.
+    interval : int
+        Epochs between two records (and checks).
+    min_trials : int
+        The minimum number of peers that reached the epoch to prune.
+    percentile : float
+        The trial is pruned if it is worse than this percentage of its peers, 50 for the
+        median, lower values prune more trials.
+    resume : bool
+        Continue the record of the trial instead of starting it over.
+    """
+
+    def __init__(
+        self, record_dir, trial, metric_weights,
+        warmup_epochs=100, interval=10, min_trials=4, percentile=50.0, resume=False
+    ):
+        os.makedirs(record_dir, exist_ok=True)
+        self.record_dir = record_dir
+        self.trial = trial
+        self.metric_weights = np.array(metric_weights)
+        self.warmup_epochs = warmup_epochs
+        self.interval = interval
+        self.min_trials = min_trials
+        self.percentile = percentile
+        self.best_metric = np.inf
+        self.record_file = os.path.join(record_dir, f"trial_{trial}.csv")
+        if os.path.exists(self.record_file):
+            if resume:
+                records = np.loadtxt(self.record_file, delimiter=",", ndmin=2)
+                if len(records) > 0:
+                    self.best_metric = records[:, 1].min()
+            else:
+                os.remove(self.record_file)
+
+    def __call__(self, epoch, metrics):
+        """
+        Record the metrics of `epoch`, return True if the trial should stop.
+        """
+        if None in metrics:
+            return False
+        self.best_metric = min(self.best_metric, - (self.metric_weights * np.array(metrics)).sum())
+        if epoch % self.interval != 0:
+            return False
+        with open(self.record_file, 'a') as f:
+            f.write(f"{epoch},{self.best_metric}\n")
+        if epoch < self.warmup_epochs:
+            return False
+        peers = self.peer_metrics(epoch)
+        if len(peers) < self.min_trials:
+            return False
+        return self.best_metric > np.percentile(peers, self.percentile)
+
+    def peer_metrics(self, epoch):
+        """
+        The best combined metrics at `epoch` of the other trials that reached it.
+        """
+        peers = []
+        for fn in os.listdir(self.record_dir):
+            if not fn.startswith("trial_") or fn == os.path.basename(self.record_file):
+                continue
+            try:
+                records = np.loadtxt(os.path.join(self.record_dir, fn), delimiter=",", ndmin=2)
+            except ValueError: # partially written file
+                continue
+            if len(records) == 0 or records[:, 0].max() < epoch:
+                continue
+            peers.append(records[records[:, 0] <= epoch, 1].min())
+        return peers
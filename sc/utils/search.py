@@ -0,0 +1,215 @@
+import json
+import math
+import time
+import sqlite3
+import numpy as np
+
+
+class SearchSpace():
+    """
+    A hyperparameter search space read from a dictionary (e.g. the `space` section of a YAML
+    file), one entry per parameter:
+
+        lr_ratio_Reconn: {type: float, low: 0.5, high: 4.0, log: true}
+        n_layers: {type: int, low: 3, high: 6}
+        optimizer_name: {type: categorical, choices: [Adam, AdamW]}
+    """
+
+    def __init__(self, space):
+        for name, spec in space.items():
+            assert spec["type"] in ["float", "int", "categorical"], f"Unknown type of {name}: {spec['type']}"
+            if spec["type"] == "categorical":
+                assert len(spec["choices"]) > 0
+            else:
+                assert spec["low"] <= spec["high"]
+                assert not spec.get("log", False) or spec["low"] > 0
+        self.space = space
+
+    def sample(self, seed):
+        """
+        Draw one set of parameters, the same `seed` always gives the same parameters.
+        """
+        rng = np.random.default_rng(seed)
+        params = {}
+        for name, spec in self.space.items():
+            if spec["type"] == "categorical":
+                params[name] = spec["choices"][rng.integers(len(spec["choices"]))]
+            elif spec["type"] == "int":
+                params[name] = int(rng.integers(spec["low"], spec["high"] + 1))
+            elif spec.get("log", False):
+                params[name] = float(math.exp(rng.uniform(math.log(spec["low"]), math.log(spec["high"]))))
+            else:
+                params[name] = float(rng.uniform(spec["low"], spec["high"]))
+        return params
+
+
+class Study():
+    """
+    The trials of a search in a SQLite file, shared by the processes running the trials, so
+    that an interrupted search can be resumed.
+
+    Tables:
+        trials : parameters, state ("WAITING", "RUNNING", "COMPLETE", "PRUNED" or "TIMEOUT"),
+            best combined metric (value), last metrics and time of each trial.
+        rungs : the best combined metric of the trials at each rung of the successive halving.
+        meta : key/value settings of the study, e.g. the deadline of the search.
+    """
+
+    FINISHED = ("COMPLETE", "PRUNED")
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS trials (trial_id INTEGER PRIMARY KEY, params TEXT, "
+                "state TEXT, value REAL, metrics TEXT, time REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rungs (trial_id INTEGER, rung INTEGER, value REAL, "
+                "PRIMARY KEY (trial_id, rung))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add_trial(self, trial_id, params):
+        """
+        Add a waiting trial, unless `trial_id` is already in the study.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO trials (trial_id, params, state) VALUES (?, ?, 'WAITING')",
+                (trial_id, json.dumps(params))
+            )
+
+    def trials(self, states=None):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT trial_id, params, state, value, metrics, time FROM trials ORDER BY trial_id"
+            ).fetchall()
+        trials = [
+            {
+                "trial_id": trial_id, "params": json.loads(params), "state": state, "value": value,
+                "metrics": json.loads(metrics) if metrics is not None else None, "time": time_used
+            }
+            for trial_id, params, state, value, metrics, time_used in rows
+        ]
+        if states is not None:
+            trials = [t for t in trials if t["state"] in states]
+        return trials
+
+    def set_state(self, trial_id, state, **values):
+        """
+        Set the state and any of `value`, `metrics` and `time` of a trial.
+        """
+        if "metrics" in values:
+            values["metrics"] = json.dumps(values["metrics"])
+        columns = ", ".join(["state = ?"] + [f"{k} = ?" for k in values])
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE trials SET {columns} WHERE trial_id = ?", (state, *values.values(), trial_id)
+            )
+
+    def reset_trial(self, trial_id):
+        """
+        Forget the rungs of a trial, before running it again.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM rungs WHERE trial_id = ?", (trial_id,))
+            conn.execute(
+                "UPDATE trials SET state = 'WAITING', value = NULL, metrics = NULL, time = NULL "
+                "WHERE trial_id = ?", (trial_id,)
+            )
+
+    def report(self, trial_id, rung, value):
+        """
+        Record the `value` of a trial at `rung` and return the values of all the trials there.
+        """
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO rungs VALUES (?, ?, ?)", (trial_id, rung, value))
+            rows = conn.execute("SELECT value FROM rungs WHERE rung = ?", (rung,)).fetchall()
+        return [v for v, in rows]
+
+    def best_value(self, trial_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT MIN(value) FROM rungs WHERE trial_id = ?", (trial_id,)).fetchone()
+        return row[0]
+
+    def best_trial(self):
+        """
+        The finished trial with the lowest value.
+        """
+        trials = [t for t in self.trials(self.FINISHED) if t["value"] is not None]
+        if len(trials) == 0:
+            return None
+        return min(trials, key=lambda t: t["value"])
+
+    def get_meta(self, key, default=None):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+
+class AshaCallback():
+    """
+    Asynchronous successive halving (ASHA) as a `Trainer.train` callback.
+
+    The rungs are at epochs `min_epochs * reduction_factor**r`. When a trial reaches a rung,
+    it records its best combined metric (`Trainer.metric_weights`, lower is better) and it is
+    pruned unless it is in the best `1 / reduction_factor` of the trials that reached the rung
+    so far (once at least `min_trials` did). Trials never wait for each other, so the early
+    trials are judged against fewer peers. The trial also stops when the `deadline` of the study
+    (a time stamp) is passed. The callback is picklable, it only holds the study file path.
+    """
+
+    def __init__(self, study_path, trial_id, metric_weights, min_epochs=50, reduction_factor=3, min_trials=3):
+        assert min_epochs > 0 and reduction_factor > 1
+        self.study_path = study_path
+        self.trial_id = trial_id
+        self.metric_weights = np.array(metric_weights)
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+        self.min_trials = min_trials
+        self.best_metric = np.inf
+        self.pruned = False
+        self.timed_out = False
+        self._study = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_study"] = None
+        return state
+
+    @property
+    def study(self):
+        if self._study is None:
+            self._study = Study(self.study_path)
+        return self._study
+
+    def rung(self, epoch):
+        """
+        The rung at `epoch`, or None if `epoch` is not a rung.
+        """
+        if epoch < self.min_epochs:
+            return None
+        r = round(math.log(epoch / self.min_epochs, self.reduction_factor))
+        return r if self.min_epochs * self.reduction_factor**r == epoch else None
+
+    def __call__(self, epoch, metrics):
+        if None not in metrics:
+            self.best_metric = min(self.best_metric, - (self.metric_weights * np.array(metrics)).sum())
+        rung = self.rung(epoch)
+        if rung is not None and np.isfinite(self.best_metric):
+            values = sorted(self.study.report(self.trial_id, rung, float(self.best_metric)))
+            if len(values) >= self.min_trials:
+                threshold = values[max(len(values) // self.reduction_factor, 1) - 1]
+                self.pruned = self.best_metric > threshold
+        deadline = self.study.get_meta("deadline") if epoch % 10 == 0 else None
+        if deadline is not None and time.time() > deadline:
+            self.timed_out = True
+        return self.pruned or self.timed_out
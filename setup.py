@@ -22,11 +22,14 @@ setup(
             "wait_ipp_engines = sc.cmd.wait_ipp_engines:main",
             "train_lat2apdf = sc.cmd.train_lat2apdf:main",
             "train_lat2prdf = sc.cmd.train_lat2prdf:main",
-            "opt_hyper_single = sc.cmd.opt_hyper_single:main"
+            "opt_hyper_single = sc.cmd.opt_hyper_single:main",
+            "sc_export_model = sc.cmd.export_model:main",
+            "sc_encode = sc.cmd.encode:main",
+            "sc_bench = sc.cmd.bench:main",
+            "sc_bench_ops = sc.cmd.bench_ops:main"
         ]
     },
     scripts=[
-        "sc/cmd/opt_hyper.sh",
         "sc/cmd/start_ipyparallel_worker.sh",
         "sc/cmd/run_locally.sh"
     ]